@@ -0,0 +1,194 @@
+#!/usr/bin/python
+"""
+Checks the standby planner on synthetic gcode: that it is actually exercised and shortens
+the predicted waits, that it keeps the choice of the standby delta and dormant time when
+no candidate does better, and that it keeps every tool within its soak budget. Exits with
+a non-zero status if any check fails.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_gcode import write_gcode  # noqa: E402
+from process import ToolchangerPostprocessor  # noqa: E402
+
+
+# candidates of the planner, mostly below the print temperature less the standby delta of the generated tools
+STANDBY_TEMPS: str = 'STANDBY_TEMPS=150,180,200,220,240,260'
+# lets the planner park the tools above their usual idle temperature, where it can shorten the waits
+MAX_STANDBY_TEMP: str = 'MAX_STANDBY_TEMP=270'
+# soak budget of every tool, small enough that the plan without a budget goes over it
+MAX_STANDBY_SOAK_TIME_S: float = 120.0
+# the planner has to cut the predicted wait of the print by at least this fraction
+MIN_WAIT_REDUCTION: float = 0.1
+
+
+class PlannedGap:
+    """
+    An idle gap of a tool as planned by a processed file, with the predictions of the planner.
+    """
+
+    tool: int
+    temperature: int
+    fixed_temperature: int
+    # whether the planner may choose the fixed temperature, it may be above the tool's maximum standby temperature
+    fixed_allowed: bool
+    wait_s: float
+    fixed_wait_s: float
+    soak_s: float
+
+    def __init__(self, processor: ToolchangerPostprocessor, event: int, next_event: int) -> None:
+        """
+        Initialize the PlannedGap class.
+
+        :param processor: the processor, after processing
+        :param event: the toolchange deselecting the tool
+        :param next_event: the toolchange selecting the tool again
+        """
+        events = processor._toolchange_events
+        self.tool = events.outgoing_tools[event]
+        self.temperature = events.standby_temperatures[event]
+        self.fixed_temperature = processor._fixed_standby_temperature(event, next_event)
+        ceiling: int = processor._tool_configs[self.tool].max_standby_temperature
+        self.fixed_allowed = ceiling == -1 or self.fixed_temperature <= ceiling
+        self.wait_s, self.soak_s = processor._predict_reheat_wait(event, next_event, self.temperature)
+        self.fixed_wait_s = processor._predict_reheat_wait(event, next_event, self.fixed_temperature)[0]
+
+
+def plan_gaps(input_file_path: str) -> list[PlannedGap]:
+    """
+    Process a file without writing it and collect the idle gaps the deselect logic planned.
+
+    :param input_file_path: path to the gcode file
+    :return: the planned gaps in print order
+    """
+    processor = ToolchangerPostprocessor(input_file_path)
+    processor._process_sections()
+    events = processor._toolchange_events
+    return [
+        PlannedGap(processor, event, events.next_selection[event]) for event in range(len(events))
+        if events.next_selection[event] != -1 and not processor._indexed_sections[events.positions[event]].last_deselect
+    ]
+
+
+def predicted_wait(input_file_path: str, report_file_path: str) -> float:
+    """
+    Process a file without writing it and read the total predicted wait from its report.
+
+    :param input_file_path: path to the gcode file
+    :param report_file_path: path to write the report to
+    :return: the seconds the printer is predicted to wait at the toolchanges
+    """
+    ToolchangerPostprocessor(input_file_path).process_gcode(write_output=False, report_file_path=report_file_path)
+    with open(report_file_path, encoding='UTF-8') as readfile:
+        return json.load(readfile)['totals']['predicted_wait_s']
+
+
+def check_exercised(fixed_file_path: str, planned_file_path: str, work_dir: str) -> list[str]:
+    """
+    The planner changes the standby temperature of some gaps and cuts the predicted wait,
+    where a file without planner settings is the baseline.
+
+    :return: the failures
+    """
+    failures: list[str] = []
+    changed: int = sum(1 for gap in plan_gaps(planned_file_path) if gap.temperature != gap.fixed_temperature)
+    if changed == 0:
+        failures.append('the planner kept the fixed standby temperature of every gap')
+    fixed_wait_s: float = predicted_wait(fixed_file_path, os.path.join(work_dir, 'fixed.json'))
+    planned_wait_s: float = predicted_wait(planned_file_path, os.path.join(work_dir, 'planned.json'))
+    print(f'  {changed} gaps changed, predicted wait {fixed_wait_s:.0f}s without the planner, {planned_wait_s:.0f}s with it')
+    if planned_wait_s > fixed_wait_s * (1 - MIN_WAIT_REDUCTION):
+        failures.append(f'the predicted wait only went from {fixed_wait_s:.0f}s to {planned_wait_s:.0f}s')
+    return failures
+
+
+def check_ties(file_paths: list[str]) -> list[str]:
+    """
+    Without a budget a gap only gets another temperature than the fixed one if that shortens
+    its predicted wait, or if the fixed one is above the tool's maximum standby temperature.
+
+    :return: the failures
+    """
+    failures: list[str] = []
+    kept: int = 0
+    for file_path in file_paths:
+        for gap in plan_gaps(file_path):
+            if gap.temperature == gap.fixed_temperature:
+                kept += 1
+            elif gap.fixed_allowed and not gap.wait_s < gap.fixed_wait_s:
+                failures.append(f'T{gap.tool} parked at {gap.temperature} instead of {gap.fixed_temperature} '
+                                f'for a wait of {gap.wait_s:.1f}s instead of {gap.fixed_wait_s:.1f}s')
+    print(f'  {kept} gaps kept the fixed standby temperature')
+    return failures
+
+
+def check_budget(planned_file_path: str, budget_file_path: str) -> list[str]:
+    """
+    The soak time of every tool stays within its budget, and the budget is small enough to
+    matter.
+
+    :return: the failures
+    """
+    failures: list[str] = []
+    unbounded_soak_s: dict[int, float] = {}
+    for gap in plan_gaps(planned_file_path):
+        unbounded_soak_s[gap.tool] = unbounded_soak_s.get(gap.tool, 0.0) + gap.soak_s
+    if max(unbounded_soak_s.values(), default=0.0) <= MAX_STANDBY_SOAK_TIME_S:
+        failures.append(f'no tool soaks for more than {MAX_STANDBY_SOAK_TIME_S:.0f}s without a budget')
+    soak_s: dict[int, float] = {}
+    for gap in plan_gaps(budget_file_path):
+        soak_s[gap.tool] = soak_s.get(gap.tool, 0.0) + gap.soak_s
+    print('  soak per tool ' + ', '.join(
+        f'T{tool} {unbounded_soak_s.get(tool, 0.0):.0f}s -> {soak:.0f}s' for tool, soak in sorted(soak_s.items())
+    ))
+    for tool, soak in sorted(soak_s.items()):
+        if soak > MAX_STANDBY_SOAK_TIME_S:
+            failures.append(f'T{tool} soaks for {soak:.0f}s, over its budget of {MAX_STANDBY_SOAK_TIME_S:.0f}s')
+    return failures
+
+
+def main(args) -> None:
+    parser = argparse.ArgumentParser(description='Check the standby planner on synthetic gcode')
+    parser.add_argument('--lines', type=int, default=20_000, help='approximate number of lines of the print body')
+    parser.add_argument('--tools', type=int, default=5, help='number of tools')
+    parser.add_argument('--layers', type=int, default=40, help='number of layers')
+    parser.add_argument('--toolchanges-per-layer', type=float, default=3.0, help='average number of toolchanges per layer')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random moves and tool choices')
+    options = parser.parse_args(args[1:])
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the same print, with the planner set up in different ways
+        file_paths: dict[str, str] = {}
+        for name, tool_parameters in (
+                ('fixed', ()),
+                ('low_candidates', (STANDBY_TEMPS,)),
+                ('planned', (STANDBY_TEMPS, MAX_STANDBY_TEMP)),
+                ('budget', (STANDBY_TEMPS, MAX_STANDBY_TEMP, f'MAX_STANDBY_SOAK_TIME={MAX_STANDBY_SOAK_TIME_S:g}')),
+        ):
+            file_paths[name] = os.path.join(work_dir, name + '.gcode')
+            write_gcode(file_paths[name], line_count=options.lines, tool_count=options.tools, layer_count=options.layers,
+                        toolchanges_per_layer=options.toolchanges_per_layer, seed=options.seed,
+                        tool_parameters=tool_parameters)
+        checks: list[tuple[str, Callable[[], list[str]]]] = [
+            ('exercised', lambda: check_exercised(file_paths['fixed'], file_paths['planned'], work_dir)),
+            ('ties', lambda: check_ties([file_paths['low_candidates'], file_paths['planned']])),
+            ('budget', lambda: check_budget(file_paths['planned'], file_paths['budget'])),
+        ]
+        failed: int = 0
+        for name, check in checks:
+            print(name)
+            failures: list[str] = check()
+            for failure in failures:
+                print(f'  FAILED: {failure}')
+            failed += bool(failures)
+            print('  ok' if not failures else '  failed')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+"""
+Generates synthetic multi tool gcode shaped like SuperSlicer output, for benchmarking the
+post processor on files of any size.
+"""
+import argparse
+import random
+import sys
+from typing import Iterator
+
+
+# print parameters of the generated tools, indexed by tool modulo the length
+TOOL_FIRST_LAYER_TEMPERATURES: tuple[int, ...] = (273, 293, 253, 240, 260, 230, 250, 280)
+TOOL_TEMPERATURES: tuple[int, ...] = (263, 283, 243, 235, 255, 225, 245, 270)
+TOOL_WARMUP_TIMES: tuple[int, ...] = (90, 60, 60, 45, 75, 60, 90, 30)
+TOOL_DORMANT_TIMES: tuple[int, ...] = (120, 90, 90, 60, 120, 90, 150, 60)
+BED_TEMPERATURE: int = 98
+FIRST_LAYER_BED_TEMPERATURE: int = 99
+CHAMBER_TEMPERATURE: int = 49
+STANDBY_TEMPERATURE_DELTA: int = -13
+TIME_START_GCODE: int = 20
+TIME_TOOLCHANGE: int = 30
+
+# layer geometry
+FIRST_LAYER_HEIGHT: float = 0.25
+LAYER_HEIGHT: float = 0.2
+# the moves stay inside this square of the bed
+BED_MIN: float = 120.0
+BED_MAX: float = 220.0
+# estimated time per body line, used for the print stats and the progress markers
+SECONDS_PER_LINE: float = 0.06
+# lines between M73 progress markers
+LINES_PER_PROGRESS_MARKER: int = 100
+# feature types cycled through within a layer
+FEATURE_TYPES: tuple[str, ...] = ('External perimeter', 'Perimeter', 'Internal infill', 'Solid infill', 'Top solid infill')
+
+
+class GcodeGenerator:
+    """
+    Generator of synthetic SuperSlicer gcode.
+    """
+
+    line_count: int
+    tool_count: int
+    layer_count: int
+    toolchanges_per_layer: float
+    config_line_count: int
+    # extra lines of the start filament gcode of every tool, such as `STANDBY_TEMPS=150,180`
+    tool_parameters: tuple[str, ...]
+
+    _random: random.Random
+    _current_tool: int
+    _toolchanges_written: int
+    _lines_written: int
+    _progress_lines: int
+    _x: float
+    _y: float
+
+    def __init__(self, line_count: int = 100_000, tool_count: int = 4, layer_count: int = 100,
+                 toolchanges_per_layer: float = 2.0, config_line_count: int = 500, seed: int = 0,
+                 tool_parameters: tuple[str, ...] = ()) -> None:
+        """
+        Initialize the GcodeGenerator class.
+
+        :param line_count: approximate number of lines of the print body
+        :param tool_count: number of tools configured, all of them are used
+        :param layer_count: number of layers
+        :param toolchanges_per_layer: average number of toolchanges per layer, fractions spread them over layers
+        :param config_line_count: approximate number of lines of the SuperSlicer config block
+        :param seed: seed of the random moves and tool choices
+        :param tool_parameters: extra `NAME=VALUE` lines of the start filament gcode of every tool
+        """
+        self.line_count = max(line_count, layer_count)
+        self.tool_count = max(tool_count, 1)
+        self.layer_count = max(layer_count, 2)
+        self.toolchanges_per_layer = toolchanges_per_layer if self.tool_count > 1 else 0.0
+        self.config_line_count = config_line_count
+        self.tool_parameters = tuple(tool_parameters)
+        self._random = random.Random(seed)
+        self._current_tool = 0
+        self._toolchanges_written = 0
+        self._lines_written = 0
+        self._progress_lines = 0
+        self._x = (BED_MIN + BED_MAX) / 2
+        self._y = (BED_MIN + BED_MAX) / 2
+
+    def generate(self) -> Iterator[str]:
+        """
+        Generate the gcode line by line.
+
+        :return: iterator of lines, including their line endings
+        """
+        yield from self._header()
+        yield from self._start()
+        toolchange_credit: float = 0.0
+        body_lines_per_layer: int = self.line_count // self.layer_count
+        for layer in range(self.layer_count):
+            yield from self._layer_change(layer)
+            # spread the toolchanges of the layer evenly over its moves
+            toolchange_credit += self.toolchanges_per_layer
+            toolchanges: int = int(toolchange_credit)
+            toolchange_credit -= toolchanges
+            segment_lines: int = body_lines_per_layer // (toolchanges + 1)
+            for segment in range(toolchanges + 1):
+                if segment > 0:
+                    yield from self._toolchange(self._pick_next_tool())
+                yield from self._moves(segment_lines)
+        yield from self._end()
+        yield from self._print_stats()
+        yield from self._config()
+
+    def _tool_value(self, values: tuple[int, ...], tool: int) -> int:
+        """
+        :param values: per tool values to pick from
+        :param tool: the tool
+        :return: the value of the tool
+        """
+        return values[tool % len(values)]
+
+    def _pick_next_tool(self) -> int:
+        """
+        Pick a tool other than the current one.
+        """
+        tool: int = self._random.randrange(self.tool_count - 1)
+        return tool + 1 if tool >= self._current_tool else tool
+
+    def _counted(self, line: str) -> str:
+        """
+        Count a body line towards the progress markers.
+
+        :param line: the line
+        :return: the line
+        """
+        self._lines_written += 1
+        return line
+
+    def _header(self) -> Iterator[str]:
+        """
+        Generate the comments at the top of the file.
+        """
+        yield '; generated by SuperSlicer 2.5.59.13 on 2025-08-07 at 14:30:07 UTC\n'
+        yield '\n'
+        yield ';\n'
+        yield '; thumbnail begin 16x16 64\n'
+        yield '; iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAAC0lEQVR4nGNgGAUAAAMQAAE=\n'
+        yield '; thumbnail end\n'
+        yield ';\n'
+        yield '\n'
+        yield '; external perimeters extrusion width = 0.50mm\n'
+        yield '; perimeters extrusion width = 0.50mm\n'
+        yield '; infill extrusion width = 0.50mm\n'
+        yield '\n'
+
+    def _start(self) -> Iterator[str]:
+        """
+        Generate the start gcode, the initial toolchange and the initial temperature block.
+        """
+        first_tool: int = 0
+        yield f'M73 P0 R{self._remaining_minutes()}\n'
+        yield 'M107\n'
+        yield ';TYPE:Custom\n'
+        yield '; custom gcode: start_gcode\n'
+        yield (f'PRINT_START  TOOL_TEMP={self._tool_value(TOOL_FIRST_LAYER_TEMPERATURES, first_tool)} '
+               f'BED_TEMP={FIRST_LAYER_BED_TEMPERATURE} TOOL={first_tool} CHAMBER={CHAMBER_TEMPERATURE}\n')
+        yield '; custom gcode end: start_gcode\n'
+        yield '\n'
+        yield 'G21 ; set units to millimeters\n'
+        yield 'G90 ; use absolute coordinates\n'
+        yield 'M83 ; use relative distances for extrusion\n'
+        yield from self._toolchange_blocks(first_tool)
+        first_temperature: int = self._tool_value(TOOL_FIRST_LAYER_TEMPERATURES, first_tool)
+        yield f'M109 S{first_temperature} T{first_tool} ; set temperature and wait for it to be reached\n'
+        for tool in range(self.tool_count):
+            standby: int = self._tool_value(TOOL_FIRST_LAYER_TEMPERATURES, tool) + STANDBY_TEMPERATURE_DELTA
+            yield f'M104 S{standby} T{tool} ; set temperature\n'
+        yield f'M109 S{first_temperature} T{first_tool} ; set temperature and wait for it to be reached\n'
+        yield f'M190 S{FIRST_LAYER_BED_TEMPERATURE} ; set bed temperature and wait for it to be reached\n'
+
+    def _toolchange_blocks(self, next_tool: int) -> Iterator[str]:
+        """
+        Generate the toolchange gcode and start filament gcode blocks of a tool selection.
+
+        :param next_tool: the tool being selected
+        """
+        yield '; custom gcode: toolchange_gcode\n'
+        yield f'CURRENT_TOOL={self._current_tool}\n'
+        yield f'NEXT_TOOL={next_tool}\n'
+        yield '; custom gcode end: toolchange_gcode\n'
+        yield '; custom gcode: start_filament_gcode\n'
+        yield f'EXTRUDER={next_tool}\n'
+        yield f'WARMUP_TIME={self._tool_value(TOOL_WARMUP_TIMES, next_tool)}\n'
+        yield f'DORMANT_TIME={self._tool_value(TOOL_DORMANT_TIMES, next_tool)}\n'
+        for parameter in self.tool_parameters:
+            yield f'{parameter}\n'
+        yield '; custom gcode end: start_filament_gcode\n'
+        self._current_tool = next_tool
+
+    def _toolchange(self, next_tool: int) -> Iterator[str]:
+        """
+        Generate a toolchange in the print body the way SuperSlicer writes it, with the
+        temperature drop of the outgoing tool before it.
+
+        :param next_tool: the tool being selected
+        """
+        self._toolchanges_written += 1
+        yield self._counted('G1 E-10.000000 F1800\n')
+        standby: int = self._tool_value(TOOL_TEMPERATURES, self._current_tool) + STANDBY_TEMPERATURE_DELTA
+        yield f'M104 S{standby} T{self._current_tool} ; set temperature\n'
+        yield from self._toolchange_blocks(next_tool)
+        yield f'M109 S{self._tool_value(TOOL_TEMPERATURES, next_tool)} T{next_tool} ; set temperature and wait for it to be reached\n'
+        yield self._counted('G1 E-0.5 F1800\n')
+
+    def _layer_change(self, layer: int) -> Iterator[str]:
+        """
+        Generate the layer change comments and gcode, and the second layer temperatures.
+
+        :param layer: index of the layer
+        """
+        z: float = FIRST_LAYER_HEIGHT + layer * LAYER_HEIGHT
+        yield ';LAYER_CHANGE\n'
+        yield f';Z:{z:.2f}\n'
+        yield f';HEIGHT:{FIRST_LAYER_HEIGHT if layer == 0 else LAYER_HEIGHT}\n'
+        yield self._counted(f'G1 Z{z:.2f} F27000\n')
+        yield '; custom gcode: layer_gcode\n'
+        yield 'VERIFY_TOOL_DETECTED ASYNC=1 \n'
+        yield '; custom gcode end: layer_gcode\n'
+        yield '\n'
+        yield 'G92 E0\n'
+        if layer == 1:
+            for tool in range(self.tool_count):
+                yield f'M104 S{self._tool_value(TOOL_TEMPERATURES, tool)} T{tool} ; set temperature\n'
+            yield f'M140 S{BED_TEMPERATURE} ; set bed temperature\n'
+
+    def _moves(self, count: int) -> Iterator[str]:
+        """
+        Generate extrusion and travel moves with the occasional comment, acceleration
+        change and progress marker in between.
+
+        :param count: number of lines to generate
+        """
+        for index in range(count):
+            if self._lines_written - self._progress_lines >= LINES_PER_PROGRESS_MARKER:
+                self._progress_lines = self._lines_written
+                percentage: int = min(self._lines_written * 100 // self.line_count, 99)
+                yield f'M73 P{percentage} R{self._remaining_minutes()}\n'
+            roll: float = self._random.random()
+            if index % 200 == 0:
+                yield f';TYPE:{FEATURE_TYPES[index // 200 % len(FEATURE_TYPES)]}\n'
+                yield self._counted(f'M204 S{self._random.choice((2000, 4000, 10000))}\n')
+            elif roll < 0.1:
+                # travel
+                self._x = self._random.uniform(BED_MIN, BED_MAX)
+                self._y = self._random.uniform(BED_MIN, BED_MAX)
+                yield self._counted(f'G1 X{self._x:.3f} Y{self._y:.3f} F27000\n')
+            elif roll < 0.15:
+                yield self._counted(f'G1 F{self._random.choice((1800, 3600, 5400))}\n')
+            else:
+                # a short extrusion
+                self._x = min(max(self._x + self._random.uniform(-5.0, 5.0), BED_MIN), BED_MAX)
+                self._y = min(max(self._y + self._random.uniform(-5.0, 5.0), BED_MIN), BED_MAX)
+                yield self._counted(f'G1 X{self._x:.3f} Y{self._y:.3f} E{self._random.uniform(0.01, 0.3):.5f}\n')
+
+    def _remaining_minutes(self) -> int:
+        """
+        :return: estimated minutes of printing left at the current line
+        """
+        return int((self.line_count - self._lines_written) * SECONDS_PER_LINE / 60)
+
+    def _end(self) -> Iterator[str]:
+        """
+        Generate the end of the print.
+        """
+        yield 'G1 E-0.5 F1800\n'
+        yield 'M107\n'
+        yield ';TYPE:Custom\n'
+        yield '; custom gcode: end_gcode\n'
+        yield 'PRINT_END\n'
+        yield '; custom gcode end: end_gcode\n'
+        yield 'M73 P100 R0\n'
+
+    def _print_stats(self) -> Iterator[str]:
+        """
+        Generate the print stats block.
+        """
+        used: str = ', '.join('10.00' for _ in range(self.tool_count))
+        # SuperSlicer includes its time constants for the start gcode and the toolchanges
+        seconds: int = int(self.line_count * SECONDS_PER_LINE) + TIME_START_GCODE + \
+            self._toolchanges_written * TIME_TOOLCHANGE
+        yield f'; filament used [mm] = {used}\n'
+        yield f'; filament used [g] = {used}\n'
+        yield f'; total filament used [g] = {10 * self.tool_count:.2f}\n'
+        yield f'; total layers count = {self.layer_count}\n'
+        yield (f'; estimated printing time (normal mode) = '
+               f'{seconds // 3600}h {seconds // 60 % 60}m {seconds % 60}s\n')
+        yield '\n'
+
+    def _config(self) -> Iterator[str]:
+        """
+        Generate the SuperSlicer config block with the keys the post processor reads, padded
+        out with filler settings to the requested size.
+        """
+        def per_tool(values: tuple[int, ...] | int) -> str:
+            if isinstance(values, int):
+                return ','.join(str(values) for _ in range(self.tool_count))
+            return ','.join(str(self._tool_value(values, tool)) for tool in range(self.tool_count))
+
+        start_filament_gcode: str = ';'.join(
+            f'"EXTRUDER={{current_extruder}}\\nWARMUP_TIME={self._tool_value(TOOL_WARMUP_TIMES, tool)}'
+            f'\\nDORMANT_TIME={self._tool_value(TOOL_DORMANT_TIMES, tool)}'
+            + ''.join(f'\\n{parameter}' for parameter in self.tool_parameters) + '"'
+            for tool in range(self.tool_count)
+        )
+        settings: dict[str, str] = {
+            'bed_temperature': per_tool(BED_TEMPERATURE),
+            'chamber_temperature': per_tool(CHAMBER_TEMPERATURE),
+            'first_layer_bed_temperature': per_tool(FIRST_LAYER_BED_TEMPERATURE),
+            'first_layer_temperature': per_tool(TOOL_FIRST_LAYER_TEMPERATURES),
+            'machine_max_acceleration_e': '10000,5000',
+            'machine_max_acceleration_extruding': '10000,1250',
+            'machine_max_acceleration_retracting': '1500,1250',
+            'machine_max_acceleration_travel': '10000,1250',
+            'machine_max_acceleration_x': '10000,1000',
+            'machine_max_acceleration_y': '10000,1000',
+            'machine_max_acceleration_z': '350,200',
+            'machine_max_feedrate_e': '120,120',
+            'machine_max_feedrate_x': '450,200',
+            'machine_max_feedrate_y': '450,200',
+            'machine_max_feedrate_z': '30,12',
+            'machine_max_jerk_x': '5,10',
+            'standby_temperature_delta': str(STANDBY_TEMPERATURE_DELTA),
+            'start_filament_gcode': start_filament_gcode,
+            'temperature': per_tool(TOOL_TEMPERATURES),
+            'time_start_gcode': str(TIME_START_GCODE),
+            'time_toolchange': str(TIME_TOOLCHANGE),
+            'use_relative_e_distances': '1',
+        }
+        for index in range(max(self.config_line_count - len(settings) - 2, 0)):
+            settings[f'synthetic_setting_{index:05d}'] = str(index)
+        yield '; SuperSlicer_config = begin\n'
+        for key in sorted(settings):
+            yield f'; {key} = {settings[key]}\n'
+        yield '; SuperSlicer_config = end\n'
+
+
+def write_gcode(file_path: str, **parameters) -> int:
+    """
+    Write a synthetic gcode file.
+
+    :param file_path: path of the file to write
+    :param parameters: parameters of the GcodeGenerator
+    :return: number of lines written
+    """
+    lines: int = 0
+    with open(file_path, 'w', encoding='UTF-8') as writefile:
+        for line in GcodeGenerator(**parameters).generate():
+            writefile.write(line)
+            lines += 1
+    return lines
+
+
+def main(args) -> None:
+    parser = argparse.ArgumentParser(description='Generate synthetic SuperSlicer shaped multi tool gcode')
+    parser.add_argument('output_file_path', help='path of the gcode file to write')
+    parser.add_argument('--lines', type=int, default=100_000, help='approximate number of lines of the print body')
+    parser.add_argument('--tools', type=int, default=4, help='number of tools')
+    parser.add_argument('--layers', type=int, default=100, help='number of layers')
+    parser.add_argument('--toolchanges-per-layer', type=float, default=2.0,
+                        help='average number of toolchanges per layer, e.g. 0.5 for one every other layer')
+    parser.add_argument('--config-lines', type=int, default=500, help='approximate size of the config block in lines')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random moves and tool choices')
+    parser.add_argument('--tool-parameter', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra line of the start filament gcode of every tool, e.g. STANDBY_TEMPS=150,180,200')
+    options = parser.parse_args(args[1:])
+    lines: int = write_gcode(options.output_file_path, line_count=options.lines, tool_count=options.tools,
+                             layer_count=options.layers, toolchanges_per_layer=options.toolchanges_per_layer,
+                             config_line_count=options.config_lines, seed=options.seed,
+                             tool_parameters=tuple(options.tool_parameter))
+    print(f'Wrote {lines} lines to {options.output_file_path}')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
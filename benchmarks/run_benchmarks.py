@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Times and memory profiles each stage of the post processor across a sweep of synthetic
+gcode sizes and saves the results as JSON.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime, timezone
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_gcode import write_gcode  # noqa: E402
+from process import StageProfiler, TimeModel, ToolchangerPostprocessor  # noqa: E402
+
+
+DEFAULT_SIZES: tuple[int, ...] = (10_000, 50_000, 200_000, 1_000_000)
+# a stage whose time grows faster than this power of the size is reported as superlinear
+SUPERLINEAR_EXPONENT: float = 1.3
+# stages faster than this are too noisy to judge their scaling
+MIN_SCALING_TIME_S: float = 0.01
+
+
+def run_profiled(input_file_path: str, output_file_path: str, time_model: TimeModel,
+                 trace_memory: bool) -> dict[str, dict[str, float | int]]:
+    """
+    Process a file with each stage profiled.
+
+    :param input_file_path: path to the gcode file
+    :param output_file_path: path to write the output to
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param trace_memory: trace the python allocations of each stage, which slows the stages down a lot
+    :return: the measurements of each stage
+    """
+    processor = ToolchangerPostprocessor(input_file_path, time_model=time_model, output_file_path=output_file_path)
+    profiler = StageProfiler(trace_memory=trace_memory)
+    profiler.instrument(processor)
+    processor.process_gcode()
+    return profiler.report(processor)['stages']
+
+
+def fit_exponents(runs: list[dict[str, Any]]) -> dict[str, float]:
+    """
+    Fit how the time of each stage grows with the size of the input, as the slope of
+    log time over log lines between the smallest and largest runs it took measurable time in.
+
+    :param runs: the runs of a sweep, in increasing size
+    :return: exponent of each stage, 1.0 is linear and 2.0 quadratic
+    """
+    exponents: dict[str, float] = {}
+    for name in runs[-1]['stages']:
+        points: list[tuple[int, float]] = [
+            (run['lines'], run['stages'][name]['wall_s']) for run in runs
+            if name in run['stages'] and run['stages'][name]['wall_s'] >= MIN_SCALING_TIME_S
+        ]
+        if len(points) >= 2 and points[-1][0] > points[0][0]:
+            exponents[name] = math.log(points[-1][1] / points[0][1]) / math.log(points[-1][0] / points[0][0])
+    return exponents
+
+
+def run_sweep(sizes: list[int], tool_count: int, toolchanges_per_layer: float, lines_per_layer: int,
+              time_model: TimeModel, repeat: int, trace_memory: bool) -> dict[str, Any]:
+    """
+    Generate a file of each size and benchmark the post processor on it.
+
+    :param sizes: line counts of the generated files
+    :param tool_count: number of tools in the generated files
+    :param toolchanges_per_layer: average number of toolchanges per layer
+    :param lines_per_layer: lines per layer, the layer count grows with the size
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param repeat: timed runs per size, the fastest of each stage is kept
+    :param trace_memory: whether to also record the memory of each stage
+    :return: the results
+    """
+    runs: list[dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_file_path: str = os.path.join(temp_dir, 'input.gcode')
+        output_file_path: str = os.path.join(temp_dir, 'output.gcode')
+        for size in sorted(sizes):
+            line_count: int = write_gcode(input_file_path, line_count=size, tool_count=tool_count,
+                                          layer_count=max(size // lines_per_layer, 2),
+                                          toolchanges_per_layer=toolchanges_per_layer)
+            stages: dict[str, dict[str, float]] = {}
+            for _ in range(repeat):
+                for name, timing in run_profiled(input_file_path, output_file_path, time_model, False).items():
+                    if name not in stages or timing['wall_s'] < stages[name]['wall_s']:
+                        stages[name] = timing
+            if trace_memory:
+                # tracing slows the stages down, so the memory comes from a separate run
+                for name, traced in run_profiled(input_file_path, output_file_path, time_model, True).items():
+                    stages[name]['traced_peak_bytes'] = traced['traced_peak_bytes']
+                    stages[name]['traced_retained_bytes'] = traced['traced_retained_bytes']
+            run: dict[str, Any] = {
+                'lines': line_count,
+                'bytes': os.path.getsize(input_file_path),
+                'total_wall_s': sum(stage['wall_s'] for stage in stages.values()),
+                'total_cpu_s': sum(stage['cpu_s'] for stage in stages.values()),
+                'stages': stages,
+            }
+            runs.append(run)
+            print(f'{line_count} lines: {run["total_wall_s"]:.3f}s', flush=True)
+    exponents: dict[str, float] = fit_exponents(runs)
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'tools': tool_count,
+            'toolchanges_per_layer': toolchanges_per_layer,
+            'lines_per_layer': lines_per_layer,
+            'time_model': time_model.value,
+            'repeat': repeat,
+        },
+        'runs': runs,
+        'scaling_exponents': exponents,
+        'superlinear_stages': sorted(name for name, exponent in exponents.items() if exponent > SUPERLINEAR_EXPONENT),
+    }
+
+
+def main(args) -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the post processor on synthetic gcode')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='line counts of the generated files')
+    parser.add_argument('--tools', type=int, default=4, help='number of tools')
+    parser.add_argument('--toolchanges-per-layer', type=float, default=2.0, help='average number of toolchanges per layer')
+    parser.add_argument('--lines-per-layer', type=int, default=1000, help='lines per layer')
+    parser.add_argument('--time-model', choices=[model.value for model in TimeModel], default=TimeModel.LINE_COUNT.value,
+                        help='how the durations of the gcode blocks are estimated')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per size, the fastest is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the memory profiling run')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='path of the JSON results')
+    options = parser.parse_args(args[1:])
+    results: dict[str, Any] = run_sweep(options.sizes, options.tools, options.toolchanges_per_layer, options.lines_per_layer,
+                                        TimeModel(options.time_model), max(options.repeat, 1), not options.no_memory)
+    with open(options.output, 'w', encoding='UTF-8') as writefile:
+        json.dump(results, writefile, indent=2)
+    for name in results['superlinear_stages']:
+        print(f'{name} scales as lines^{results["scaling_exponents"][name]:.2f}')
+    print(f'Results written to {options.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
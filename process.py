@@ -1,7 +1,34 @@
 #!/usr/bin/python
+import argparse
+import asyncio
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import resource
+import shutil
+import signal
+import socket
 import sys
-from shutil import ReadError
-from typing import Any
+import tempfile
+import time
+import tracemalloc
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum, IntFlag, auto
+from io import StringIO
+from math import exp, inf, log, sqrt
+from mmap import ACCESS_READ, PAGESIZE, mmap
+try:
+    from mmap import MADV_DONTNEED
+except ImportError:
+    MADV_DONTNEED = -1
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, TextIO
 
 
 CFG_DEFAULT_TIME_BEFORE_PREHEAT_S: int = 30
@@ -9,69 +36,356 @@ CFG_DEFAULT_TIME_BEFORE_PREHEAT_FROM_OFF_S: int = 90
 CFG_DEFAULT_OFF_TIME_TO_GO_DORMANT_S: int = 120
 CFG_DEFAULT_CLEAN_ON_FIRST_USE: bool = True
 CFG_DEFAULT_CLEAN_ON_EVERY_TOOLCHANGE: bool = False
+# heater model used for the preheat lead times of tools that set any of its parameters, the
+# defaults heat a tool from ambient to 260C in about 90s and from 13C below it in about 10s
+CFG_DEFAULT_HEATER_MAX_TEMPERATURE: float = 350.0
+CFG_DEFAULT_HEATER_TIME_CONSTANT_S: float = 70.0
+CFG_DEFAULT_COOLING_TIME_CONSTANT_S: float = 150.0
+CFG_DEFAULT_AMBIENT_TEMPERATURE: float = 25.0
+# machine limits used for the kinematic time model when the slicer config does not have them
+CFG_DEFAULT_MAX_ACCELERATION: float = 3000.0
+CFG_DEFAULT_MAX_FEEDRATE: tuple[float, float, float, float] = (300.0, 300.0, 20.0, 120.0)
+CFG_DEFAULT_MAX_JERK: float = 8.0
+CFG_DEFAULT_FEEDRATE: float = 50.0
+
+GCODE_ENCODING: str = 'UTF-8'
+
+TEMPERATURE_COMMANDS: tuple[bytes, ...] = (b'M104', b'M109', b'M140', b'M190')
+
+# a run of consecutive G1 lines, blank lines in between do not end the run
+G1_RUN_PATTERN: re.Pattern = re.compile(rb'(?:G1[^\n]*(?:\n|$)(?:[^\S\n]*\n)*)+')
+# the next line that starts a section of its own kind, see _tokenize_raw_lines
+SECTION_START_PATTERN: re.Pattern = re.compile(
+    rb'\n(?:G1|; custom gcode: (?:start_gcode|toolchange_gcode|layer_gcode)|;LAYER_CHANGE|M104|M109|M140|M190)'
+)
+
+# a word of a gcode command, letter and number
+MOVE_PARAMETER_PATTERN: re.Pattern = re.compile(rb'([A-Z])(-?\d*\.?\d+)')
+# a G1 move with its parameters in the order the slicer writes them, so that a whole gcode
+# block parses in a single call; moves written any other way are caught by G1_MOVE_LINE_PATTERN
+G1_MOVE_PATTERN: re.Pattern = re.compile(
+    rb'^G1(?: X(-?\d*\.?\d+))?(?: Y(-?\d*\.?\d+))?(?: Z(-?\d*\.?\d+))?(?: E(-?\d*\.?\d+))?(?: F(-?\d*\.?\d+))?[ \t\r]*(?:;[^\n]*)?$',
+    re.MULTILINE
+)
+G1_MOVE_LINE_PATTERN: re.Pattern = re.compile(rb'^G1(?![0-9])', re.MULTILINE)
+# an M73 progress marker with its percentage and remaining minutes
+PROGRESS_MARKER_PATTERN: re.Pattern = re.compile(rb'M73(?: P(\d+))?(?: R(\d+))?')
+PROGRESS_MARKER_LINE_PATTERN: re.Pattern = re.compile(rb'^' + PROGRESS_MARKER_PATTERN.pattern, re.MULTILINE)
+
+# commands outside of the gcode blocks that change the state of the kinematic time model
+KINEMATIC_STATE_COMMANDS: tuple[bytes, ...] = (b'M204', b'G92', b'M82', b'M83', b'G0 ', b'G0\n')
+
+# the first line of the SuperSlicer config block at the end of the file
+SS_CONFIG_BEGIN: str = '; SuperSlicer_config = begin'
+# bytes read per step when seeking backwards from the end of the file for the config block
+TAIL_CHUNK_SIZE: int = 64 * 1024
+# block size used when hashing or copying whole files
+FILE_CHUNK_SIZE: int = 1024 * 1024
+# bytes of the print body processed at a time in streaming mode, a window ends at the next layer change
+STREAM_WINDOW_SIZE: int = 1024 * 1024
+# permissions of a newly created file, the umask can only be read by setting it
+_UMASK: int = os.umask(0o022)
+os.umask(_UMASK)
+NEW_FILE_MODE: int = 0o666 & ~_UMASK
+
+# temperature commands and tool selections written by this script, replayed by the timeline report
+TEMPERATURE_LINE_PATTERN: re.Pattern = re.compile(r'^(M104|M109) S(\d+) T(\d+)')
+TOOL_SELECT_LINE_PATTERN: re.Pattern = re.compile(r'^T(\d+)\b')
+
+# resolution of the standby soak time budget in the standby planner
+STANDBY_SOAK_STEP_S: float = 5.0
+# most soak steps a budget is divided into, larger budgets get coarser steps
+MAX_STANDBY_SOAK_STEPS: int = 1000
+
+# bisection steps used to find the latest point a preheat can start and still be on time
+PREHEAT_SEARCH_STEPS: int = 40
+
+# suffix of the stage profile report written next to the output with --profile
+PROFILE_SUFFIX: str = '.profile.json'
+
+# enough of the start of a line to classify it by any of the prefixes the tokenizer looks for
+LINE_HEAD_LENGTH: int = 64
+
+
+def split_buffer_lines(buffer: bytes | mmap, start: int, end: int) -> list[str]:
+    """
+    Split a span of the gcode buffer into decoded lines, keeping the line endings.
+
+    :param buffer: the gcode buffer
+    :param start: offset of the first byte of the span
+    :param end: offset one past the last byte of the span
+    :return: list of lines in the span
+    """
+    lines: list[str] = []
+    while start < end:
+        newline: int = buffer.find(b'\n', start, end)
+        stop: int = end if newline == -1 else newline + 1
+        lines.append(buffer[start:stop].decode(GCODE_ENCODING))
+        start = stop
+    return lines
+
+
+def buffer_startswith(buffer: bytes | mmap, prefix: bytes, start: int) -> bool:
+    """
+    Check for a prefix at an offset of the gcode buffer, mmap has no startswith of its own.
+
+    :param buffer: the gcode buffer
+    :param prefix: the prefix to check for
+    :param start: offset to check at
+    """
+    return buffer[start:start + len(prefix)] == prefix
+
+
+def detect_line_ending(buffer: bytes | mmap) -> str:
+    """
+    Detect the line terminator of the gcode buffer from its first line.
+
+    :param buffer: the gcode buffer
+    :return: '\\r\\n' if the first line ends with it, '\\n' otherwise
+    """
+    newline: int = buffer.find(b'\n')
+    return '\r\n' if newline > 0 and buffer[newline - 1:newline] == b'\r' else '\n'
+
+
+def encode_output_text(text: str, line_ending: str) -> bytes:
+    """
+    Encode new or rewritten gcode for the output with the line terminator of the input, so
+    that it does not mix line endings with the spans copied from the input unchanged.
+
+    :param text: the gcode text
+    :param line_ending: the line terminator of the input
+    :return: the encoded text
+    """
+    if line_ending != '\n':
+        text = text.replace('\r\n', '\n').replace('\n', line_ending)
+    return text.encode(GCODE_ENCODING)
+
+
+def parse_print_time(print_stats: list[str]) -> int:
+    """
+    Parse the estimated printing time, written as e.g. `1d 2h 3m 4s`, from the print stats.
+
+    :param print_stats: lines of the print stats block
+    :return: the print time in seconds, 0 if there is none
+    """
+    for line in print_stats:
+        if 'estimated printing time' in line:
+            # now get just the time string, everything after the = sign
+            print_time: str = line.split('=')[1].strip()
+            seconds: int = 0
+            for amount, unit in re.findall(r'(\d+)\s*([dhms])', print_time):
+                seconds += int(amount) * {'d': 86400, 'h': 3600, 'm': 60, 's': 1}[unit]
+            return seconds
+    return 0
+
+
+def parse_filament_used(print_stats: list[str]) -> list[float]:
+    """
+    Parse the length of filament used by each tool from the print stats.
+
+    :param print_stats: lines of the print stats block
+    :return: millimeters of filament per tool, empty if there is no such line
+    """
+    for line in print_stats:
+        if line.startswith('; filament used [mm] ='):
+            return [float(amount) for amount in line.split('=')[1].split(',')]
+    return []
+
+
+def parse_layer_count(print_stats: list[str]) -> int:
+    """
+    Parse the layer count from the print stats.
+
+    :param print_stats: lines of the print stats block
+    :return: the layer count, 0 if there is none
+    """
+    for line in print_stats:
+        if line.startswith('; layer count:'):
+            return int(line.split(':')[1].strip())
+    return 0
+
+
+class SectionKind(Enum):
+    """
+    Kinds of sections emitted by the raw line tokenizer.
+    """
+    START_GCODE = auto()
+    GCODE_BLOCK = auto()
+    TOOLCHANGE_GCODE = auto()
+    LAYER_CHANGE_COMMENTS = auto()
+    LAYER_CHANGE_GCODE = auto()
+    TEMPERATURE_BLOCK = auto()
+    OTHER = auto()
+
+
+class SectionFlag(IntFlag):
+    """
+    Bitfield holding the kind of a gcode section along with its planning state.
+    """
+    NONE = 0
+    # the flags carried by the vast majority of sections use the lowest bits so that
+    # their combinations stay below 256 and share CPython's cached small int objects
+    FIRST_LAYER_TEMPS_USED = auto()
+    OTHER_LAYER_TEMPS_USED = auto()
+    GCODE_BLOCK = auto()
+    LAYER_CHANGE_COMMENTS = auto()
+    LAYER_CHANGE_GCODE = auto()
+    TOOLCHANGE_GCODE = auto()
+    # section kinds that only occur once or twice per print
+    PRE_START_GCODE = auto()
+    START_GCODE = auto()
+    INITIAL_TEMPERATURE_BLOCK = auto()
+    SECOND_LAYER_TEMPERATURE_BLOCK = auto()
+    # for toolchange sections
+    INITIAL_TOOLCHANGE = auto()
+    LAST_DESELECT = auto()
+    HEAT_FROM_OFF = auto()
+
+
+# the flags that give a section a kind, sections without any are runs of plain lines
+SECTION_KIND_FLAGS: int = (
+    SectionFlag.GCODE_BLOCK | SectionFlag.LAYER_CHANGE_COMMENTS | SectionFlag.LAYER_CHANGE_GCODE |
+    SectionFlag.TOOLCHANGE_GCODE | SectionFlag.PRE_START_GCODE | SectionFlag.START_GCODE |
+    SectionFlag.INITIAL_TEMPERATURE_BLOCK | SectionFlag.SECOND_LAYER_TEMPERATURE_BLOCK
+).value
+
+
+class _SectionFlagAttribute:
+    """
+    Exposes a single bit of `GcodeSection.flags` as a boolean attribute.
+    """
+    __slots__ = ('_mask',)
+
+    def __init__(self, flag: SectionFlag) -> None:
+        self._mask = int(flag)
+
+    def __get__(self, section: Any, owner: Any = None) -> Any:
+        if section is None:
+            return self
+        return section.flags & self._mask != 0
+
+    def __set__(self, section: Any, value: bool) -> None:
+        if value:
+            section.flags |= self._mask
+        else:
+            section.flags &= ~self._mask
+
 
 class GcodeSection:
-    _lines: list[str]
+    __slots__ = (
+        '_lines',
+        '_buffer',
+        '_start',
+        '_end',
+        'tool',
+        'prev_section',
+        'next_section',
+        'flags',
+        'score',
+        'outgoing_tool',
+        'incoming_tool',
+    )
+
+    # either the section owns its lines, or it references a span of the shared buffer
+    _lines: list[str] | None
+    _buffer: bytes | mmap
+    _start: int
+    _end: int
     tool: int
 
     prev_section: Any
     next_section: Any
 
-    pre_start_gcode: bool
-    start_gcode: bool
-    initial_temperature_block: bool
-    gcode_block: bool
-    toolchange_gcode: bool
-    initial_toolchange: bool
-    layer_change_comments: bool
-    layer_change_gcode: bool
-    second_layer_temperature_block: bool
+    # kind and state of the section, see SectionFlag
+    flags: int
+
+    pre_start_gcode = _SectionFlagAttribute(SectionFlag.PRE_START_GCODE)
+    start_gcode = _SectionFlagAttribute(SectionFlag.START_GCODE)
+    initial_temperature_block = _SectionFlagAttribute(SectionFlag.INITIAL_TEMPERATURE_BLOCK)
+    gcode_block = _SectionFlagAttribute(SectionFlag.GCODE_BLOCK)
+    toolchange_gcode = _SectionFlagAttribute(SectionFlag.TOOLCHANGE_GCODE)
+    initial_toolchange = _SectionFlagAttribute(SectionFlag.INITIAL_TOOLCHANGE)
+    layer_change_comments = _SectionFlagAttribute(SectionFlag.LAYER_CHANGE_COMMENTS)
+    layer_change_gcode = _SectionFlagAttribute(SectionFlag.LAYER_CHANGE_GCODE)
+    second_layer_temperature_block = _SectionFlagAttribute(SectionFlag.SECOND_LAYER_TEMPERATURE_BLOCK)
 
-    first_layer_temps_used: bool
-    other_layer_temps_used: bool
+    first_layer_temps_used = _SectionFlagAttribute(SectionFlag.FIRST_LAYER_TEMPS_USED)
+    other_layer_temps_used = _SectionFlagAttribute(SectionFlag.OTHER_LAYER_TEMPS_USED)
 
     score: float
 
     # for toolchange sections
     outgoing_tool: int
     incoming_tool: int
-    last_deselect: bool
-    heat_from_off: bool
+    last_deselect = _SectionFlagAttribute(SectionFlag.LAST_DESELECT)
+    heat_from_off = _SectionFlagAttribute(SectionFlag.HEAT_FROM_OFF)
 
     def __init__(
         self,
-        first_line: str,
+        first_line: str | None,
         tool: int
     ) -> None:
-        self._lines = [first_line]
+        self._lines = [first_line] if first_line is not None else None
+        self._buffer = b''
+        self._start = 0
+        self._end = 0
         self.tool = tool
-        self.pre_start_gcode = False
-        self.start_gcode = False
-        self.initial_temperature_block = False
-        self.gcode_block = False
-        self.toolchange_gcode = False
-        self.initial_toolchange = False
-        self.layer_change_comments = False
-        self.layer_change_gcode = False
-        self.second_layer_temperature_block = False
+        self.flags = SectionFlag.NONE.value
         self.score = 0.0
         self.prev_section = None
         self.next_section = None
-        self.first_layer_temps_used = False
-        self.other_layer_temps_used = False
         self.outgoing_tool = -1
         self.incoming_tool = -1
-        self.last_deselect = False
-        self.heat_from_off = False
+
+    def reference_lines(self, buffer: bytes | mmap, start: int, end: int) -> None:
+        """
+        Make the section reference a span of the shared buffer rather than own its lines,
+        the lines are only copied out of the buffer once the section is modified.
+
+        :param buffer: the shared gcode buffer
+        :param start: offset of the first byte of the section
+        :param end: offset one past the last byte of the section
+        """
+        self._lines = None
+        self._buffer = buffer
+        self._start = start
+        self._end = end
 
     def add_line(self, line: str) -> None:
+        if self._lines is None:
+            self._lines = self.resolve_lines()
         self._lines.append(line)
     
     def resolve_lines(self) -> list[str]:
+        if self._lines is None:
+            return split_buffer_lines(self._buffer, self._start, self._end)
         return self._lines
 
+    def resolve_bytes(self) -> bytes:
+        if self._lines is None:
+            return self._buffer[self._start:self._end]
+        return ''.join(self._lines).encode(GCODE_ENCODING)
+
+    def buffer_span(self) -> tuple[int, int] | None:
+        """
+        :return: the span of the shared buffer the section references, or None if it owns its lines
+        """
+        if self._lines is None:
+            return self._start, self._end
+        return None
+
+    def line_count(self) -> int:
+        if self._lines is None:
+            line_count: int = self._buffer[self._start:self._end].count(b'\n')
+            if self._end > self._start and self._buffer[self._end - 1] != ord('\n'):
+                # the last line of the file has no line ending
+                line_count += 1
+            return line_count
+        return len(self._lines)
+
     def replace_lines(self, lines: list[str]) -> None:
         self._lines = lines
+        self._buffer = b''
 
 
 class ToolConfig:
@@ -90,6 +404,14 @@ class ToolConfig:
     dormant_time_s: int
     clean_nozzle_on_first_use: bool
     clean_nozzle_on_toolchange: bool
+    # model of the heater, when set it decides the preheat lead times instead of the warmup times
+    heater: 'HeaterModel | None'
+    # candidate standby temperatures, when set the standby planner chooses among them for every idle gap
+    standby_temperatures: list[int]
+    # hottest standby temperature allowed, -1 for the print temperature less the standby delta
+    max_standby_temperature: int
+    # total seconds the tool may sit idle with its heater on, inf for no limit
+    max_standby_soak_time_s: float
 
     def __init__(self, index: int) -> None:
         self.tool_number = index
@@ -104,332 +426,1775 @@ class ToolConfig:
         self.warmup_from_off_time_s = 0
         self.clean_nozzle_on_first_use = False
         self.clean_nozzle_on_toolchange = False
+        self.heater = None
+        self.standby_temperatures = []
+        self.max_standby_temperature = -1
+        self.max_standby_soak_time_s = inf
 
 
-class ToolchangerPostprocessor:
-
-
-    _input_file_path: str
-    _raw_lines: list[str]
-    _output_lines: list[str]
-
-    # print stats
-    _layer_count: int
-    _print_time_s: int
-    _time_start_gcode: int
-    _time_toolchange: int
-    _standby_temp_delta: int
-
-    # relevant ss configs
-    _tool_count_overall: int
-
-    # tool configs
-    _tool_configs: list[ToolConfig]
-
-    # special sections
-    _end_print_section: list[str]
-    _print_stats_section: list[str]
-    _ss_configs_section: list[str]
-    _middle_section: list[str]
-
-    # sections
-    _track_current_tool: int
-
-    # linked list of sections
-    _first_section: GcodeSection
+class HeaterModel:
+    """
+    First order model of a tool heater. At full power the temperature approaches the
+    maximum temperature exponentially, with the heater off it decays exponentially towards
+    the ambient temperature, and once the setpoint is reached it is held there.
+    """
 
-    # score tracker
-    _score_tracker: float
-    _has_first_toolchange: bool
+    max_temperature: float
+    heat_time_constant_s: float
+    cool_time_constant_s: float
+    ambient_temperature: float
 
-    def __init__(self, input_file_path: str) -> None:
+    def __init__(
+        self,
+        max_temperature: float = CFG_DEFAULT_HEATER_MAX_TEMPERATURE,
+        heat_time_constant_s: float = CFG_DEFAULT_HEATER_TIME_CONSTANT_S,
+        cool_time_constant_s: float = CFG_DEFAULT_COOLING_TIME_CONSTANT_S,
+        ambient_temperature: float = CFG_DEFAULT_AMBIENT_TEMPERATURE
+    ) -> None:
         """
-        Initialize the ToolchangerPostprocessor class.
+        Initialize the HeaterModel class.
 
-        :param input_file_path: path to the input gcode file
+        :param max_temperature: temperature the heater approaches at full power
+        :param heat_time_constant_s: time constant of heating at full power
+        :param cool_time_constant_s: time constant of cooling with the heater off
+        :param ambient_temperature: temperature the heater cools down to
         """
-        self._input_file_path = input_file_path
-        self._output_lines = []
-        self._raw_lines = self._read_input_file()        
-        self._layer_count = 0
-        self._print_time_s = 0
-        self._time_start_gcode = 0
-        self._time_toolchange = 0
-        self._print_stats_section = []
-        self._ss_configs_section = []
-        self._middle_section = []
-        self._first_section = None  # type: ignore
-        self._score_tracker = 0.0
-        self._has_first_toolchange = False
+        self.max_temperature = max_temperature
+        self.heat_time_constant_s = heat_time_constant_s
+        self.cool_time_constant_s = cool_time_constant_s
+        self.ambient_temperature = ambient_temperature
 
-    def _read_input_file(self) -> list[str]:
+    def heat_time(self, start: float, target: float) -> float:
         """
-        Read the input gcode file.
-
-        :return: list of lines from the input file
+        :param start: temperature to heat from
+        :param target: temperature to reach
+        :return: seconds at full power to reach the target, inf if it is out of reach
         """
-        try:
-            with open(self._input_file_path, "r", encoding='UTF-8') as readfile:
-                return readfile.readlines()
-        except ReadError as exc:
-            print('FileReadError:' + str(exc))
-            sys.exit(1)
+        if start >= target:
+            return 0.0
+        if target >= self.max_temperature:
+            return inf
+        return self.heat_time_constant_s * log((self.max_temperature - start) / (self.max_temperature - target))
 
-    def process_gcode(self) -> None:
+    def cool_time(self, start: float, target: float) -> float:
         """
-        Process the gcode file.
+        :param start: temperature to cool from
+        :param target: temperature to reach
+        :return: seconds with the heater off to reach the target, inf if it is out of reach
         """
-        # only process if there is a tool change in the gcode
-        if not self._has_tool_change_in_gcode():
-            print('No tool change in gcode, exiting now.')
-            sys.exit(0)
-
-        # eliminate unneeded blank lines
-        self._eliminate_blank_lines()
-        # dump comments and images at top of file into output list
-        self._process_comments_and_images_at_start_of_file()
-        # process block before print start
-        self._process_block_before_print_start()
-        # extract slicer configs section
-        self._extract_slicer_configs_section()
-        # parse slicer configs
-        self._parse_slicer_configs()
-        # extract print stats section
-        self._extract_print_stats_section()
-        # parse print stats
-        self._parse_print_stats()
-        # initial score
-        self._score_tracker = float(self._print_time_s - self._time_start_gcode)
-        # extract end print section
-        self._extract_end_gcode_section()
-        # find tools used in print
-        self._find_tools_used_in_print()
-        # eliminate ss pre toolchange tool temp drop
-        self._eliminate_ss_pre_toolchange_tool_temp_drop()
-        # eliminate ss post start filament tool temp set
-        self._eliminate_ss_post_start_filament_tool_temp_set()
-        # process start filament gcode blocks for tool parameters
-        self._process_start_filament_gcode_blocks_for_tool_parameters()
-        # extract basic start info
-        self._extract_basic_start_info()
-        # parse the raw lines into sections
-        self._parse_raw_lines_into_sections()
-        # process the start section
-        self._process_start_section()
-        # process the second layer changes
-        self._process_second_layer_changes()
-        # process the toolchange sections
-        self._process_toolchange_sections()
-        # score the gcode blocks
-        self._score_gcode_blocks()
-        # add the turn off tool logic
-        self._add_turn_off_tool_logic()
-        # add the deselect temperature logic
-        self._add_deselect_temperature_logic()
-        # add the preheat logic
-        self._add_preheat_logic()
-        # reduce the linked list to the middle section
-        self._reduce_linked_list_to_middle_section()
-        # reconstruct the gcode for output
-        self._reconstruct_for_output()
-        # write the output file
-        self._write_output_file()
+        if start <= target:
+            return 0.0
+        if target <= self.ambient_temperature:
+            return inf
+        return self.cool_time_constant_s * log((start - self.ambient_temperature) / (target - self.ambient_temperature))
 
-    def _has_tool_change_in_gcode(self) -> bool:
-        """
-        Checks if the gcode has a tool change.
+    def temperature_after(self, start: float, setpoint: float, duration: float) -> float:
         """
-        for line in self._raw_lines:
-            if line.startswith('; custom gcode: toolchange_gcode'):
-                return True
-        return False
+        Simulate the heater for a while at a fixed setpoint.
 
-    def _eliminate_blank_lines(self) -> None:
-        """
-        Eliminate blank lines from the raw lines list.
+        :param start: temperature at the start
+        :param setpoint: the setpoint, 0 for the heater turned off
+        :param duration: seconds to simulate
+        :return: the temperature at the end
         """
-        self._raw_lines = [line for line in self._raw_lines if line.strip()]
+        if start < setpoint:
+            # heating at full power until the setpoint is reached
+            if duration >= self.heat_time(start, setpoint):
+                return float(setpoint)
+            return self.max_temperature - (self.max_temperature - start) * exp(-duration / self.heat_time_constant_s)
+        # cooling until the setpoint, or the ambient temperature when the heater is off
+        floor: float = max(setpoint, self.ambient_temperature)
+        if start <= floor:
+            return start
+        if duration >= self.cool_time(start, floor):
+            return floor
+        return self.ambient_temperature + (start - self.ambient_temperature) * exp(-duration / self.cool_time_constant_s)
 
-    def _process_comments_and_images_at_start_of_file(self) -> None:
-        """
-        Takes all lines up to the first `M73` and immediately dumps them to output list
-        as these are comments and images that are not relevant to the script
-        """
-        while not self._raw_lines[0].startswith('M73'):
-            self._output_lines.append(self._raw_lines.pop(0))
 
-    def _process_block_before_print_start(self) -> None:
-        """
-        Takes everything up to the start of the print start custom gcode section and
-        dumps it to the output list.
-        """
-        while not self._raw_lines[0].startswith('; custom gcode: start_gcode'):
-            self._output_lines.append(self._raw_lines.pop(0))
+class ThermalReplay:
+    """
+    Follows the simulated temperature of every tool along a timeline of setpoint changes,
+    including the time the printer stands still waiting for a tool to heat up.
+    """
 
-    def _extract_slicer_configs_section(self) -> None:
-        """
-        Extracts the slicer configs from the end of the raw lines list.
-        """
-        # first find the line that starts with `; SuperSlicer_config = begin`
-        idx_begin: int = 0
-        for i, line in enumerate(self._raw_lines):
-            if line.startswith('; SuperSlicer_config = begin'):
-                idx_begin = i
-                break
-        # then find the line that starts with `; SuperSlicer_config = end`
-        idx_end = len(self._raw_lines) -1
-        # then extract the lines, including the two lines that contain the begin and end
-        self._ss_configs_section = self._raw_lines[idx_begin:idx_end + 1]
-        # then remove these lines from the raw lines list
-        self._raw_lines = self._raw_lines[:idx_begin] + self._raw_lines[idx_end + 1:]
+    time: float
+    _heaters: list[HeaterModel]
+    # per tool, the temperature and setpoint as of the time it was last brought up to date
+    _temperatures: list[float]
+    _setpoints: list[float]
+    _updated_at: list[float]
 
-    def _parse_slicer_configs(self) -> None:
+    def __init__(self, heaters: list[HeaterModel]) -> None:
         """
-        Parse the slicer configs section to extract relevant configs at the top level
-        as well as on a per-tool basis.
+        Initialize the ThermalReplay class, all tools start off at their ambient temperature.
+
+        :param heaters: heater model of each tool
         """
-        # standby_temp_delta
-        for line in self._ss_configs_section:
-            if line.startswith('; standby_temperature_delta ='):
-                self._standby_temp_delta = abs(int(line.split('=')[1].strip()))
-                break
-        # time_start_gcode
-        for line in self._ss_configs_section:
-            if line.startswith('; time_start_gcode ='):
-                self._time_start_gcode = int(line.split('=')[1].strip())
-                break
-        # time_toolchange
-        for line in self._ss_configs_section:
-            if line.startswith('; time_toolchange ='):
-                self._time_toolchange = int(line.split('=')[1].strip())
-                break
-        # find overall tool count using bed_temperature
-        for line in self._ss_configs_section:
-            if line.startswith('; bed_temperature ='):
-                self._tool_count_overall = len(line.split(','))
-                break
-        # create empty tool configs list
-        self._tool_configs = [ToolConfig(index=tool_number) for tool_number in range(self._tool_count_overall)]
-        # parse individual tool_configs
-        # parse bed temperature
-        for line in self._ss_configs_section:
-            if line.startswith('; bed_temperature ='):
-                bed_temperatures = line.split('=')[1].strip().split(',')
-                for i, temp in enumerate(bed_temperatures):
-                    self._tool_configs[i].bed_temperature = int(temp)
-                break
-        # parse chamber temperature
-        for line in self._ss_configs_section:
-            if line.startswith('; chamber_temperature ='):
-                chamber_temperatures = line.split('=')[1].strip().split(',')
-                for i, temp in enumerate(chamber_temperatures):
-                    self._tool_configs[i].chamber_temperature = int(temp)
-                break
-        # parse first_layer_bed_temperature
-        for line in self._ss_configs_section:
-            if line.startswith('; first_layer_bed_temperature ='):
-                first_layer_bed_temperatures = line.split('=')[1].strip().split(',')
-                for i, temp in enumerate(first_layer_bed_temperatures):
-                    self._tool_configs[i].first_layer_bed_temperature = int(temp)
-                break
-        # parse first_layer_temperature
-        for line in self._ss_configs_section:
-            if line.startswith('; first_layer_temperature ='):
-                first_layer_temperatures = line.split('=')[1].strip().split(',')
-                for i, temp in enumerate(first_layer_temperatures):
-                    self._tool_configs[i].first_layer_temperature = int(temp)
-                break
-        # parse temperature
-        for line in self._ss_configs_section:
-            if line.startswith('; temperature ='):
-                temperatures = line.split('=')[1].strip().split(',')
-                for i, temp in enumerate(temperatures):
-                    self._tool_configs[i].temperature = int(temp)
-                break
+        self.time = 0.0
+        self._heaters = heaters
+        self._temperatures = [heater.ambient_temperature for heater in heaters]
+        self._setpoints = [0.0] * len(heaters)
+        self._updated_at = [0.0] * len(heaters)
 
-    def _extract_print_stats_section(self) -> None:
+    def temperature(self, tool: int) -> float:
         """
-        Extracts the print stats from the raw lines list. When this is called this will
-        consist of the block of comments at the end of _raw_lines
+        :param tool: the tool
+        :return: the temperature of the tool now
         """
-        output: list[str] = []
-        # iterate through the raw lines list starting from the end
-        while self._raw_lines[-1].startswith('; ') or len(self._raw_lines[-1].strip()) == 0:
-            output.append(self._raw_lines.pop(-1))
-        # reverse the output list
-        output.reverse()
-        self._print_stats_section = output
+        self._temperatures[tool] = self._heaters[tool].temperature_after(
+            self._temperatures[tool], self._setpoints[tool], self.time - self._updated_at[tool])
+        self._updated_at[tool] = self.time
+        return self._temperatures[tool]
 
-    def _parse_print_stats(self) -> None:
+    def setpoint(self, tool: int) -> float:
         """
-        Parse the print stats section.
+        :param tool: the tool
+        :return: the setpoint of the tool, 0 for off
         """
-        # parse layer count
-        for line in self._print_stats_section:
-            if line.startswith('; layer count:'):
-                self._layer_count = int(line.split(':')[1].strip())
-                break
-        # parse print time to get minutes and seconds then convert to seconds
-        print_time_line: str = ''
-        for line in self._print_stats_section:
-            if 'estimated printing time' in line:
-                print_time_line = line
-                break
-        # now get just the time string, everything after the = sign
-        print_time_line = print_time_line.split('=')[1].strip()
-        # parse minutes if present and seconds
-        minutes: int = 0
-        seconds: int = 0
-        if 'm' in print_time_line:
-            minutes = int(print_time_line.split('m')[0].strip())
-            seconds = int(print_time_line.split('m')[1].strip().split('s')[0].strip())
-        else:
-            seconds = int(print_time_line.split('s')[0].strip())
-        self._print_time_s = (minutes * 60) + seconds
+        return self._setpoints[tool]
 
-    def _extract_end_gcode_section(self) -> None:
+    def set_temperature(self, tool: int, setpoint: float) -> None:
         """
-        Extracts the end of print section from the bottom of the raw lines list since this
-        is not going to be modified by the script.
+        Change the setpoint of a tool from now on.
+
+        :param tool: the tool
+        :param setpoint: the setpoint, 0 for off
         """
-        # find the M107 line, there should be only one
-        idx_m107: int = 0
-        for i, line in enumerate(self._raw_lines):
-            if line.startswith('M107'):
-                idx_m107 = i
-                break
-        # extract the M107 line and anything after it
-        self._end_print_section = self._raw_lines[idx_m107:]
-        # remove the M107 line from the raw lines list and anything after it
-        self._raw_lines = self._raw_lines[:idx_m107]
-    
-    def _find_tools_used_in_print(self) -> None:
+        self.temperature(tool)
+        self._setpoints[tool] = setpoint
+
+    def wait_for(self, tool: int) -> float:
         """
-        Find the tools used in the print.
+        Stand still until a tool has heated up to its setpoint.
+
+        :param tool: the tool
+        :return: seconds waited
         """
-        for tool in range(self._tool_count_overall):
-            for line in self._raw_lines:
-                tool_name = f'T{tool}'
-                if tool_name in line:
-                    self._tool_configs[tool].tool_used = True
-                    break
+        wait_s: float = self._heaters[tool].heat_time(self.temperature(tool), self._setpoints[tool])
+        if wait_s == inf:
+            # the heater cannot reach the setpoint according to its model, count nothing
+            # rather than poison the totals
+            wait_s = 0.0
+        self.time += wait_s
+        return wait_s
 
-    def _eliminate_ss_pre_toolchange_tool_temp_drop(self) -> None:
+
+class SlicerConfig:
+    """
+    The `; key = value` lines of the SuperSlicer config block, parsed once into a map.
+    Values are kept as text and converted on first access, per extruder settings are
+    comma separated lists.
+    """
+    __slots__ = ('_values', '_converted')
+
+    _values: dict[str, str]
+    # converted values, keyed by the key and the conversion
+    _converted: dict[tuple[str, str], Any]
+
+    def __init__(self, lines: list[str]) -> None:
+        self._values = {}
+        self._converted = {}
+        for line in lines:
+            if not line.startswith('; '):
+                continue
+            key, separator, value = line[2:].partition('=')
+            if separator:
+                # the first occurrence wins, as it did when the block was scanned per key
+                self._values.setdefault(key.strip(), value.strip())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._values
+
+    def get(self, key: str, default: str = '') -> str:
+        return self._values.get(key, default)
+
+    def get_int(self, key: str, default: int = 0) -> int:
+        return self._convert(key, 'int', lambda value: int(value), default)
+
+    def get_float(self, key: str, default: float = 0.0) -> float:
+        # per extruder or per mode settings take their first value
+        return self._convert(key, 'float', lambda value: float(value.split(',')[0]), default)
+
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        return self._convert(key, 'bool', lambda value: value == '1', default)
+
+    def get_int_list(self, key: str) -> list[int]:
+        return self._convert(key, 'int_list', lambda value: [int(item) for item in value.split(',')], [])
+
+    def get_float_list(self, key: str) -> list[float]:
+        return self._convert(key, 'float_list', lambda value: [float(item) for item in value.split(',')], [])
+
+    def _convert(self, key: str, conversion: str, convert: Any, default: Any) -> Any:
         """
-        SS automatically adds a temperature drop to the current tool immediately before
-        a tool change, this eliminates those temperature commands so that this script 
-        can perform its own temperature management.
+        Convert a value on first access and cache the result.
+
+        :param key: the config key
+        :param conversion: name of the conversion, part of the cache key
+        :param convert: function converting the text value
+        :param default: returned if the key is not in the config
         """
-        output_lines: list[str] = []
-        for i, line in enumerate(self._raw_lines):
-            if line.startswith('M104'):
-                next_line_check = (i + 1 < len(self._raw_lines) and 
-                                 self._raw_lines[i + 1].strip() == 
-                                 '; custom gcode: toolchange_gcode')
-                if next_line_check:
-                    continue
-            output_lines.append(line)
-        self._raw_lines = output_lines
+        if key not in self._values:
+            return default
+        cache_key: tuple[str, str] = (key, conversion)
+        if cache_key not in self._converted:
+            self._converted[cache_key] = convert(self._values[key])
+        return self._converted[cache_key]
+
+
+class GcodeMetadata:
+    """
+    Print metadata from the blocks at the end of a gcode file: the print stats block and
+    the SuperSlicer config block.
+    """
+
+    print_stats: list[str]
+    slicer_config: SlicerConfig
+    print_time_s: int
+    layer_count: int
+    tool_count: int
+    # millimeters of filament used by each tool, empty if the print stats do not say
+    filament_used: list[float]
+    tools_used: list[int]
+
+    def __init__(self, print_stats: list[str], slicer_config: SlicerConfig) -> None:
+        self.print_stats = print_stats
+        self.slicer_config = slicer_config
+        self.print_time_s = parse_print_time(print_stats)
+        self.layer_count = parse_layer_count(print_stats)
+        self.tool_count = len(slicer_config.get_int_list('bed_temperature'))
+        self.filament_used = parse_filament_used(print_stats)
+        self.tools_used = [tool for tool, amount in enumerate(self.filament_used) if amount > 0]
+
+
+def read_gcode_metadata(source: str | bytes | mmap, chunk_size: int = TAIL_CHUNK_SIZE) -> GcodeMetadata:
+    """
+    Read the print stats and SuperSlicer config blocks by seeking backwards from the end
+    of the file in fixed size chunks, so the body of the file is never read.
+
+    :param source: path to the gcode file, or its contents
+    :param chunk_size: number of bytes read per step
+    :return: the metadata, empty if the file has no SuperSlicer config block
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as readfile:
+            def read_range(start: int, end: int) -> bytes:
+                readfile.seek(start)
+                return readfile.read(end - start)
+            return _read_tail_metadata(read_range, readfile.seek(0, os.SEEK_END), chunk_size)
+    return _read_tail_metadata(lambda start, end: source[start:end], len(source), chunk_size)
+
+
+def _read_tail_metadata(read_range: Callable[[int, int], bytes], size: int, chunk_size: int) -> GcodeMetadata:
+    """
+    Read the metadata blocks backwards from the end of a gcode file, see `read_gcode_metadata`.
+
+    :param read_range: reads the bytes between two offsets of the file
+    :param size: size of the file
+    :param chunk_size: number of bytes read per step
+    :return: the metadata, empty if the file has no SuperSlicer config block
+    """
+    marker: bytes = ('\n' + SS_CONFIG_BEGIN).encode(GCODE_ENCODING)
+    position: int = size
+    tail: bytes = b''
+    config_start: int = -1
+    while position > 0:
+        step: int = min(chunk_size, position)
+        position -= step
+        tail = read_range(position, position + step) + tail
+        if config_start == -1:
+            config_start = tail.rfind(marker)
+            if config_start == -1:
+                continue
+        else:
+            # the marker moves along as chunks are prepended
+            config_start += step
+        # the print stats block ends at the first line above the config block that is
+        # neither a comment nor blank, keep reading until that line is in the tail
+        if find_print_stats_start(tail, config_start) > 0:
+            break
+    if config_start == -1:
+        return GcodeMetadata([], SlicerConfig([]))
+    stats_start: int = max(find_print_stats_start(tail, config_start), 0)
+    print_stats: list[str] = split_buffer_lines(tail, stats_start, config_start + 1)
+    slicer_config: SlicerConfig = SlicerConfig(split_buffer_lines(tail, config_start + 1, len(tail)))
+    return GcodeMetadata(print_stats, slicer_config)
+
+
+def find_print_stats_start(tail: bytes, config_start: int) -> int:
+    """
+    Find the start of the block of comment and blank lines right above the config block.
+
+    :param tail: the end of the gcode file
+    :param config_start: offset in the tail of the line ending before the config block
+    :return: offset of the first line of the block, or -1 if the block reaches the start
+        of the tail and may go on above it
+    """
+    line_end: int = config_start
+    while line_end > 0:
+        line_start: int = tail.rfind(b'\n', 0, line_end) + 1
+        if line_start == 0:
+            # the line may be cut off by the start of the tail
+            return -1
+        line: bytes = tail[line_start:line_end]
+        if not line.startswith(b'; ') and line.strip():
+            return line_end + 1
+        line_end = line_start - 1
+    return -1
+
+
+def write_file_atomically(file_path: str, chunks: Iterable[bytes],
+                          before_replace: Callable[[], None] | None = None) -> None:
+    """
+    Write a file through a temporary file in the same directory that is flushed to disk and
+    then renamed over the target, so a crash never leaves a truncated file behind. Small
+    chunks are collected into large writes.
+
+    :param file_path: path of the file to write
+    :param chunks: the contents of the file
+    :param before_replace: called once the contents are on disk, just before the rename
+    """
+    temp_fd, temp_file_path = _create_temp_file(file_path)
+    try:
+        with os.fdopen(temp_fd, 'wb', buffering=FILE_CHUNK_SIZE) as writefile:
+            writefile.writelines(chunks)
+            writefile.flush()
+            os.fsync(writefile.fileno())
+        _replace_file(temp_file_path, file_path, before_replace)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+        raise
+
+
+def copy_file_atomically(source_file_path: str, file_path: str) -> None:
+    """
+    Copy a file in the same way that `write_file_atomically` writes one, the copy itself is
+    left to the operating system.
+
+    :param source_file_path: path of the file to copy
+    :param file_path: path of the copy
+    """
+    temp_fd, temp_file_path = _create_temp_file(file_path)
+    os.close(temp_fd)
+    try:
+        shutil.copyfile(source_file_path, temp_file_path)
+        with open(temp_file_path, 'r+b') as writefile:
+            os.fsync(writefile.fileno())
+        _replace_file(temp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+        raise
+
+
+def write_spliced_file(file_path: str, source_file_path: str, source_buffer: bytes | mmap,
+                       pieces: Iterable[bytes | tuple[int, int]],
+                       before_replace: Callable[[], None] | None = None) -> None:
+    """
+    Write a file from an edit list against a source file, in the same way that
+    `write_file_atomically` writes one. Byte ranges of the source are copied by the kernel
+    and only the new data passes through python.
+
+    :param file_path: path of the file to write
+    :param source_file_path: path of the source file
+    :param source_buffer: contents of the source file, used where the kernel cannot copy
+    :param pieces: the contents of the file, either new data or a (start, end) range of the source
+    :param before_replace: called once the contents are on disk, just before the rename
+    """
+    temp_fd, temp_file_path = _create_temp_file(file_path)
+    try:
+        with os.fdopen(temp_fd, 'wb', buffering=0) as writefile, open(source_file_path, 'rb') as sourcefile:
+            source_fd: int = sourcefile.fileno()
+            target_fd: int = writefile.fileno()
+            pending: bytearray = bytearray()
+            for piece in pieces:
+                if isinstance(piece, tuple):
+                    # flush the new data in front of the range before copying it
+                    _write_all(target_fd, pending)
+                    pending.clear()
+                    _copy_range(source_fd, target_fd, source_buffer, piece[0], piece[1])
+                else:
+                    pending += piece
+                    if len(pending) >= FILE_CHUNK_SIZE:
+                        _write_all(target_fd, pending)
+                        pending.clear()
+            _write_all(target_fd, pending)
+            os.fsync(target_fd)
+        _replace_file(temp_file_path, file_path, before_replace)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+        raise
+
+
+def _create_temp_file(file_path: str) -> tuple[int, str]:
+    """
+    Create a uniquely named temporary file next to a file that is about to be written, so
+    concurrent writers of the same target and unrelated files never collide. The temporary
+    file gets the permissions a newly created file would get rather than the private ones
+    of `tempfile.mkstemp`.
+
+    :param file_path: path of the file that is about to be written
+    :return: the open file descriptor and the path of the temporary file
+    """
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    temp_fd, temp_file_path = tempfile.mkstemp(dir=directory, prefix=f'.{file_name}.', suffix='.tmp')
+    try:
+        os.fchmod(temp_fd, NEW_FILE_MODE)
+    except (AttributeError, OSError):
+        # not every platform has fchmod, the file then keeps the private permissions
+        pass
+    return temp_fd, temp_file_path
+
+
+def _remove_file(file_path: str) -> None:
+    """
+    Remove a file if it is still there.
+
+    :param file_path: path of the file
+    """
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def _copy_range(source_fd: int, target_fd: int, source_buffer: bytes | mmap, start: int, end: int) -> None:
+    """
+    Append a byte range of the source file to the target file, with copy_file_range where
+    available, then sendfile, and writing from the buffer where neither works.
+
+    :param source_fd: file descriptor of the source file
+    :param target_fd: file descriptor of the target file, positioned at its end
+    :param source_buffer: contents of the source file
+    :param start: offset of the first byte of the range
+    :param end: offset one past the last byte of the range
+    """
+    while start < end:
+        copied: int = 0
+        try:
+            if hasattr(os, 'copy_file_range'):
+                copied = os.copy_file_range(source_fd, target_fd, end - start, start)
+            elif hasattr(os, 'sendfile'):
+                copied = os.sendfile(target_fd, source_fd, start, end - start)
+        except OSError:
+            # for example a copy across file systems on older kernels
+            copied = 0
+        if copied <= 0:
+            _write_all(target_fd, source_buffer[start:end])
+            return
+        start += copied
+
+
+def _write_all(target_fd: int, data: bytes | bytearray) -> None:
+    """
+    Write all of the data to an unbuffered file descriptor.
+
+    :param target_fd: file descriptor to write to
+    :param data: the data
+    """
+    view: memoryview = memoryview(data)
+    while view:
+        view = view[os.write(target_fd, view):]
+
+
+def _replace_file(temp_file_path: str, file_path: str, before_replace: Callable[[], None] | None = None) -> None:
+    """
+    Rename a fully written temporary file over its target, keeping the permissions of the
+    target, and flush the rename to disk.
+
+    :param temp_file_path: path of the temporary file
+    :param file_path: path of the target
+    :param before_replace: called just before the rename
+    """
+    if os.path.exists(file_path):
+        shutil.copymode(file_path, temp_file_path)
+    if before_replace is not None:
+        before_replace()
+    os.replace(temp_file_path, file_path)
+    if hasattr(os, 'O_DIRECTORY'):
+        # directories cannot be opened for syncing on every platform
+        directory_fd: int = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+
+class ToolchangeEvents:
+    """
+    Columnar table of the toolchanges in the print, in print order, along with the next
+    and last use of each tool so the planner passes do not have to rescan the sections.
+    """
+    __slots__ = (
+        'positions',
+        'outgoing_tools',
+        'incoming_tools',
+        'times',
+        'layers',
+        'first_layer',
+        'previous_use',
+        'next_selection',
+        'previous_deselection',
+        'standby_temperatures',
+        'last_deselection',
+        '_layer',
+        '_last_selected',
+    )
+
+    # index of the toolchange section in the score index
+    positions: array
+    outgoing_tools: array
+    incoming_tools: array
+    # cumulative score at the start of the toolchange
+    times: array
+    # number of layer changes before the toolchange
+    layers: array
+    # 1 if the toolchange happens while first layer temperatures are used
+    first_layer: array
+    # index in the score index of the last section before the toolchange that has the
+    # incoming tool selected or is a toolchange selecting it, -1 if there is none
+    previous_use: array
+    # event of the next toolchange that selects the outgoing tool again, -1 if there is none
+    next_selection: array
+    # event of the toolchange that last deselected the incoming tool, -1 if there is none
+    previous_deselection: array
+    # temperature the deselect pass leaves the outgoing tool at, 0 for off, -1 if unchanged
+    standby_temperatures: array
+
+    # per tool, the event of the last toolchange deselecting it, -1 if there is none
+    last_deselection: list[int]
+
+    # number of layer changes so far, while the sections are added
+    _layer: int
+    # index of the last section that has a tool selected or is a toolchange selecting it
+    _last_selected: dict[int, int]
+
+    def __init__(self, tool_count: int) -> None:
+        self.positions = array('l')
+        self.outgoing_tools = array('b')
+        self.incoming_tools = array('b')
+        self.times = array('d')
+        self.layers = array('l')
+        self.first_layer = array('b')
+        self.previous_use = array('l')
+        self.next_selection = array('l')
+        self.previous_deselection = array('l')
+        self.standby_temperatures = array('l')
+        self.last_deselection = [-1] * tool_count
+        self._layer = 0
+        self._last_selected = {}
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def append(
+        self,
+        position: int,
+        outgoing_tool: int,
+        incoming_tool: int,
+        time: float,
+        layer: int,
+        first_layer: bool,
+        previous_use: int
+    ) -> None:
+        """
+        Add a toolchange to the end of the table.
+        """
+        self.positions.append(position)
+        self.outgoing_tools.append(outgoing_tool)
+        self.incoming_tools.append(incoming_tool)
+        self.times.append(time)
+        self.layers.append(layer)
+        self.first_layer.append(1 if first_layer else 0)
+        self.previous_use.append(previous_use)
+        self.standby_temperatures.append(-1)
+        if 0 <= outgoing_tool < len(self.last_deselection):
+            self.last_deselection[outgoing_tool] = len(self.positions) - 1
+
+    def add_section(self, index: int, section: GcodeSection, time: float) -> None:
+        """
+        Go past a section of the print, in print order, adding it to the table if it is a
+        toolchange other than the initial one.
+
+        :param index: index of the section in the score index
+        :param section: the section
+        :param time: cumulative score at the start of the section
+        """
+        if section.layer_change_comments:
+            self._layer += 1
+        if section.toolchange_gcode and not section.initial_toolchange:
+            self.append(
+                position=index,
+                outgoing_tool=section.outgoing_tool,
+                incoming_tool=section.incoming_tool,
+                time=time,
+                layer=self._layer,
+                first_layer=section.first_layer_temps_used,
+                previous_use=self._last_selected.get(section.incoming_tool, -1)
+            )
+        self._last_selected[section.tool] = index
+        if section.toolchange_gcode:
+            self._last_selected[section.incoming_tool] = index
+
+    def link_next_selections(self) -> None:
+        """
+        Fill in the next selection of every toolchange's outgoing tool, and the other way
+        around the previous deselection of every incoming tool, walking the table backwards
+        once the table is complete.
+        """
+        self.next_selection = array('l', [-1] * len(self.positions))
+        self.previous_deselection = array('l', [-1] * len(self.positions))
+        next_selection: dict[int, int] = {}
+        for event in range(len(self.positions) - 1, -1, -1):
+            self.next_selection[event] = next_selection.get(self.outgoing_tools[event], -1)
+            if self.next_selection[event] != -1:
+                self.previous_deselection[self.next_selection[event]] = event
+            next_selection[self.incoming_tools[event]] = event
+
+
+class TimeModel(Enum):
+    """
+    How the approximated durations of the gcode blocks are estimated.
+    """
+    # in proportion to the number of G1 lines in each block, the default
+    LINE_COUNT = 'line_count'
+    # from the length, feedrate and acceleration limits of every move in each block, more
+    # accurate but several times slower on large files as every move is estimated in python
+    KINEMATIC = 'kinematic'
+    # interpolated between the M73 progress markers the slicer writes
+    PROGRESS_MARKERS = 'progress_markers'
+
+
+class MachineLimits:
+    """
+    Kinematic limits of the printer, as exported by SuperSlicer in its config block.
+    """
+
+    max_acceleration_extruding: float
+    max_acceleration_retracting: float
+    max_acceleration_travel: float
+    # per axis limits, indexed X, Y, Z, E
+    max_acceleration: tuple[float, float, float, float]
+    max_feedrate: tuple[float, float, float, float]
+    max_jerk: float
+    relative_e_distances: bool
+
+    def __init__(self) -> None:
+        self.max_acceleration_extruding = CFG_DEFAULT_MAX_ACCELERATION
+        self.max_acceleration_retracting = CFG_DEFAULT_MAX_ACCELERATION
+        self.max_acceleration_travel = CFG_DEFAULT_MAX_ACCELERATION
+        self.max_acceleration = (CFG_DEFAULT_MAX_ACCELERATION,) * 4
+        self.max_feedrate = CFG_DEFAULT_MAX_FEEDRATE
+        self.max_jerk = CFG_DEFAULT_MAX_JERK
+        self.relative_e_distances = True
+
+
+class KinematicTimeEstimator:
+    """
+    Estimates the duration of the moves in the gcode blocks, in print order, using a
+    trapezoidal velocity profile for every move. Entry and exit speeds are limited by
+    the angle to the neighbouring moves, with one move of lookahead.
+    """
+    __slots__ = (
+        '_limits',
+        '_position',
+        '_feedrate',
+        '_acceleration',
+        '_relative_e_distances',
+        '_pending_section',
+        '_pending_move',
+        'total_time_s',
+    )
+
+    _limits: MachineLimits
+    # X, Y, Z, E
+    _position: list[float]
+    # mm/s
+    _feedrate: float
+    # acceleration set by M204, 0 if not set
+    _acceleration: float
+    _relative_e_distances: bool
+    # the last move, whose exit speed depends on the move after it, and the section it belongs to
+    _pending_section: GcodeSection | None
+    # length, unit vector x, y, z, cruise speed, acceleration, entry speed
+    _pending_move: tuple[float, float, float, float, float, float, float]
+    total_time_s: float
+
+    def __init__(self, limits: MachineLimits) -> None:
+        self._limits = limits
+        self._position = [0.0, 0.0, 0.0, 0.0]
+        self._feedrate = CFG_DEFAULT_FEEDRATE
+        self._acceleration = 0.0
+        self._relative_e_distances = limits.relative_e_distances
+        self._pending_section = None
+        self._pending_move = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        self.total_time_s = 0.0
+
+    def process_command(self, line: bytes) -> None:
+        """
+        Track the state changes of a line outside of the gcode blocks.
+
+        :param line: the raw line
+        """
+        if not line.startswith(KINEMATIC_STATE_COMMANDS):
+            return
+        if line.startswith(b'M204'):
+            # klipper takes S, or the lower of P and T
+            values: dict[bytes, float] = {letter: float(value) for letter, value in MOVE_PARAMETER_PATTERN.findall(line, 4) if letter in b'SPT'}
+            if b'S' in values:
+                self._acceleration = values[b'S']
+            elif values:
+                self._acceleration = min(values.values())
+        elif line.startswith(b'G92'):
+            for letter, value in MOVE_PARAMETER_PATTERN.findall(line, 3):
+                if letter in b'XYZE':
+                    self._position[b'XYZE'.index(letter)] = float(value)
+        elif line.startswith(b'M82'):
+            self._relative_e_distances = False
+        elif line.startswith(b'M83'):
+            self._relative_e_distances = True
+        elif line.startswith((b'G0 ', b'G0\n')):
+            # moves outside of the gcode blocks are not scored, only their end position matters
+            for letter, value in MOVE_PARAMETER_PATTERN.findall(line, 2):
+                if letter in b'XYZ':
+                    self._position[b'XYZE'.index(letter)] = float(value)
+
+    def add_moves(self, section: GcodeSection, text: bytes) -> None:
+        """
+        Estimate the moves of a gcode block, adding the time of each move to the score of
+        the section it belongs to. This runs for every move in the print so the state is
+        kept in locals and the per axis limits are unrolled.
+
+        :param section: the gcode block
+        :param text: the raw text of the gcode block
+        """
+        limits: MachineLimits = self._limits
+        max_feedrate_x, max_feedrate_y, max_feedrate_z, max_feedrate_e = limits.max_feedrate
+        max_acceleration_x, max_acceleration_y, max_acceleration_z, max_acceleration_e = limits.max_acceleration
+        acceleration_extruding: float = limits.max_acceleration_extruding
+        acceleration_travel: float = limits.max_acceleration_travel
+        acceleration_retracting: float = limits.max_acceleration_retracting
+        if self._acceleration > 0.0:
+            acceleration_extruding = min(acceleration_extruding, self._acceleration)
+            acceleration_travel = min(acceleration_travel, self._acceleration)
+            acceleration_retracting = min(acceleration_retracting, self._acceleration)
+        jerk: float = limits.max_jerk
+        relative_e: bool = self._relative_e_distances
+        x, y, z, e = self._position
+        feedrate: float = self._feedrate
+        pending_section: GcodeSection | None = self._pending_section
+        pending_length, pending_x, pending_y, pending_z, pending_speed, pending_acceleration, pending_entry = self._pending_move
+        total_time_s: float = 0.0
+        moves: list[tuple[bytes, bytes, bytes, bytes, bytes]] = G1_MOVE_PATTERN.findall(text)
+        if len(moves) != len(G1_MOVE_LINE_PATTERN.findall(text)):
+            moves = parse_moves(text)
+        for move_x, move_y, move_z, move_e, move_f in moves:
+            new_x: float = float(move_x) if move_x else x
+            new_y: float = float(move_y) if move_y else y
+            new_z: float = float(move_z) if move_z else z
+            de: float = 0.0
+            if move_e:
+                de = float(move_e) if relative_e else float(move_e) - e
+            if move_f:
+                feedrate = float(move_f) / 60.0
+            dx: float = new_x - x
+            dy: float = new_y - y
+            dz: float = new_z - z
+            x = new_x
+            y = new_y
+            z = new_z
+            e += de
+            length: float = sqrt(dx * dx + dy * dy + dz * dz)
+            speed: float = feedrate
+            acceleration: float
+            unit_x: float = 0.0
+            unit_y: float = 0.0
+            unit_z: float = 0.0
+            if length > 0.0:
+                unit_x = dx / length
+                unit_y = dy / length
+                unit_z = dz / length
+                acceleration = acceleration_extruding if de > 0.0 else acceleration_travel
+                # scale the speed and acceleration down so that no single axis exceeds its limits
+                if dx != 0.0:
+                    ratio: float = length / abs(dx)
+                    if speed > max_feedrate_x * ratio:
+                        speed = max_feedrate_x * ratio
+                    if acceleration > max_acceleration_x * ratio:
+                        acceleration = max_acceleration_x * ratio
+                if dy != 0.0:
+                    ratio = length / abs(dy)
+                    if speed > max_feedrate_y * ratio:
+                        speed = max_feedrate_y * ratio
+                    if acceleration > max_acceleration_y * ratio:
+                        acceleration = max_acceleration_y * ratio
+                if dz != 0.0:
+                    ratio = length / abs(dz)
+                    if speed > max_feedrate_z * ratio:
+                        speed = max_feedrate_z * ratio
+                    if acceleration > max_acceleration_z * ratio:
+                        acceleration = max_acceleration_z * ratio
+                if de != 0.0:
+                    ratio = length / abs(de)
+                    if speed > max_feedrate_e * ratio:
+                        speed = max_feedrate_e * ratio
+                    if acceleration > max_acceleration_e * ratio:
+                        acceleration = max_acceleration_e * ratio
+            elif de != 0.0:
+                # extruder only move, retract or unretract
+                length = abs(de)
+                acceleration = min(acceleration_retracting, max_acceleration_e)
+                speed = min(speed, max_feedrate_e)
+            else:
+                continue
+            entry_speed: float = 0.0
+            if pending_section is not None:
+                # full speed through a straight line, down to the jerk limit through a reversal
+                slower: float = speed if speed < pending_speed else pending_speed
+                cosine: float = pending_x * unit_x + pending_y * unit_y + pending_z * unit_z
+                entry_speed = slower * cosine if cosine > 0.0 else 0.0
+                if entry_speed < jerk:
+                    entry_speed = jerk if jerk < slower else slower
+                # the previous move may be too short to slow down or speed up to that
+                reachable: float = sqrt(pending_entry * pending_entry + 2.0 * pending_acceleration * pending_length)
+                if entry_speed > reachable:
+                    entry_speed = reachable
+                time_s: float = trapezoid_time(pending_length, pending_entry, pending_speed, entry_speed, pending_acceleration)
+                pending_section.score += time_s
+                total_time_s += time_s
+            pending_section = section
+            pending_length = length
+            pending_x = unit_x
+            pending_y = unit_y
+            pending_z = unit_z
+            pending_speed = speed
+            pending_acceleration = acceleration
+            pending_entry = entry_speed
+        self._position = [x, y, z, e]
+        self._feedrate = feedrate
+        self._pending_section = pending_section
+        self._pending_move = (pending_length, pending_x, pending_y, pending_z, pending_speed, pending_acceleration, pending_entry)
+        self.total_time_s += total_time_s
+
+    def finish(self) -> None:
+        """
+        Settle the last move, which decelerates to a stop.
+        """
+        if self._pending_section is not None:
+            length, _, _, _, speed, acceleration, entry_speed = self._pending_move
+            time_s: float = trapezoid_time(length, entry_speed, speed, 0.0, acceleration)
+            self._pending_section.score += time_s
+            self.total_time_s += time_s
+            self._pending_section = None
+
+    def add_section(self, section: GcodeSection) -> None:
+        """
+        Estimate the moves of a section if it is a gcode block, otherwise track the state
+        changes of its lines.
+
+        :param section: the next section of the print
+        """
+        if section.gcode_block:
+            self.add_moves(section, section.resolve_bytes())
+        else:
+            for line in section.resolve_bytes().split(b'\n'):
+                self.process_command(line)
+
+    def is_pending(self, section: GcodeSection) -> bool:
+        """
+        Whether the last move estimated belongs to the section, its score then still grows
+        with the next move or when the estimate is finished.
+        """
+        return section is self._pending_section
+
+
+def parse_moves(text: bytes) -> list[tuple[bytes, bytes, bytes, bytes, bytes]]:
+    """
+    Parse the G1 moves of a gcode block line by line, whatever the order of their parameters.
+
+    :param text: the raw text of the gcode block
+    :return: list of (X, Y, Z, E, F) tuples, empty for parameters the move does not have
+    """
+    moves: list[tuple[bytes, bytes, bytes, bytes, bytes]] = []
+    for line in text.split(b'\n'):
+        if not G1_MOVE_LINE_PATTERN.match(line):
+            continue
+        comment: int = line.find(b';')
+        parameters: dict[bytes, bytes] = dict(MOVE_PARAMETER_PATTERN.findall(line, 2, len(line) if comment == -1 else comment))
+        moves.append((
+            parameters.get(b'X', b''),
+            parameters.get(b'Y', b''),
+            parameters.get(b'Z', b''),
+            parameters.get(b'E', b''),
+            parameters.get(b'F', b'')
+        ))
+    return moves
+
+
+def trapezoid_time(length: float, entry_speed: float, cruise_speed: float, exit_speed: float, acceleration: float) -> float:
+    """
+    Duration of a move that accelerates from its entry speed towards the cruise speed and
+    decelerates to its exit speed.
+
+    :param length: length of the move in mm
+    :param entry_speed: speed at the start of the move in mm/s
+    :param cruise_speed: the requested speed in mm/s
+    :param exit_speed: speed at the end of the move in mm/s
+    :param acceleration: acceleration in mm/s^2
+    :return: the duration in seconds
+    """
+    if cruise_speed <= 0.0:
+        return 0.0
+    if acceleration <= 0.0:
+        return length / cruise_speed
+    entry_speed = min(entry_speed, cruise_speed)
+    exit_speed = min(exit_speed, cruise_speed)
+    accelerate_distance: float = (cruise_speed * cruise_speed - entry_speed * entry_speed) / (2.0 * acceleration)
+    decelerate_distance: float = (cruise_speed * cruise_speed - exit_speed * exit_speed) / (2.0 * acceleration)
+    if accelerate_distance + decelerate_distance <= length:
+        return (cruise_speed - entry_speed) / acceleration + \
+            (cruise_speed - exit_speed) / acceleration + \
+            (length - accelerate_distance - decelerate_distance) / cruise_speed
+    # the cruise speed is never reached, the move is a triangle peaking in between
+    peak_speed: float = sqrt((2.0 * acceleration * length + entry_speed * entry_speed + exit_speed * exit_speed) / 2.0)
+    peak_speed = max(peak_speed, entry_speed, exit_speed)
+    return (peak_speed - entry_speed) / acceleration + (peak_speed - exit_speed) / acceleration
+
+
+class ProgressMarkerAnchors:
+    """
+    Elapsed times pinned by the M73 progress markers of a print, against the number of G1
+    lines before each marker. The sections are added in print order, in between markers
+    the elapsed time is interpolated by line count.
+    """
+    __slots__ = (
+        '_print_time_s',
+        '_use_remaining_time',
+        '_previous_marker',
+        '_line_counts',
+        '_times',
+        'line_count',
+    )
+
+    _print_time_s: int
+    _use_remaining_time: bool
+    _previous_marker: bytes
+    # elapsed time at each change in progress, against the G1 lines before it
+    _line_counts: list[int]
+    _times: list[float]
+    # number of G1 lines of the gcode blocks added so far
+    line_count: int
+
+    def __init__(self, print_time_s: int) -> None:
+        self._print_time_s = print_time_s
+        # the percentage resolves to 1% of the print time and the remaining time to a
+        # minute, so go by whichever is finer for this print
+        self._use_remaining_time = print_time_s > 6000
+        self._previous_marker = b''
+        self._line_counts = [0]
+        self._times = [0.0]
+        self.line_count = 0
+
+    def add_section(self, section: GcodeSection) -> None:
+        """
+        Count the lines of a gcode block, or pin the elapsed time at the progress markers of
+        another section.
+
+        :param section: the next section of the print
+        """
+        if section.gcode_block:
+            self.line_count += section.line_count()
+        elif not section.toolchange_gcode:
+            text: bytes = section.resolve_bytes()
+            # any line of a run of plain lines can be a marker, other kinds only count
+            # when they start with one
+            if section.flags & SECTION_KIND_FLAGS:
+                markers: Iterable[re.Match] = filter(None, [PROGRESS_MARKER_PATTERN.match(text)])
+            else:
+                markers = PROGRESS_MARKER_LINE_PATTERN.finditer(text)
+            for marker in markers:
+                value: bytes | None = marker.group(2) if self._use_remaining_time else marker.group(1)
+                if value is not None and value != self._previous_marker:
+                    self._previous_marker = value
+                    elapsed: float
+                    if self._use_remaining_time:
+                        elapsed = float(self._print_time_s - int(value) * 60)
+                    else:
+                        elapsed = self._print_time_s * int(value) / 100.0
+                    self._line_counts.append(self.line_count)
+                    # the rounding of the markers must not make time run backwards
+                    self._times.append(max(elapsed, self._times[-1]))
+
+    def finish(self) -> bool:
+        """
+        Pin the end of the print at the print time, once all sections are added.
+
+        :return: False if there are no progress markers or lines to go by
+        """
+        if len(self._times) == 1 or self.line_count == 0:
+            return False
+        self._line_counts.append(self.line_count)
+        self._times.append(max(float(self._print_time_s), self._times[-1]))
+        return True
+
+    def elapsed_at(self, line_index: int) -> float:
+        """
+        Interpolate the elapsed time at a G1 line between the surrounding anchors.
+        """
+        anchor: int = bisect_right(self._line_counts, line_index) - 1
+        if anchor >= len(self._line_counts) - 1:
+            return self._times[-1]
+        span: int = self._line_counts[anchor + 1] - self._line_counts[anchor]
+        if span == 0:
+            return self._times[anchor + 1]
+        fraction: float = (line_index - self._line_counts[anchor]) / span
+        return self._times[anchor] + fraction * (self._times[anchor + 1] - self._times[anchor])
+
+
+class ToolchangerPostprocessor:
+
+
+    _input_file_path: str
+    _output_file_path: str
+    # whether the gcode was read from the input file rather than handed over in memory
+    _input_from_file: bool
+    _splice_output: bool
+    # process the body of the print a window at a time, in two passes over the input, so
+    # that the memory held does not grow with the size of the file
+    _stream: bool
+    # buffer offsets of the first line of the body of the print and of the first line after
+    # it, the part of the file streaming mode processes in windows
+    _body_start: int
+    _body_end: int
+    # the whole gcode file mapped into memory, sections reference spans of it
+    _buffer: bytes | mmap
+    # line terminator of the input, new and rewritten gcode is written with it
+    _line_ending: str
+    # start offsets into the buffer of the raw lines that have not been consumed yet
+    _raw_line_offsets: array
+    # spans of the buffer before the print start gcode, passed through unchanged
+    _output_spans: list[tuple[int, int]]
+
+    # print stats
+    _layer_count: int
+    _print_time_s: int
+    _time_start_gcode: int
+    _time_toolchange: int
+    _standby_temp_delta: int
+
+    # relevant ss configs
+    _slicer_config: SlicerConfig
+    _tool_count_overall: int
+    _machine_limits: MachineLimits
+
+    # how the gcode blocks are scored
+    _time_model: TimeModel
+
+    # tool configs
+    _tool_configs: list[ToolConfig]
+
+    # special sections, the spans are what is written out as they are never changed
+    _end_print_spans: list[tuple[int, int]]
+    _print_stats_section: list[str]
+    _print_stats_spans: list[tuple[int, int]]
+    _ss_configs_section: list[str]
+    _ss_configs_spans: list[tuple[int, int]]
+
+    # sections
+    _track_current_tool: int
+    # tool selected by the start gcode and the tool left selected at the end of the print
+    _first_tool: int
+    _last_tool: int
+
+    # linked list of sections
+    _first_section: GcodeSection
+    _last_section: GcodeSection
+
+    # state the section stages carry from one window of the body to the next in streaming
+    # mode, see _reset_section_stages
+    _initial_toolchange_found: bool
+    _initial_temperature_block_found: bool
+    _second_layer_found: bool
+    _tools_encountered: set[int]
+    _skipped_first_toolchange: bool
+
+    # score tracker
+    _score_tracker: float
+    _has_first_toolchange: bool
+
+    # score index, built once the sections are scored, in streaming mode only the
+    # toolchange sections are kept by index, with just the last two lines of each that
+    # the planner passes insert their lines before
+    _indexed_sections: list[GcodeSection] | dict[int, GcodeSection]
+    # _cumulative_scores[i] is the total score of the sections before _indexed_sections[i]
+    _cumulative_scores: array
+    _cumulative_scores_ascending: bool
+    # index of the start gcode section in the score index
+    _start_gcode_index: int
+    # per index of the score index, the preheats planned before that section as tool and
+    # temperature, in the order they are inserted
+    _planned_preheats: dict[int, list[tuple[int, int]]]
+    # toolchange event table, built along with the score index
+    _toolchange_events: ToolchangeEvents
+    # metadata read from the end of the file, read on first use
+    _metadata: GcodeMetadata | None
+
+    def __init__(self, input_file_path: str, time_model: TimeModel = TimeModel.LINE_COUNT,
+                 output_file_path: str | None = None, splice_output: bool = True,
+                 data: bytes | None = None, stream: bool = False) -> None:
+        """
+        Initialize the ToolchangerPostprocessor class.
+
+        :param input_file_path: path to the input gcode file, only a name for the gcode when data is given
+        :param time_model: how the durations of the gcode blocks are estimated
+        :param output_file_path: path to write the output to, defaults to replacing the input file
+        :param splice_output: copy the unchanged parts of the input to the output in the kernel
+        :param data: contents of the gcode file, the file is not read when this is given
+        :param stream: process the body of the print a window at a time, see _process_sections_streamed
+        """
+        self._input_file_path = input_file_path
+        self._output_file_path = output_file_path or input_file_path
+        self._splice_output = splice_output
+        self._stream = stream
+        self._body_start = 0
+        self._body_end = 0
+        self._time_model = time_model
+        self._machine_limits = MachineLimits()
+        self._output_spans = []
+        self._input_from_file = data is None
+        self._buffer = self._read_input_file() if data is None else data
+        self._line_ending = detect_line_ending(self._buffer)
+        self._raw_line_offsets = array('I')
+        self._layer_count = 0
+        self._print_time_s = 0
+        self._time_start_gcode = 0
+        self._time_toolchange = 0
+        self._end_print_spans = []
+        self._print_stats_section = []
+        self._print_stats_spans = []
+        self._ss_configs_section = []
+        self._ss_configs_spans = []
+        self._slicer_config = SlicerConfig([])
+        self._first_tool = 0
+        self._last_tool = 0
+        self._score_tracker = 0.0
+        self._reset_section_stages()
+        self._indexed_sections = []
+        self._cumulative_scores = array('d')
+        self._cumulative_scores_ascending = True
+        self._start_gcode_index = 0
+        self._planned_preheats = {}
+        self._toolchange_events = ToolchangeEvents(tool_count=0)
+        self._metadata = None
+
+    def _read_input_file(self) -> bytes | mmap:
+        """
+        Map the input gcode file into memory. Lines are classified on the raw bytes and
+        only the lines that are inspected or rewritten get decoded.
+
+        :return: read only mapping of the input file
+        :raises OSError: if the input file cannot be read
+        """
+        with open(self._input_file_path, "rb") as readfile:
+            if os.fstat(readfile.fileno()).st_size == 0:
+                # an empty file cannot be mapped
+                return b''
+            return mmap(readfile.fileno(), 0, access=ACCESS_READ)
+
+    def _reset_section_stages(self) -> None:
+        """
+        Reset the section list and the state the section stages carry from one window of
+        the body to the next, before the first window of a pass.
+        """
+        self._first_section = None  # type: ignore
+        self._last_section = None  # type: ignore
+        self._has_first_toolchange = False
+        self._initial_toolchange_found = False
+        self._initial_temperature_block_found = False
+        self._second_layer_found = False
+        self._tools_encountered = set()
+        self._skipped_first_toolchange = False
+
+    def _index_raw_lines(self, start: int = 0, end: int | None = None) -> array:
+        """
+        Index the start offset of every line in a range of the buffer.
+
+        :param start: offset of the first line, defaults to the start of the buffer
+        :param end: offset of the first line after the range, defaults to the end of the buffer
+        :return: array of line start offsets
+        """
+        # 4 byte offsets are enough for anything short of a 4 GB file
+        offsets: array = array('I' if len(self._buffer) < 2 ** 32 else 'Q')
+        if end is None:
+            end = len(self._buffer)
+        while start < end:
+            offsets.append(start)
+            start = self._buffer.find(b'\n', start) + 1
+            if start == 0:
+                # last line without a line ending
+                break
+        return offsets
+
+    def process_gcode(self, write_output: bool = True, report_file_path: str | None = None) -> 'JobResult':
+        """
+        Process the gcode file. Gcode that is left alone is reported as skipped and copied
+        unchanged to the output when that goes somewhere else.
+
+        :param write_output: write the output file, turned off for a dry run
+        :param report_file_path: path to write the predicted timeline report to, JSON or CSV by extension
+        :return: the result, with a summary of the report as its message when one is written
+        :raises ValueError: if a report is asked for in streaming mode
+        """
+        if self._stream and report_file_path is not None:
+            raise ValueError('the timeline report needs the whole section list, which streaming mode does not keep')
+        # leave the gcode alone if it does not need processing
+        skip_reason: str = self._skip_reason()
+        if skip_reason:
+            if write_output:
+                self._copy_input_to_output()
+            return JobResult(self._input_file_path, JobStatus.SKIPPED, skip_reason)
+        # process the sections, in two passes over the body in streaming mode
+        if self._stream:
+            self._process_sections_streamed()
+        else:
+            self._process_sections()
+        # predict the waits at the toolchanges while the input is still mapped
+        message: str = ''
+        if report_file_path is not None:
+            message = self._write_timeline_report(report_file_path)
+        # reconstruct the gcode and write the output file
+        if write_output:
+            self._write_output_file()
+        return JobResult(self._input_file_path, JobStatus.PROCESSED, message)
+
+    def process_to_chunks(self) -> tuple['JobResult', Iterator[bytes]]:
+        """
+        Process the gcode without writing any file and without exiting. Gcode that is left
+        alone is reported as skipped and comes out unchanged.
+
+        :return: the result and an iterator over the chunks of the output
+        """
+        skip_reason: str = self._skip_reason()
+        if skip_reason:
+            return JobResult(self._input_file_path, JobStatus.SKIPPED, skip_reason), iter((bytes(self._buffer),))
+        if self._stream:
+            self._process_sections_streamed()
+        else:
+            self._process_sections()
+        return JobResult(self._input_file_path, JobStatus.PROCESSED), self._reconstruct_for_output()
+
+    def summary(self) -> str:
+        """
+        Describe the gcode and whether it would be processed from the metadata at the end of
+        the file and the start of the gcode, without processing the body.
+
+        :return: a one line summary
+        """
+        metadata: GcodeMetadata = self._read_metadata()
+        tools_used: str = ', '.join(f'T{tool}' for tool in metadata.tools_used) or 'unknown'
+        layers: str = f'{metadata.layer_count} layers, ' if metadata.layer_count else ''
+        skip_reason: str = self._skip_reason()
+        return (f'{metadata.tool_count} tools, used {tools_used}, {layers}estimated print time {metadata.print_time_s}s, '
+                + (f'would be left alone: {skip_reason}' if skip_reason else 'would be processed'))
+
+    def _read_metadata(self) -> GcodeMetadata:
+        """
+        Read the print stats and config blocks from the end of the buffer, once.
+
+        :return: the metadata
+        """
+        if self._metadata is None:
+            self._metadata = read_gcode_metadata(self._buffer)
+        return self._metadata
+
+    def _skip_reason(self) -> str:
+        """
+        Checks whether the gcode needs processing, both checks only search the parts of the
+        buffer the answer can be in so that the body of a skipped file is never read.
+
+        :return: why the gcode is left alone, or an empty string if it should be processed
+        """
+        # only process if there is a tool change in the gcode
+        if not self._has_tool_change_in_gcode():
+            return 'No tool change in gcode'
+        # never process the same gcode twice
+        if self._is_already_processed():
+            return 'Gcode already processed'
+        return ''
+
+    def _process_sections(self) -> None:
+        """
+        Run the processing stages, the output is reconstructed from the sections afterwards.
+        """
+        # index the raw lines of the file
+        self._raw_line_offsets = self._index_raw_lines()
+        # eliminate unneeded blank lines
+        self._eliminate_blank_lines()
+        # dump comments and images at top of file into output list
+        self._process_comments_and_images_at_start_of_file()
+        # process block before print start
+        self._process_block_before_print_start()
+        # extract slicer configs section
+        self._extract_slicer_configs_section()
+        # parse slicer configs
+        self._parse_slicer_configs()
+        # extract print stats section
+        self._extract_print_stats_section()
+        # parse print stats
+        self._parse_print_stats()
+        # initial score
+        self._score_tracker = float(self._print_time_s - self._time_start_gcode)
+        # extract end print section
+        self._extract_end_gcode_section()
+        # find tools used in print
+        self._find_tools_used_in_print()
+        # eliminate ss pre toolchange tool temp drop
+        self._eliminate_ss_pre_toolchange_tool_temp_drop()
+        # eliminate ss post start filament tool temp set
+        self._eliminate_ss_post_start_filament_tool_temp_set()
+        # process start filament gcode blocks for tool parameters
+        self._process_start_filament_gcode_blocks_for_tool_parameters()
+        # extract basic start info
+        self._extract_basic_start_info()
+        # parse the raw lines into sections
+        self._parse_raw_lines_into_sections()
+        # process the start section
+        self._process_start_section()
+        # process the second layer changes
+        self._process_second_layer_changes()
+        # process the toolchange sections
+        self._process_toolchange_sections()
+        # score the gcode blocks
+        self._score_gcode_blocks()
+        # index the cumulative scores of the sections
+        self._build_score_index()
+        # build the toolchange event table
+        self._build_toolchange_events()
+        # add the turn off tool logic
+        self._add_turn_off_tool_logic()
+        # add the deselect temperature logic
+        self._add_deselect_temperature_logic()
+        # add the preheat logic
+        self._add_preheat_logic()
+
+    def _process_sections_streamed(self) -> None:
+        """
+        Pass one of streaming mode. The head and the tail of the file are processed as
+        usual, the body a window of whole layers at a time with the same stages, and of
+        each section only its score goes into the index, along with the toolchange sections
+        the planner passes add their lines to. Pass two, see _stream_output_sections, runs
+        the window stages again as the output is written. A file without the lines the body
+        is found by is processed in one go.
+        """
+        body: tuple[int, int] | None = self._find_body_bounds()
+        if body is None:
+            self._stream = False
+            self._process_sections()
+            return
+        self._body_start, self._body_end = body
+        # index the raw lines of the tail of the file, from the M107 that ends the print
+        self._raw_line_offsets = self._index_raw_lines(self._body_end)
+        self._eliminate_blank_lines()
+        # extract and parse the slicer configs and the print stats
+        self._extract_slicer_configs_section()
+        self._parse_slicer_configs()
+        self._extract_print_stats_section()
+        self._parse_print_stats()
+        # initial score
+        self._score_tracker = float(self._print_time_s - self._time_start_gcode)
+        # extract end print section
+        self._extract_end_gcode_section()
+        # index the raw lines of the head of the file, up to the start gcode
+        self._raw_line_offsets = self._index_raw_lines(0, self._body_start)
+        self._eliminate_blank_lines()
+        self._process_comments_and_images_at_start_of_file()
+        self._process_block_before_print_start()
+        # find tools used in print
+        self._find_tools_used_in_print(self._body_start, self._body_end)
+        # score the sections of the body as they come out of the windows
+        estimator: KinematicTimeEstimator | None = None
+        anchors: ProgressMarkerAnchors | None = None
+        if self._time_model == TimeModel.KINEMATIC:
+            estimator = KinematicTimeEstimator(self._machine_limits)
+        elif self._time_model == TimeModel.PROGRESS_MARKERS:
+            anchors = ProgressMarkerAnchors(self._print_time_s)
+        scores: array = array('d')
+        line_counts: array = array('l')
+        self._indexed_sections = {}
+        self._toolchange_events = ToolchangeEvents(tool_count=self._tool_count_overall)
+        # sections wait here until the estimator is past their last move
+        pending: deque[GcodeSection] = deque()
+        for current_section in self._process_body_windows(update_tool_configs=True):
+            if estimator is not None:
+                estimator.add_section(current_section)
+            elif anchors is not None:
+                anchors.add_section(current_section)
+            pending.append(current_section)
+            while pending and not (estimator is not None and estimator.is_pending(pending[0])):
+                self._add_to_streamed_index(pending.popleft(), scores, line_counts)
+        if estimator is not None:
+            estimator.finish()
+        while pending:
+            self._add_to_streamed_index(pending.popleft(), scores, line_counts)
+        # index the cumulative scores of the sections
+        self._build_streamed_score_index(scores, line_counts, estimator, anchors)
+        # fill in the times of the toolchange events
+        events: ToolchangeEvents = self._toolchange_events
+        for event in range(len(events)):
+            events.times[event] = self._cumulative_scores[events.positions[event]]
+        events.link_next_selections()
+        # add the turn off tool logic
+        self._add_turn_off_tool_logic()
+        # add the deselect temperature logic
+        self._add_deselect_temperature_logic()
+        # plan the preheat logic, the preheat sections are added in pass two
+        self._add_preheat_logic()
+
+    def _find_body_bounds(self) -> tuple[int, int] | None:
+        """
+        Find the body of the print without indexing the lines of the file: from the start
+        gcode after the first M73 up to the M107 after it, the lines the head and tail
+        stages stop at.
+
+        :return: buffer offsets of the first line of the body and of the first line after
+            it, or None if the file does not have these lines
+        """
+        first_m73: int = self._find_buffer_line('M73')
+        if first_m73 == -1:
+            return None
+        body_start: int = self._find_buffer_line('; custom gcode: start_gcode', first_m73)
+        if body_start == -1:
+            return None
+        body_end: int = self._find_buffer_line('M107', body_start)
+        if body_end == -1:
+            return None
+        return body_start, body_end
+
+    def _body_windows(self) -> Iterator[tuple[int, int]]:
+        """
+        Split the body of the print into windows of whole layers, each ending at the first
+        layer change after STREAM_WINDOW_SIZE bytes. The first window reaches past the first
+        toolchange, which the start section is processed with.
+
+        :return: iterator of (start, end) buffer offsets of the windows, both line starts
+        """
+        start: int = self._body_start
+        first_toolchange: int = self._find_buffer_line('; custom gcode: toolchange_gcode', start, self._body_end)
+        minimum_end: int = max(start + STREAM_WINDOW_SIZE, first_toolchange + 1)
+        while start < self._body_end:
+            end: int = self._find_buffer_line(';LAYER_CHANGE', minimum_end, self._body_end)
+            if end == -1:
+                end = self._body_end
+            yield start, end
+            start = end
+            minimum_end = start + STREAM_WINDOW_SIZE
+
+    def _process_body_windows(self, update_tool_configs: bool) -> Iterator[GcodeSection]:
+        """
+        Run the section stages over the body of the print a window at a time and yield the
+        sections of each window in print order, taken out of the linked list. The stages
+        carry their state from one window to the next, so the sections come out the same
+        as when the body is processed in one go.
+
+        :param update_tool_configs: read the tool parameters into the tool configs, only
+            the first pass does
+        """
+        first_window: bool = True
+        for window_start, window_end in self._body_windows():
+            # index the raw lines of the window
+            self._raw_line_offsets = self._index_raw_lines(window_start, window_end)
+            self._eliminate_blank_lines()
+            # eliminate the slicer temperature commands and process the tool parameters
+            self._eliminate_ss_pre_toolchange_tool_temp_drop()
+            self._eliminate_ss_post_start_filament_tool_temp_set()
+            self._process_start_filament_gcode_blocks_for_tool_parameters(update_tool_configs)
+            if first_window:
+                self._extract_basic_start_info()
+            # parse the raw lines into sections and process them
+            self._parse_raw_lines_into_sections()
+            if first_window:
+                self._process_start_section()
+            self._process_second_layer_changes()
+            self._process_toolchange_sections()
+            yield from self._detach_sections()
+            # the pages of the window are read back from the file if its spans are copied later
+            self._release_pages(window_start, window_end)
+            first_window = False
+
+    def _add_to_streamed_index(self, section: GcodeSection, scores: array, line_counts: array) -> None:
+        """
+        Add a section of the body to the index of pass one of streaming mode, once its
+        score is final. A toolchange section is kept for the planner passes, cut down to
+        its last two lines that they insert their lines before.
+
+        :param section: the next section of the print
+        :param scores: score of each section so far
+        :param line_counts: line count of each gcode block so far, 0 for the other sections
+        """
+        index: int = len(scores)
+        scores.append(section.score)
+        line_counts.append(section.line_count() if section.gcode_block else 0)
+        if section.start_gcode:
+            self._start_gcode_index = index
+        self._last_tool = section.tool
+        self._toolchange_events.add_section(index, section, 0.0)
+        if section.toolchange_gcode and not section.initial_toolchange:
+            section.replace_lines(section.resolve_lines()[-2:])
+            self._indexed_sections[index] = section
+
+    def _build_streamed_score_index(self, scores: array, line_counts: array,
+                                    estimator: KinematicTimeEstimator | None,
+                                    anchors: ProgressMarkerAnchors | None) -> None:
+        """
+        Scale the scores of the gcode blocks gathered in pass one of streaming mode and
+        build the cumulative scores, the way the scoring stages and _build_score_index do
+        on the linked list.
+
+        :param scores: score of each section, the estimated move time for the gcode blocks
+            under the kinematic time model, turned into the cumulative scores
+        :param line_counts: line count of each gcode block, 0 for the other sections
+        :param estimator: the finished estimator under the kinematic time model
+        :param anchors: the progress markers under the progress marker time model
+        """
+        scale: float
+        scored: bool = False
+        if estimator is not None and estimator.total_time_s > 0.0:
+            # scale the estimated durations to the print time reported by the slicer
+            scale = self._score_tracker / estimator.total_time_s
+            for index in range(len(scores)):
+                if line_counts[index]:
+                    scores[index] *= scale
+            scored = True
+        elif anchors is not None and anchors.finish():
+            total_time_s: float = 0.0
+            line_count: int = 0
+            for index in range(len(scores)):
+                if line_counts[index]:
+                    end_line_count: int = line_count + line_counts[index]
+                    scores[index] = anchors.elapsed_at(end_line_count) - anchors.elapsed_at(line_count)
+                    total_time_s += scores[index]
+                    line_count = end_line_count
+            if total_time_s > 0.0:
+                # scale the interpolated durations to the time left for the gcode blocks
+                scale = self._score_tracker / total_time_s
+                for index in range(len(scores)):
+                    if line_counts[index]:
+                        scores[index] *= scale
+                scored = True
+        if not scored:
+            # score the gcode blocks in proportion to their number of lines
+            total_line_count: int = sum(line_counts)
+            for index in range(len(scores)):
+                if line_counts[index]:
+                    scores[index] = (line_counts[index] / total_line_count) * self._score_tracker
+        # the scores are turned into the cumulative scores in place
+        ascending: bool = True
+        total: float = 0.0
+        for index in range(len(scores)):
+            score: float = scores[index]
+            if score < 0:
+                # only happens when the print stats undercut the start and toolchange times
+                ascending = False
+            scores[index] = total
+            total += score
+        scores.append(total)
+        self._cumulative_scores = scores
+        self._cumulative_scores_ascending = ascending
+
+    def _stream_output_sections(self) -> Iterator[GcodeSection]:
+        """
+        Pass two of streaming mode: run the window stages over the body again and yield
+        its sections in print order, with the preheat sections planned in pass one and the
+        lines the planner passes added to the toolchange sections.
+        """
+        self._reset_section_stages()
+        index: int = 0
+        for current_section in self._process_body_windows(update_tool_configs=False):
+            for tool, temperature in self._planned_preheats.get(index, ()):
+                preheat_section: GcodeSection = GcodeSection('\n', current_section.tool)
+                self._add_preheat_lines(preheat_section, tool, temperature)
+                yield preheat_section
+            planned_section: GcodeSection | None = self._indexed_sections.get(index)
+            if planned_section is not None:
+                # the window stages rewrite the toolchange the same way in both passes
+                current_section.replace_lines(current_section.resolve_lines()[:-2] + planned_section.resolve_lines())
+            yield current_section
+            index += 1
+
+    def _has_tool_change_in_gcode(self) -> bool:
+        """
+        Checks if the gcode has a tool change. A print that uses more than one tool according
+        to the print stats has one, with a single tool the only one there can be is the
+        selection of that tool before the first layer.
+        """
+        metadata: GcodeMetadata = self._read_metadata()
+        if len(metadata.tools_used) > 1:
+            return True
+        first_layer: int = self._find_buffer_line(';LAYER_CHANGE') if metadata.filament_used else -1
+        return self._find_buffer_line('; custom gcode: toolchange_gcode',
+                                      end=first_layer if first_layer != -1 else None) != -1
+
+    def _is_already_processed(self) -> bool:
+        """
+        Checks if the gcode already contains the pre start gcode block added by this script,
+        which goes right before the print start custom gcode.
+        """
+        start_gcode: int = self._find_buffer_line('; custom gcode: start_gcode')
+        return self._find_buffer_line('; custom gcode: pre_start_gcode',
+                                      end=start_gcode if start_gcode != -1 else None) != -1
+
+    def _eliminate_blank_lines(self) -> None:
+        """
+        Eliminate blank lines from the raw lines list.
+        """
+        kept_offsets: array = array(self._raw_line_offsets.typecode)
+        for start in self._raw_line_offsets:
+            # only a line that begins with whitespace can be blank
+            if self._buffer[start:start + 1].isspace() and not self._buffer[start:self._raw_line_end(start)].strip():
+                continue
+            kept_offsets.append(start)
+        self._raw_line_offsets = kept_offsets
+
+    def _process_comments_and_images_at_start_of_file(self) -> None:
+        """
+        Takes all lines up to the first `M73` and immediately dumps them to output list
+        as these are comments and images that are not relevant to the script
+        """
+        idx_m73: int = self._find_line_index('M73')
+        self._output_spans.extend(self._raw_line_spans(0, idx_m73))
+        del self._raw_line_offsets[:idx_m73]
+
+    def _process_block_before_print_start(self) -> None:
+        """
+        Takes everything up to the start of the print start custom gcode section and
+        dumps it to the output list.
+        """
+        idx_start_gcode: int = self._find_line_index('; custom gcode: start_gcode')
+        self._output_spans.extend(self._raw_line_spans(0, idx_start_gcode))
+        del self._raw_line_offsets[:idx_start_gcode]
+
+    def _extract_slicer_configs_section(self) -> None:
+        """
+        Extracts the slicer configs from the end of the raw lines list.
+        """
+        # first find the line that starts with `; SuperSlicer_config = begin`, searching
+        # backwards from the end so that only the tail of the file is touched
+        idx_begin: int = len(self._raw_line_offsets)
+        config_start: int = self._buffer.rfind(('\n' + SS_CONFIG_BEGIN).encode(GCODE_ENCODING))
+        if config_start != -1:
+            idx_begin = bisect_left(self._raw_line_offsets, config_start + 1)
+        # then extract everything from there to the end, including the begin and end lines
+        self._ss_configs_section = self._raw_lines_between(idx_begin, len(self._raw_line_offsets))
+        self._ss_configs_spans = self._raw_line_spans(idx_begin, len(self._raw_line_offsets))
+        # then remove these lines from the raw lines list
+        del self._raw_line_offsets[idx_begin:]
+
+    def _parse_slicer_configs(self) -> None:
+        """
+        Parse the slicer configs section to extract relevant configs at the top level
+        as well as on a per-tool basis.
+        """
+        config: SlicerConfig = SlicerConfig(self._ss_configs_section)
+        self._slicer_config = config
+        # standby_temp_delta
+        self._standby_temp_delta = abs(config.get_int('standby_temperature_delta'))
+        # time_start_gcode
+        self._time_start_gcode = config.get_int('time_start_gcode')
+        # time_toolchange
+        self._time_toolchange = config.get_int('time_toolchange')
+        # find overall tool count using bed_temperature
+        self._tool_count_overall = len(config.get_int_list('bed_temperature'))
+        # create empty tool configs list
+        self._tool_configs = [ToolConfig(index=tool_number) for tool_number in range(self._tool_count_overall)]
+        # parse individual tool_configs
+        for i, temp in enumerate(config.get_int_list('bed_temperature')):
+            self._tool_configs[i].bed_temperature = temp
+        for i, temp in enumerate(config.get_int_list('chamber_temperature')):
+            self._tool_configs[i].chamber_temperature = temp
+        for i, temp in enumerate(config.get_int_list('first_layer_bed_temperature')):
+            self._tool_configs[i].first_layer_bed_temperature = temp
+        for i, temp in enumerate(config.get_int_list('first_layer_temperature')):
+            self._tool_configs[i].first_layer_temperature = temp
+        for i, temp in enumerate(config.get_int_list('temperature')):
+            self._tool_configs[i].temperature = temp
+        # parse the machine limits for the kinematic time model
+        limits: MachineLimits = self._machine_limits
+        limits.relative_e_distances = config.get_bool('use_relative_e_distances', limits.relative_e_distances)
+        limits.max_acceleration_extruding = config.get_float('machine_max_acceleration_extruding', limits.max_acceleration_extruding)
+        limits.max_acceleration_retracting = config.get_float('machine_max_acceleration_retracting', limits.max_acceleration_retracting)
+        limits.max_acceleration_travel = config.get_float('machine_max_acceleration_travel', limits.max_acceleration_travel)
+        limits.max_acceleration = tuple(
+            config.get_float(f'machine_max_acceleration_{axis}', default) for axis, default in zip('xyze', limits.max_acceleration)
+        )  # type: ignore
+        limits.max_feedrate = tuple(
+            config.get_float(f'machine_max_feedrate_{axis}', default) for axis, default in zip('xyze', limits.max_feedrate)
+        )  # type: ignore
+        limits.max_jerk = config.get_float('machine_max_jerk_x', limits.max_jerk)
+
+    def _extract_print_stats_section(self) -> None:
+        """
+        Extracts the print stats from the raw lines list. When this is called this will
+        consist of the block of comments at the end of the raw lines
+        """
+        # iterate through the raw lines list starting from the end
+        idx_stats: int = len(self._raw_line_offsets)
+        while self._raw_line_startswith(idx_stats - 1, '; ') or len(self._raw_line(idx_stats - 1).strip()) == 0:
+            idx_stats -= 1
+        self._print_stats_section = self._raw_lines_between(idx_stats, len(self._raw_line_offsets))
+        self._print_stats_spans = self._raw_line_spans(idx_stats, len(self._raw_line_offsets))
+        del self._raw_line_offsets[idx_stats:]
+
+    def _parse_print_stats(self) -> None:
+        """
+        Parse the print stats section.
+        """
+        self._layer_count = parse_layer_count(self._print_stats_section)
+        self._print_time_s = parse_print_time(self._print_stats_section)
+
+    def _extract_end_gcode_section(self) -> None:
+        """
+        Extracts the end of print section from the bottom of the raw lines list since this
+        is not going to be modified by the script.
+        """
+        # find the M107 line, there should be only one
+        idx_m107: int = self._find_line_index('M107')
+        # extract the M107 line and anything after it
+        self._end_print_spans = self._raw_line_spans(idx_m107, len(self._raw_line_offsets))
+        # remove the M107 line from the raw lines list and anything after it
+        del self._raw_line_offsets[idx_m107:]
+    
+    def _find_tools_used_in_print(self, body_start: int | None = None, body_end: int | None = None) -> None:
+        """
+        Find the tools used in the print.
+
+        :param body_start: buffer offset of the start of the body, defaults to the first raw line
+        :param body_end: buffer offset of the end of the body, defaults to the end of the last raw line
+        """
+        # only blank lines have been dropped from the body so far, so it can be searched as a whole
+        if body_start is None or body_end is None:
+            body_start = self._raw_line_offsets[0]
+            body_end = self._raw_line_end(self._raw_line_offsets[-1])
+        for tool in range(self._tool_count_overall):
+            tool_name = f'T{tool}'.encode(GCODE_ENCODING)
+            if self._scan_buffer(tool_name, body_start, body_end) != -1:
+                self._tool_configs[tool].tool_used = True
+
+    def _eliminate_ss_pre_toolchange_tool_temp_drop(self) -> None:
+        """
+        SS automatically adds a temperature drop to the current tool immediately before
+        a tool change, this eliminates those temperature commands so that this script 
+        can perform its own temperature management.
+        """
+        drop_lines: list[int] = []
+        idx_toolchange: int = self._find_line_index('; custom gcode: toolchange_gcode')
+        while idx_toolchange < len(self._raw_line_offsets):
+            if idx_toolchange > 0 and \
+                    self._raw_line(idx_toolchange).strip() == '; custom gcode: toolchange_gcode' and \
+                    self._raw_line_startswith(idx_toolchange - 1, 'M104'):
+                drop_lines.append(idx_toolchange - 1)
+            idx_toolchange = self._find_line_index('; custom gcode: toolchange_gcode', idx_toolchange + 1)
+        self._drop_raw_lines(drop_lines)
     
     def _eliminate_ss_post_start_filament_tool_temp_set(self) -> None:
         """
@@ -437,63 +2202,93 @@ class ToolchangerPostprocessor:
         This eliminates those temperature commands so that this script can perform its own
         temperature management.
         """
-        output_lines: list[str] = []
-        for i, line in enumerate(self._raw_lines):
-            if line.startswith('M109'):
-                prev_line_check = (i - 1 >= 0 and 
-                                 self._raw_lines[i - 1].startswith('; custom gcode end: start_filament_gcode'))
-                if prev_line_check:
-                    continue
-            output_lines.append(line)
-        self._raw_lines = output_lines
-
-    def _process_start_filament_gcode_blocks_for_tool_parameters(self) -> None:
-        """
-        Process the start filament gcode blocks for tool parameters.
-        """
-        for i in range(len(self._raw_lines)):
-            if self._raw_lines[i].startswith('; custom gcode: start_filament_gcode'):
-                open_line: int = i
-                while not self._raw_lines[i].startswith('; custom gcode end: start_filament_gcode'):
-                    i += 1
-                close_line: int = i
-                # check if the block is empty
-                if open_line == close_line - 1:
-                    # delete this block
-                    self._raw_lines.pop(open_line)
-                    self._raw_lines.pop(open_line)
-                    # if here, then we deleted lines and want to start this from the beginning
-                    return self._process_start_filament_gcode_blocks_for_tool_parameters()
-                # now process the lines between open and close
-                delete_lines: list[int] = []
-                extruder_number: int = -1
-                warmup_time_s: int = -1
-                dormant_time_s: int = -1
-                warmup_from_off_time_s: int = -1
-                clean_nozzle_on_first_use: bool = CFG_DEFAULT_CLEAN_ON_FIRST_USE
-                clean_nozzle_on_toolchange: bool = CFG_DEFAULT_CLEAN_ON_EVERY_TOOLCHANGE
-                for j in range(open_line, close_line):
-                    if self._raw_lines[j].startswith('EXTRUDER='):
-                        extruder_number = int(self._raw_lines[j].split('=')[1].strip())
-                        delete_lines.append(j)
-                    elif self._raw_lines[j].startswith('WARMUP_TIME='):
-                        warmup_time_s = int(self._raw_lines[j].split('=')[1].strip())
-                        delete_lines.append(j)
-                    elif self._raw_lines[j].startswith('WARMUP_FROM_OFF_TIME='):
-                        warmup_from_off_time_s = int(self._raw_lines[j].split('=')[1].strip())
-                        delete_lines.append(j)
-                    elif self._raw_lines[j].startswith('DORMANT_TIME='):
-                        dormant_time_s = int(self._raw_lines[j].split('=')[1].strip())
-                        delete_lines.append(j)
-                    elif self._raw_lines[j].startswith('CLEAN_ON_FIRST_USE='):
-                        clean_nozzle_on_first_use = self._raw_lines[j].split('=')[1].strip() == 'True'
-                        delete_lines.append(j)
-                    elif self._raw_lines[j].startswith('CLEAN_ON_EVERY_TOOLCHANGE='):
-                        clean_nozzle_on_toolchange = self._raw_lines[j].split('=')[1].strip() == 'True'
-                        delete_lines.append(j)
-                if extruder_number == -1 and warmup_time_s == -1 and dormant_time_s == -1 and warmup_from_off_time_s == -1:
-                    # no params in this block, so just move on
-                    continue
+        drop_lines: list[int] = []
+        idx_block_end: int = self._find_line_index('; custom gcode end: start_filament_gcode')
+        while idx_block_end < len(self._raw_line_offsets):
+            if idx_block_end + 1 < len(self._raw_line_offsets) and \
+                    self._raw_line_startswith(idx_block_end + 1, 'M109'):
+                drop_lines.append(idx_block_end + 1)
+            idx_block_end = self._find_line_index('; custom gcode end: start_filament_gcode', idx_block_end + 1)
+        self._drop_raw_lines(drop_lines)
+
+    def _process_start_filament_gcode_blocks_for_tool_parameters(self, update_tool_configs: bool = True) -> None:
+        """
+        Process the start filament gcode blocks for tool parameters. The blocks are walked
+        once in file order, so later blocks override earlier ones, and every consumed line
+        is dropped in a single rebuild at the end.
+
+        :param update_tool_configs: set the tool parameters on the tool configs, the second
+            pass of streaming mode only drops the lines as the first pass has read them
+        """
+        drop_lines: list[int] = []
+        line_count: int = len(self._raw_line_offsets)
+        open_line: int = self._find_line_index('; custom gcode: start_filament_gcode')
+        while open_line < line_count:
+            close_line: int = self._find_line_index('; custom gcode end: start_filament_gcode', open_line + 1)
+            if close_line == line_count:
+                # unterminated block, leave it alone
+                break
+            # now process the lines between open and close
+            delete_lines: list[int] = []
+            extruder_number: int = -1
+            warmup_time_s: int = -1
+            dormant_time_s: int = -1
+            warmup_from_off_time_s: int = -1
+            clean_nozzle_on_first_use: bool = CFG_DEFAULT_CLEAN_ON_FIRST_USE
+            clean_nozzle_on_toolchange: bool = CFG_DEFAULT_CLEAN_ON_EVERY_TOOLCHANGE
+            heater_parameters: dict[str, float] = {}
+            standby_temperatures: list[int] = []
+            max_standby_temperature: int = -1
+            max_standby_soak_time_s: float = inf
+            for j in range(open_line + 1, close_line):
+                if self._raw_line_startswith(j, 'EXTRUDER='):
+                    extruder_number = int(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'WARMUP_TIME='):
+                    warmup_time_s = int(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'WARMUP_FROM_OFF_TIME='):
+                    warmup_from_off_time_s = int(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'DORMANT_TIME='):
+                    dormant_time_s = int(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'CLEAN_ON_FIRST_USE='):
+                    clean_nozzle_on_first_use = self._raw_line(j).split('=')[1].strip() == 'True'
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'CLEAN_ON_EVERY_TOOLCHANGE='):
+                    clean_nozzle_on_toolchange = self._raw_line(j).split('=')[1].strip() == 'True'
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'HEATER_MAX_TEMP='):
+                    heater_parameters['max_temperature'] = float(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'HEATER_TIME_CONSTANT='):
+                    heater_parameters['heat_time_constant_s'] = float(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'COOLING_TIME_CONSTANT='):
+                    heater_parameters['cool_time_constant_s'] = float(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'AMBIENT_TEMP='):
+                    heater_parameters['ambient_temperature'] = float(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'STANDBY_TEMPS='):
+                    standby_temperatures = [int(value) for value in self._raw_line(j).split('=')[1].split(',') if value.strip()]
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'MAX_STANDBY_TEMP='):
+                    max_standby_temperature = int(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+                elif self._raw_line_startswith(j, 'MAX_STANDBY_SOAK_TIME='):
+                    max_standby_soak_time_s = float(self._raw_line(j).split('=')[1].strip())
+                    delete_lines.append(j)
+            if extruder_number == -1 and warmup_time_s == -1 and dormant_time_s == -1 and warmup_from_off_time_s == -1 \
+                    and not heater_parameters and not standby_temperatures:
+                # no params in this block, keep its lines but still drop it if it is empty
+                delete_lines = []
+            elif extruder_number == -1:
+                # the params cannot be matched to a tool, so do not guess one
+                raise ValueError(f'the start_filament_gcode block at line {open_line + 1} sets tool parameters '
+                                 f'without an EXTRUDER={{current_extruder}} line')
+            elif update_tool_configs:
                 # now add the tool config
                 if warmup_time_s >= 0:
                     self._tool_configs[extruder_number].warmup_time_s = warmup_time_s
@@ -511,126 +2306,296 @@ class ToolchangerPostprocessor:
                     clean_nozzle_on_first_use = True
                 self._tool_configs[extruder_number].clean_nozzle_on_first_use = clean_nozzle_on_first_use
                 self._tool_configs[extruder_number].clean_nozzle_on_toolchange = clean_nozzle_on_toolchange
-                # now sort the delete lines descending
-                delete_lines.sort(reverse=True)
-                # now delete the lines
-                for line_idx in delete_lines:
-                    self._raw_lines.pop(line_idx)
-                # if here, then we deleted lines and want to start this from the beginning
-                return self._process_start_filament_gcode_blocks_for_tool_parameters()
+                # any heater parameter turns on the heater model for the tool
+                if heater_parameters:
+                    self._tool_configs[extruder_number].heater = HeaterModel(**heater_parameters)
+                # candidate standby temperatures turn on the standby planner for the tool
+                self._tool_configs[extruder_number].standby_temperatures = standby_temperatures
+                self._tool_configs[extruder_number].max_standby_temperature = max_standby_temperature
+                self._tool_configs[extruder_number].max_standby_soak_time_s = max_standby_soak_time_s
+            if len(delete_lines) == close_line - open_line - 1:
+                # nothing is left in this block, so delete the whole block
+                drop_lines.extend(range(open_line, close_line + 1))
+            else:
+                drop_lines.extend(delete_lines)
+            open_line = self._find_line_index('; custom gcode: start_filament_gcode', close_line + 1)
+        self._drop_raw_lines(drop_lines)
 
     def _extract_basic_start_info(self) -> None:
         """Extract the basic start info from the raw start section list."""
         # find the toolchange gcode block in the raw start lines and extract the tool number to get initial tool
-        in_toolchange_gcode_block: bool = False
-        for line in self._raw_lines:
-            if line.startswith('; custom gcode: toolchange_gcode'):
-                in_toolchange_gcode_block = True
-                continue
-            if in_toolchange_gcode_block:
-                if line.startswith('NEXT_TOOL'):
-                    self._track_current_tool = int(line.split('=')[1].strip())
-                    break
+        idx_toolchange: int = self._find_line_index('; custom gcode: toolchange_gcode')
+        idx_next_tool: int = self._find_line_index('NEXT_TOOL', idx_toolchange + 1)
+        if idx_next_tool < len(self._raw_line_offsets):
+            self._track_current_tool = int(self._raw_line(idx_next_tool).split('=')[1].strip())
+
+    def _tokenize_raw_lines(self) -> Iterator[tuple[SectionKind, int, int]]:
+        """
+        Walks the raw lines once with an index cursor and yields the section boundaries.
+
+        :return: iterator of (kind, start index, end index) tuples, the end is exclusive
+        """
+        buffer: bytes | mmap = self._buffer
+        offsets: array = self._raw_line_offsets
+        line_count: int = len(offsets)
+        lines_end: int = self._raw_line_end(offsets[-1]) if offsets else 0
+        cursor: int = 0
+        while cursor < line_count:
+            start: int = cursor
+            line_start: int = offsets[cursor]
+            cursor += 1
+            # classify the line on a short copy of its first bytes
+            line_head: bytes = buffer[line_start:line_start + LINE_HEAD_LENGTH]
+            if line_head.startswith(b'; custom gcode: start_gcode'):
+                # everything up to and including the end of the start gcode block
+                cursor = min(self._find_line_index('; custom gcode end: start_gcode', cursor) + 1, line_count)
+                yield SectionKind.START_GCODE, start, cursor
+            elif line_head.startswith(b'G1'):
+                # all of the consecutive lines that start with G1, matched in one go
+                run = G1_RUN_PATTERN.match(buffer, line_start)
+                if run is not None:
+                    cursor = bisect_left(offsets, run.end(), cursor)
+                yield SectionKind.GCODE_BLOCK, start, cursor
+            elif line_head.startswith(b'; custom gcode: toolchange_gcode'):
+                # everything up to and including the end of the toolchange gcode block
+                cursor = min(self._find_line_index('; custom gcode end: toolchange_gcode', cursor) + 1, line_count)
+                yield SectionKind.TOOLCHANGE_GCODE, start, cursor
+            elif line_head.startswith(b';LAYER_CHANGE'):
+                # the layer change comment and the two comment lines that follow it
+                cursor = min(cursor + 2, line_count)
+                yield SectionKind.LAYER_CHANGE_COMMENTS, start, cursor
+            elif line_head.startswith(b'; custom gcode: layer_gcode'):
+                # everything up to and including the end of the layer change gcode block
+                cursor = min(self._find_line_index('; custom gcode end: layer_gcode', cursor) + 1, line_count)
+                yield SectionKind.LAYER_CHANGE_GCODE, start, cursor
+            elif line_head.startswith(TEMPERATURE_COMMANDS):
+                # all of the consecutive temperature setting lines
+                while cursor < line_count and buffer[offsets[cursor]:offsets[cursor] + 4] in TEMPERATURE_COMMANDS:
+                    cursor += 1
+                yield SectionKind.TEMPERATURE_BLOCK, start, cursor
+            else:
+                # non-special comment lines or unscored gcode lines, up to the next line that
+                # starts a section of another kind, are one section so that the number of
+                # sections does not grow with every comment in the file
+                following = SECTION_START_PATTERN.search(buffer, line_start, lines_end)
+                if following is None:
+                    cursor = line_count
+                else:
+                    cursor = bisect_left(offsets, following.start() + 1, cursor)
+                yield SectionKind.OTHER, start, cursor
 
     def _parse_raw_lines_into_sections(self) -> None:
         """
         Parse the raw lines into sections.
         """
-        new_section: GcodeSection | None = None
-        initial_toolchange_found: bool = False
-        initial_temperature_block_found: bool = False
-        while len(self._raw_lines) > 0:
-            # grab the top line
-            line: str = self._raw_lines.pop(0)
-            if line.startswith('; custom gcode: start_gcode'):
-                # start of start gcode section
-                new_section = self._insert_new_section_at_end(line)
+        new_section: GcodeSection
+        for kind, start, end in self._tokenize_raw_lines():
+            new_section = self._insert_new_section_at_end(None)
+            self._reference_raw_lines(new_section, start, end)
+            if kind == SectionKind.START_GCODE:
                 # mark it as start gcode
                 new_section.start_gcode = True
-                # now add all the lines that start with G1
-                while not self._raw_lines[0].startswith('; custom gcode end: start_gcode'):
-                    new_section.add_line(self._raw_lines.pop(0))
-                # add the closing block
-                new_section.add_line(self._raw_lines.pop(0))
-                continue
-            if line.startswith('G1'):
-                # start of standard gcode section
-                new_section = self._insert_new_section_at_end(line)
+            elif kind == SectionKind.GCODE_BLOCK:
                 # mark it as gcode block
                 new_section.gcode_block = True
-                # now add all the lines that start with G1
-                while len(self._raw_lines) > 0 and self._raw_lines[0].startswith('G1'):
-                    new_section.add_line(self._raw_lines.pop(0))
-                continue
-            if line.startswith('; custom gcode: toolchange_gcode'):
-                # start of custom toolchange gcode section
-                new_section = self._insert_new_section_at_end(line)
+            elif kind == SectionKind.TOOLCHANGE_GCODE:
                 # mark it as toolchange gcode
                 new_section.toolchange_gcode = True
                 # mark it as initial toolchange
-                if not initial_toolchange_found:
+                if not self._initial_toolchange_found:
                     new_section.initial_toolchange = True
-                    initial_toolchange_found = True
-                # now add all the up to and including the end of the toolchange gcode block
-                while not self._raw_lines[0].startswith('; custom gcode end: toolchange_gcode'):
-                    new_section.add_line(self._raw_lines.pop(0))
-                # add the closing block
-                new_section.add_line(self._raw_lines.pop(0))
+                    self._initial_toolchange_found = True
                 # determine the next tool to update the tracker
                 for line in new_section.resolve_lines():
                     if line.startswith('NEXT_TOOL'):
                         self._track_current_tool = int(line.split('=')[1].strip())
                         break
-                continue
-            if line.startswith(';LAYER_CHANGE'):
-                # parse layer change comments
-                # start of layer change section
-                new_section = self._insert_new_section_at_end(line)
+            elif kind == SectionKind.LAYER_CHANGE_COMMENTS:
                 # mark it as layer change comments
                 new_section.layer_change_comments = True
-                new_section.add_line(self._raw_lines.pop(0))
-                # add the next line to the section
-                new_section.add_line(self._raw_lines.pop(0))
-                initial_layer_change_found = True
-                continue
-            if line.startswith('; custom gcode: layer_gcode'):
-                # start of custom toolchange gcode section
-                new_section = self._insert_new_section_at_end(line)
+            elif kind == SectionKind.LAYER_CHANGE_GCODE:
                 # mark it as layer change gcode
                 new_section.layer_change_gcode = True
-                # now add all the up to and including the end of the layer change gcode block
-                while not self._raw_lines[0].startswith('; custom gcode end: layer_gcode'):
-                    new_section.add_line(self._raw_lines.pop(0))
-                # add the closing block
-                new_section.add_line(self._raw_lines.pop(0))
-                continue
-            if (line.startswith('M104') or line.startswith('M109') or line.startswith('M140') or line.startswith('M190')) and not initial_temperature_block_found:
-                # start of second layer temperature block
-                new_section = self._insert_new_section_at_end(line)
-                # mark it as initial temperature block
-                new_section.initial_temperature_block = True
-                initial_temperature_block_found = True
-                # now add all the up to and including the end of the second layer temperature block
-                while self._raw_lines[0].startswith('M104') or \
-                        self._raw_lines[0].startswith('M140') or \
-                        self._raw_lines[0].startswith('M109') or \
-                        self._raw_lines[0].startswith('M190'):
-                    new_section.add_line(self._raw_lines.pop(0))
-                continue
-            if (line.startswith('M104') or line.startswith('M109') or line.startswith('M140') or line.startswith('M190')):
-                # start of second layer temperature block
-                new_section = self._insert_new_section_at_end(line)
-                # mark it as second layer temperature block
-                new_section.second_layer_temperature_block = True
-                # now add all the up to and including the end of the second layer temperature block
-                while self._raw_lines[0].startswith('M104') or \
-                        self._raw_lines[0].startswith('M140') or \
-                        self._raw_lines[0].startswith('M109') or \
-                        self._raw_lines[0].startswith('M190'):
-                    new_section.add_line(self._raw_lines.pop(0))
-                continue
-            # for all other lines, non-special comment lines or unscored gcode line
-            self._insert_new_section_at_end(line)
+            elif kind == SectionKind.TEMPERATURE_BLOCK:
+                # the first temperature block is the initial one, all others are second layer ones
+                if not self._initial_temperature_block_found:
+                    new_section.initial_temperature_block = True
+                    self._initial_temperature_block_found = True
+                else:
+                    new_section.second_layer_temperature_block = True
+        # all raw lines now belong to sections, only the buffer itself is still needed
+        self._raw_line_offsets = array(self._raw_line_offsets.typecode)
+
+    # raw line helpers
+
+    def _raw_line(self, index: int) -> str:
+        """
+        Copy a single raw line out of the buffer and decode it.
+
+        :param index: index of the raw line
+        :return: the line, including its line ending
+        """
+        start: int = self._raw_line_offsets[index]
+        return self._buffer[start:self._raw_line_end(start)].decode(GCODE_ENCODING)
+
+    def _raw_line_startswith(self, index: int, prefix: str) -> bool:
+        """
+        Check the start of a raw line without decoding it.
+
+        :param index: index of the raw line
+        :param prefix: the prefix to check for
+        """
+        return buffer_startswith(self._buffer, prefix.encode(GCODE_ENCODING), self._raw_line_offsets[index])
+
+    def _raw_line_end(self, start: int) -> int:
+        """
+        Find the end of the line that starts at the given buffer offset.
+
+        :param start: buffer offset of the start of the line
+        :return: buffer offset one past the line ending
+        """
+        newline: int = self._buffer.find(b'\n', start)
+        return len(self._buffer) if newline == -1 else newline + 1
+
+    def _raw_lines_between(self, start: int, end: int) -> list[str]:
+        """
+        Copy a range of raw lines out of the buffer.
+
+        :param start: index of the first raw line
+        :param end: index one past the last raw line
+        """
+        return [self._raw_line(i) for i in range(start, end)]
+
+    def _raw_line_spans(self, start: int, end: int) -> list[tuple[int, int]]:
+        """
+        Describe a range of raw lines as spans of the buffer, without copying them out. Lines
+        that follow each other in the buffer share a span, so only dropped lines split it.
+
+        :param start: index of the first raw line
+        :param end: index one past the last raw line
+        :return: (start, end) buffer offsets of the runs of lines
+        """
+        spans: list[tuple[int, int]] = []
+        for i in range(start, end):
+            line_start: int = self._raw_line_offsets[i]
+            line_end: int = self._raw_line_end(line_start)
+            if spans and spans[-1][1] == line_start:
+                spans[-1] = (spans[-1][0], line_end)
+            else:
+                spans.append((line_start, line_end))
+        return spans
+
+    def _find_buffer_line(self, prefix: str, start: int = 0, end: int | None = None) -> int:
+        """
+        Find the first line in the buffer at or after the given offset that starts with
+        the given prefix.
+
+        :param prefix: the prefix to look for
+        :param start: buffer offset of a line start to search from
+        :param end: buffer offset of a line start to stop searching at, the end of the buffer by default
+        :return: buffer offset of the matching line, or -1 if none matches
+        """
+        encoded_prefix: bytes = prefix.encode(GCODE_ENCODING)
+        if start == 0 and buffer_startswith(self._buffer, encoded_prefix, 0):
+            return 0
+        found: int = self._scan_buffer(b'\n' + encoded_prefix, max(start - 1, 0), end)
+        return -1 if found == -1 else found + 1
+
+    def _scan_buffer(self, pattern: bytes, start: int = 0, end: int | None = None) -> int:
+        """
+        Find a pattern in a range of the buffer. In streaming mode a long range is searched
+        a chunk at a time, dropping the pages of each chunk once it is searched, so that a
+        scan across the body does not keep the whole file in memory.
+
+        :param pattern: the bytes to look for
+        :param start: buffer offset to search from
+        :param end: buffer offset to stop searching at, the end of the buffer by default
+        :return: buffer offset of the first match, or -1 if there is none
+        """
+        if end is None:
+            end = len(self._buffer)
+        if not self._stream:
+            return self._buffer.find(pattern, start, end)
+        while start < end:
+            chunk_end: int = min(start + FILE_CHUNK_SIZE, end)
+            # the chunks overlap by the length of the pattern so that a match across the boundary is found
+            found: int = self._buffer.find(pattern, start, min(chunk_end + len(pattern) - 1, end))
+            self._release_pages(start, chunk_end)
+            if found != -1:
+                return found
+            start = chunk_end
+        return -1
+
+    def _release_pages(self, start: int, end: int) -> None:
+        """
+        Drop the pages of a range of the mapped input from memory in streaming mode, they
+        are read back from the file if the range is used again.
+
+        :param start: buffer offset of the start of the range
+        :param end: buffer offset of the end of the range
+        """
+        if not self._stream or MADV_DONTNEED == -1 or not isinstance(self._buffer, mmap):
+            return
+        start -= start % PAGESIZE
+        end = min(end, len(self._buffer))
+        if start < end:
+            self._buffer.madvise(MADV_DONTNEED, start, end - start)
+
+    def _find_line_index(self, prefix: str, start: int = 0) -> int:
+        """
+        Find the index of the first raw line at or after `start` that starts with the
+        given prefix.
+
+        :param prefix: the prefix to look for
+        :param start: the index to start searching from
+        :return: index of the matching line, or the number of raw lines if none matches
+        """
+        offsets: array = self._raw_line_offsets
+        if start >= len(offsets):
+            return len(offsets)
+        search_from: int = offsets[start]
+        # lines past the last raw line cannot match, so the search stops there
+        search_end: int = self._raw_line_end(offsets[-1])
+        while True:
+            found: int = self._find_buffer_line(prefix, search_from, search_end)
+            if found == -1:
+                return len(offsets)
+            index: int = bisect_left(offsets, found, start)
+            if index == len(offsets) or offsets[index] == found:
+                return index
+            # the match is on a line that has already been dropped, keep looking
+            search_from = found + 1
+
+    def _drop_raw_lines(self, indices: list[int]) -> None:
+        """
+        Drop raw lines in a single rebuild of the offsets array.
+
+        :param indices: ascending indices of the raw lines to drop
+        """
+        if not indices:
+            return
+        kept_offsets: array = array(self._raw_line_offsets.typecode)
+        previous: int = 0
+        for index in indices:
+            kept_offsets.extend(self._raw_line_offsets[previous:index])
+            previous = index + 1
+        kept_offsets.extend(self._raw_line_offsets[previous:])
+        self._raw_line_offsets = kept_offsets
+
+    def _reference_raw_lines(self, section: GcodeSection, start: int, end: int) -> None:
+        """
+        Point a section at a range of raw lines in the buffer. If lines have been dropped
+        from within that range the section gets its own copy of the remaining lines.
+
+        :param section: the section to populate
+        :param start: index of the first raw line
+        :param end: index one past the last raw line
+        """
+        span_start: int = self._raw_line_offsets[start]
+        span_end: int = self._raw_line_end(self._raw_line_offsets[end - 1])
+        section.reference_lines(self._buffer, span_start, span_end)
+        if section.line_count() != end - start:
+            section.replace_lines(self._raw_lines_between(start, end))
 
     def _process_start_section(self) -> None:
         """
@@ -685,6 +2650,7 @@ class ToolchangerPostprocessor:
         current_section.score = self._time_start_gcode
         # get the first tool from the start gcode section
         first_tool = current_section.tool
+        self._first_tool = first_tool
         # now replace the lines in the start gcode section with a simple PRINT_START call
         new_section = []
         new_section.append(f'; custom gcode: start_gcode\n')
@@ -789,22 +2755,13 @@ class ToolchangerPostprocessor:
 
     def _process_second_layer_changes(self) -> None:
         """
-        Process the second layer changes.
+        Process the second layer changes. The sections up to the first second layer
+        temperature block are marked as using first layer temperatures and the sections
+        from there on as using other layer temperatures, and that block is replaced. In
+        streaming mode this runs for every window and picks up where the last one left off.
         """
         current_section: GcodeSection
-        # first go through all sections and mark them as first_layer_temps_used or other_layer_temps_used
-        current_section = self._first_section
-        in_first_layer_temps: bool = True
-        while current_section is not None:
-            if current_section.second_layer_temperature_block:
-                in_first_layer_temps = False
-            if in_first_layer_temps:
-                current_section.first_layer_temps_used = True
-            else:
-                current_section.other_layer_temps_used = True
-            current_section = current_section.next_section
-
-        # next, find the maximum other layer bed temperature for all tools used in the print
+        # first, find the maximum other layer bed temperature for all tools used in the print
         max_other_layer_bed_temp: int = 0
         for tool_config in self._tool_configs:
             if not tool_config.tool_used:
@@ -812,46 +2769,49 @@ class ToolchangerPostprocessor:
             if tool_config.bed_temperature > max_other_layer_bed_temp:
                 max_other_layer_bed_temp = tool_config.bed_temperature
 
-        # next, find the second layer temperature block
+        # next, go through all sections and mark them as first_layer_temps_used or other_layer_temps_used
         current_section = self._first_section
-        while not current_section.second_layer_temperature_block:
+        while current_section is not None:
+            if current_section.second_layer_temperature_block and not self._second_layer_found:
+                self._second_layer_found = True
+                # create a new section to contain the second layer temperature block
+                new_section = []
+                # add line for marking the section
+                new_section.append(f'\n')
+                new_section.append(f'; custom gcode: second_layer_temperature\n')
+                # add line for setting bed temperature (without wait)
+                new_section.append(f'M140 S{max_other_layer_bed_temp} ; set bed temperature\n')
+                # add line for the current tool to be set to the other layer temperature
+                new_section.append(f'M104 S{self._tool_configs[current_section.tool].temperature} T{current_section.tool} ; set tool temperature\n')
+                # add closing block
+                new_section.append(f'; custom gcode end: second_layer_temperature\n')
+                new_section.append('\n')
+                # now replace the lines in the second layer temperature block
+                current_section.replace_lines(new_section)
+            if self._second_layer_found:
+                current_section.other_layer_temps_used = True
+            else:
+                current_section.first_layer_temps_used = True
             current_section = current_section.next_section
 
-        # next, create a new section to contain the second layer temperature block
-        new_section = []
-        # add line for marking the section
-        new_section.append(f'\n')
-        new_section.append(f'; custom gcode: second_layer_temperature\n')
-        # add line for setting bed temperature (without wait)
-        new_section.append(f'M140 S{max_other_layer_bed_temp} ; set bed temperature\n')
-        # add line for the current tool to be set to the other layer temperature
-        new_section.append(f'M104 S{self._tool_configs[current_section.tool].temperature} T{current_section.tool} ; set tool temperature\n')
-        # add closing block
-        new_section.append(f'; custom gcode end: second_layer_temperature\n')
-        new_section.append('\n')
-        # now replace the lines in the second layer temperature block
-        current_section.replace_lines(new_section)
-
     def _process_toolchange_sections(self) -> None:
         """
         Process the toolchange sections.
         """
         current_section: GcodeSection
-        tools_encountered: set[int] = set()
         # go through all sections and find the toolchange sections
         current_section = self._first_section
-        skipped_first_toolchange: bool = False
         if not self._has_first_toolchange:
-            skipped_first_toolchange = True  # otherwise the first toolchange will be skipped, so we need to mark it as skipped to prevent it from being skipped
+            self._skipped_first_toolchange = True  # otherwise the first toolchange will be skipped, so we need to mark it as skipped to prevent it from being skipped
         while current_section is not None:
-            if current_section.toolchange_gcode and not skipped_first_toolchange:
-                skipped_first_toolchange = True
+            if current_section.toolchange_gcode and not self._skipped_first_toolchange:
+                self._skipped_first_toolchange = True
                 current_section = current_section.next_section
                 continue
             first_use: bool = False
             if current_section.toolchange_gcode:
-                if current_section.tool not in tools_encountered:
-                    tools_encountered.add(current_section.tool)
+                if current_section.tool not in self._tools_encountered:
+                    self._tools_encountered.add(current_section.tool)
                     first_use = True
                 else:
                     first_use = False
@@ -883,7 +2843,7 @@ class ToolchangerPostprocessor:
                 # determine if we need to add a clean nozzle command
                 if self._tool_configs[current_section.incoming_tool].clean_nozzle_on_toolchange:
                     new_section.append(f'CLEAN_NOZZLE ; clean nozzle\n')
-                elif first_use and not self._first_section.tool == current_section.incoming_tool and self._tool_configs[current_section.incoming_tool].clean_nozzle_on_first_use:
+                elif first_use and not self._first_tool == current_section.incoming_tool and self._tool_configs[current_section.incoming_tool].clean_nozzle_on_first_use:
                     new_section.append(f'CLEAN_NOZZLE ; clean nozzle\n')
                 # NOTE: clean nozzle logic for tools heated from off is handled in the deselect temperature logic function below
                 # append the last line from the original section
@@ -896,6 +2856,79 @@ class ToolchangerPostprocessor:
         """
         Score the gcode blocks, these scores are approximated durations.
         """
+        if self._time_model == TimeModel.KINEMATIC and self._score_gcode_blocks_by_move_time():
+            return
+        if self._time_model == TimeModel.PROGRESS_MARKERS and self._score_gcode_blocks_by_progress_markers():
+            return
+        self._score_gcode_blocks_by_line_count()
+
+    def _score_gcode_blocks_by_move_time(self) -> bool:
+        """
+        Score the gcode blocks by the estimated duration of their moves, scaled so that
+        they add up to the time of the print that is not spent in the start and toolchange
+        gcode.
+
+        :return: False if there are no moves to estimate
+        """
+        estimator: KinematicTimeEstimator = KinematicTimeEstimator(self._machine_limits)
+        current_section: GcodeSection = self._first_section
+        while current_section is not None:
+            estimator.add_section(current_section)
+            current_section = current_section.next_section
+        estimator.finish()
+        if estimator.total_time_s <= 0.0:
+            return False
+        # scale the estimated durations to the print time reported by the slicer
+        scale: float = self._score_tracker / estimator.total_time_s
+        current_section = self._first_section
+        while current_section is not None:
+            if current_section.gcode_block:
+                current_section.score *= scale
+            current_section = current_section.next_section
+        return True
+
+    def _score_gcode_blocks_by_progress_markers(self) -> bool:
+        """
+        Score the gcode blocks from the M73 progress markers in the print. Each marker that
+        changes the progress pins the elapsed time at its position, in between markers the
+        time is spread by line count. The scores are scaled so that they add up to the
+        time of the print that is not spent in the start and toolchange gcode.
+
+        :return: False if there are no progress markers to go by
+        """
+        anchors: ProgressMarkerAnchors = ProgressMarkerAnchors(self._print_time_s)
+        current_section: GcodeSection = self._first_section
+        while current_section is not None:
+            anchors.add_section(current_section)
+            current_section = current_section.next_section
+        if not anchors.finish():
+            return False
+
+        total_time_s: float = 0.0
+        line_count: int = 0
+        current_section = self._first_section
+        while current_section is not None:
+            if current_section.gcode_block:
+                end_line_count: int = line_count + current_section.line_count()
+                current_section.score = anchors.elapsed_at(end_line_count) - anchors.elapsed_at(line_count)
+                total_time_s += current_section.score
+                line_count = end_line_count
+            current_section = current_section.next_section
+        if total_time_s <= 0.0:
+            return False
+        # scale the interpolated durations to the time left for the gcode blocks
+        scale: float = self._score_tracker / total_time_s
+        current_section = self._first_section
+        while current_section is not None:
+            if current_section.gcode_block:
+                current_section.score *= scale
+            current_section = current_section.next_section
+        return True
+
+    def _score_gcode_blocks_by_line_count(self) -> None:
+        """
+        Score the gcode blocks in proportion to their number of lines.
+        """
         current_section: GcodeSection
         # go through all sections and find the gcode blocks to determine line counts
         total_line_count: int = 0
@@ -903,7 +2936,7 @@ class ToolchangerPostprocessor:
         while current_section is not None:
             if current_section.gcode_block:
                 # add the line count to the total
-                total_line_count += len(current_section.resolve_lines())
+                total_line_count += current_section.line_count()
             current_section = current_section.next_section
 
         # next, go through all sections and score them based on the percentage of the total line count
@@ -911,8 +2944,70 @@ class ToolchangerPostprocessor:
         while current_section is not None:
             if current_section.gcode_block:
                 # score the section
-                current_section.score = (len(current_section.resolve_lines()) / total_line_count) * self._score_tracker
+                current_section.score = (current_section.line_count() / total_line_count) * self._score_tracker
+            current_section = current_section.next_section
+
+    def _build_score_index(self) -> None:
+        """
+        Build the prefix sums of the section scores so that the time between any two
+        sections is a subtraction and the point a given time before a section is a bisect.
+        """
+        sections: list[GcodeSection] = []
+        cumulative_scores: array = array('d', [0.0])
+        ascending: bool = True
+        total: float = 0.0
+        current_section: GcodeSection = self._first_section
+        while current_section is not None:
+            if current_section.start_gcode:
+                self._start_gcode_index = len(sections)
+            sections.append(current_section)
+            if current_section.score < 0:
+                # only happens when the print stats undercut the start and toolchange times
+                ascending = False
+            total += current_section.score
+            cumulative_scores.append(total)
             current_section = current_section.next_section
+        self._indexed_sections = sections
+        self._cumulative_scores = cumulative_scores
+        self._cumulative_scores_ascending = ascending
+        self._last_tool = self._last_section.tool
+
+    def _build_toolchange_events(self) -> None:
+        """
+        Build the toolchange event table from the score index in a single pass.
+        """
+        events: ToolchangeEvents = ToolchangeEvents(tool_count=self._tool_count_overall)
+        for index, current_section in enumerate(self._indexed_sections):
+            events.add_section(index, current_section, self._cumulative_scores[index])
+        events.link_next_selections()
+        self._toolchange_events = events
+
+    def _score_between(self, start: int, end: int) -> float:
+        """
+        Total score of the indexed sections from `start` up to but excluding `end`.
+
+        :param start: index of the first section
+        :param end: index one past the last section
+        """
+        return self._cumulative_scores[end] - self._cumulative_scores[start]
+
+    def _find_index_before(self, end: int, score: float) -> int:
+        """
+        Find the last indexed section before `end` at which the score accumulated walking
+        backwards from `end` reaches the given score.
+
+        :param end: index of the section to walk backwards from
+        :param score: the score to reach
+        :return: index of the section, or -1 if the score is never reached
+        """
+        target: float = self._cumulative_scores[end] - score
+        if self._cumulative_scores_ascending:
+            return bisect_right(self._cumulative_scores, target, 0, end) - 1
+        # negative scores break the ordering the bisect relies on
+        for index in range(end - 1, -1, -1):
+            if self._cumulative_scores[index] <= target:
+                return index
+        return -1
 
     def _add_turn_off_tool_logic(self) -> None:
         """
@@ -920,33 +3015,29 @@ class ToolchangerPostprocessor:
         time in the print, we need to turn off the tool and set the temperature to zero.
         """
         current_section: GcodeSection
+        events: ToolchangeEvents = self._toolchange_events
         # for each tool used in the print, we need to add a section to turn off the tool
         # and set the temperature to zero
         for tool in self._tool_configs:
             if tool.tool_used:
-                # first find the last section that uses this tool
-                current_section = self._first_section
-                while current_section.next_section is not None:
-                    current_section = current_section.next_section
                 # check if the last section uses this tool
-                if current_section.tool == tool.tool_number:
+                if self._last_tool == tool.tool_number:
                     # do nothing
                     continue
-                # now traverse the sections backwards until we find the last tool change that has this tool as outgoing
-                while current_section.prev_section is not None:
-                    current_section = current_section.prev_section
-                    if current_section.toolchange_gcode:
-                        if current_section.outgoing_tool == tool.tool_number:
-                            # mark as last deselect
-                            current_section.last_deselect = True
-                            # get lines from the current section
-                            lines = current_section.resolve_lines()
-                            # insert a temperature command as the second to last line
-                            lines.insert(-2, f'M104 S0 T{tool.tool_number} ; set tool temperature to zero since this tool is no longer used in print\n')
-                            # replace the lines in the section
-                            current_section.replace_lines(lines)
-                            # break out of the loop
-                            break
+                # find the last tool change that has this tool as outgoing
+                event: int = events.last_deselection[tool.tool_number]
+                if event == -1:
+                    continue
+                current_section = self._indexed_sections[events.positions[event]]
+                # mark as last deselect
+                current_section.last_deselect = True
+                events.standby_temperatures[event] = 0
+                # get lines from the current section
+                lines = current_section.resolve_lines()
+                # insert a temperature command as the second to last line
+                lines.insert(-2, f'M104 S0 T{tool.tool_number} ; set tool temperature to zero since this tool is no longer used in print\n')
+                # replace the lines in the section
+                current_section.replace_lines(lines)
 
     def _add_deselect_temperature_logic(self) -> None:
         """
@@ -960,35 +3051,27 @@ class ToolchangerPostprocessor:
         if ct_used == 1:
             # if only one extruder is used in the print, then we can skip the deselect temperature logic
             return
-        current_section: GcodeSection
-        toolchange_sections: list[GcodeSection] = []
-        # go through all sections and find the toolchange sections
-        current_section = self._first_section
-        while current_section is not None:
-            if current_section.toolchange_gcode and not current_section.initial_toolchange:
-                toolchange_sections.append(current_section)
-            current_section = current_section.next_section
+        sections: list[GcodeSection] | dict[int, GcodeSection] = self._indexed_sections
+        events: ToolchangeEvents = self._toolchange_events
+        # standby temperatures chosen by the planner, for the tools that have candidates
+        planned_temperatures: dict[int, int] = self._plan_standby_temperatures()
         # now go through each toolchange section, determine the temperature to set, and add that to the section
-        for toolchange_section in toolchange_sections:
+        for event in range(len(events)):
+            toolchange_section: GcodeSection = sections[events.positions[event]]
             if toolchange_section.last_deselect:
                 # skip if this is the last deselect, it was already handled
                 continue
-            outgoing_tool = toolchange_section.outgoing_tool
-            # now traverse the sections forward, keeping a running total of the score, until we find the next toolchange section where it is selected again
-            score_tracker: float = 0.0
-            current_section = toolchange_section.next_section
-            while current_section is not None:
-                if current_section.toolchange_gcode:
-                    if current_section.incoming_tool == outgoing_tool:
-                        # we found the next toolchange section where the tool is selected again
-                        break
-                score_tracker += current_section.score
-                current_section = current_section.next_section
-            if current_section is None:
+            outgoing_tool = events.outgoing_tools[event]
+            next_event: int = events.next_selection[event]
+            if next_event == -1:
                 # we have reached the end of the print
                 break
-            # now we can use the score to determine whether to reduce the temperature or turn the heater off
-            if score_tracker >= self._tool_configs[outgoing_tool].dormant_time_s:
+            # the next toolchange section where the tool is selected again
+            current_section = sections[events.positions[next_event]]
+            # the planned temperature, or reduce the temperature or turn the heater off by the time in between
+            standby_temperature: int = planned_temperatures[event] if event in planned_temperatures \
+                else self._fixed_standby_temperature(event, next_event)
+            if standby_temperature == 0:
                 # mark the next toolchange section as heat from off
                 current_section.heat_from_off = True
                 # if the tool is marked to clean the nozzle on first use, then we need to add a clean nozzle command
@@ -997,167 +3080,630 @@ class ToolchangerPostprocessor:
                     lines.insert(-2, f'CLEAN_NOZZLE ; clean nozzle\n')
                     current_section.replace_lines(lines)
                 # now add a temperature command to turn the heater off
+                events.standby_temperatures[event] = 0
                 lines = toolchange_section.resolve_lines()
                 lines.insert(-2, f'M104 S0 T{outgoing_tool} ; turn off tool heater for now as it will not be used again soon\n')
                 toolchange_section.replace_lines(lines)
             else:
-                # get the current temperature of the tool from the next toolchange section
-                next_tool_temp: int
-                if current_section.first_layer_temps_used:
-                    next_tool_temp = self._tool_configs[outgoing_tool].first_layer_temperature
-                else:
-                    next_tool_temp = self._tool_configs[outgoing_tool].temperature
-                # adjust it by the standby temp delta
-                next_tool_temp -= self._standby_temp_delta
                 # now add a temperature command to set the temperature
+                events.standby_temperatures[event] = standby_temperature
                 lines = toolchange_section.resolve_lines()
-                lines.insert(-2, f'M104 S{next_tool_temp} T{outgoing_tool} ; set tool temperature to idle temperature\n')
+                lines.insert(-2, f'M104 S{standby_temperature} T{outgoing_tool} ; set tool temperature to idle temperature\n')
                 toolchange_section.replace_lines(lines)
 
-    def _add_preheat_logic(self) -> None:
+    def _fixed_standby_temperature(self, event: int, next_event: int) -> int:
+        """
+        The standby temperature of an idle gap without the planner: off if the time in between,
+        excluding both toolchange sections, is at least the dormant time of the tool, otherwise
+        the temperature of the tool at the next toolchange adjusted by the standby temp delta.
+
+        :param event: the toolchange deselecting the tool
+        :param next_event: the toolchange selecting the tool again
+        :return: the standby temperature, 0 for off
+        """
+        events: ToolchangeEvents = self._toolchange_events
+        tool: int = events.outgoing_tools[event]
+        if self._score_between(events.positions[event] + 1, events.positions[next_event]) >= \
+                self._tool_configs[tool].dormant_time_s:
+            return 0
+        return self._print_temperature(tool, bool(events.first_layer[next_event])) - self._standby_temp_delta
+
+    def _plan_standby_temperatures(self) -> dict[int, int]:
+        """
+        Choose the standby temperature of every idle gap of the tools that have candidate
+        standby temperatures. The choice minimizes the predicted wait for the tool to heat up
+        again at its next pickup, keeping the temperature the fixed standby delta and dormant
+        time would have chosen when the waits are equal, as the prediction does not see the
+        waits of the other tools in between. Candidates above the tool's maximum standby
+        temperature are never chosen.
+
+        The total time the tool sits idle with its heater on is kept within its soak budget by
+        dynamic programming over its gaps in print order, with the soak time used so far as
+        the state. The soak time of a gap is rounded up to whole steps of STANDBY_SOAK_STEP_S,
+        so a plan never goes over the budget but may give up a gap that would just have fit,
+        and the step is coarsened so that there are at most MAX_STANDBY_SOAK_STEPS + 1 states,
+        which bounds the table to that many entries per gap. Without a budget there is a single
+        state and the plan reduces to the best candidate of each gap on its own.
+
+        :return: the standby temperature of each deselecting toolchange event that was planned
+        """
+        sections: list[GcodeSection] | dict[int, GcodeSection] = self._indexed_sections
+        events: ToolchangeEvents = self._toolchange_events
+        planned_temperatures: dict[int, int] = {}
+        for tool_config in self._tool_configs:
+            if not tool_config.standby_temperatures or not tool_config.tool_used:
+                continue
+            tool: int = tool_config.tool_number
+            # the idle gaps of the tool, from a deselection to the next selection
+            gaps: list[tuple[int, int]] = [
+                (event, events.next_selection[event]) for event in range(len(events))
+                if events.outgoing_tools[event] == tool and events.next_selection[event] != -1
+                and not sections[events.positions[event]].last_deselect
+            ]
+            soak_step_s: float = STANDBY_SOAK_STEP_S
+            if tool_config.max_standby_soak_time_s != inf:
+                soak_step_s = max(soak_step_s, tool_config.max_standby_soak_time_s / MAX_STANDBY_SOAK_STEPS)
+            budget_steps: float = tool_config.max_standby_soak_time_s / soak_step_s
+            # per gap, the soak steps used so far mapped to the step before and the temperature chosen
+            back_pointers: list[dict[int, tuple[int, int]]] = []
+            # soak steps used so far mapped to the total wait and the number of changed gaps of the best plan
+            states: dict[int, tuple[float, int]] = {0: (0.0, 0)}
+            for event, next_event in gaps:
+                # the idle temperature without the planner is always a candidate, and the default ceiling
+                idle_temperature: int = self._print_temperature(tool, bool(events.first_layer[next_event])) - \
+                    self._standby_temp_delta
+                ceiling: int = tool_config.max_standby_temperature
+                if ceiling == -1:
+                    ceiling = idle_temperature
+                candidates: set[int] = {0}
+                if idle_temperature <= ceiling:
+                    candidates.add(idle_temperature)
+                # the temperature chosen without the planner
+                fixed_temperature: int = self._fixed_standby_temperature(event, next_event)
+                candidates.update(temperature for temperature in tool_config.standby_temperatures if 0 < temperature <= ceiling)
+                options: list[tuple[int, float, int]] = []
+                for temperature in sorted(candidates):
+                    wait_s, soak_s = self._predict_reheat_wait(event, next_event, temperature)
+                    # the budget is only tracked when there is one
+                    soak_steps: int = int(-(-soak_s // soak_step_s)) if budget_steps != inf else 0
+                    options.append((temperature, wait_s, soak_steps))
+                next_states: dict[int, tuple[float, int]] = {}
+                pointers: dict[int, tuple[int, int]] = {}
+                for used_steps, (total_wait_s, changed_gaps) in states.items():
+                    for temperature, wait_s, soak_steps in options:
+                        steps: int = used_steps + soak_steps
+                        if steps > budget_steps:
+                            continue
+                        cost: tuple[float, int] = (total_wait_s + wait_s, changed_gaps + (temperature != fixed_temperature))
+                        if steps not in next_states or cost < next_states[steps]:
+                            next_states[steps] = cost
+                            pointers[steps] = (used_steps, temperature)
+                states = next_states
+                back_pointers.append(pointers)
+            if not gaps:
+                continue
+            # walk the choices of the best plan back from the last gap
+            steps = min(states, key=lambda used: states[used])
+            for (event, _), pointers in zip(reversed(gaps), reversed(back_pointers)):
+                steps, planned_temperatures[event] = pointers[steps]
+        return planned_temperatures
+
+    def _predict_reheat_wait(self, event: int, next_event: int, temperature: int) -> tuple[float, float]:
+        """
+        Predict how long the printer waits for a tool to heat up at its next pickup if it sits
+        at a standby temperature in between, with the preheat placed the way the preheat pass
+        is going to place it.
+
+        :param event: the toolchange deselecting the tool
+        :param next_event: the toolchange selecting the tool again
+        :param temperature: the standby temperature, 0 for off
+        :return: the seconds waited at the pickup, and the seconds the tool sits idle with its heater on
+        """
+        events: ToolchangeEvents = self._toolchange_events
+        tool: int = events.outgoing_tools[event]
+        tool_config: ToolConfig = self._tool_configs[tool]
+        heater: HeaterModel = tool_config.heater or HeaterModel()
+        deselected_at: float = self._cumulative_scores[events.positions[event] + 1]
+        pickup: float = self._cumulative_scores[events.positions[next_event]]
+        target: int = self._print_temperature(tool, bool(events.first_layer[next_event]))
+        # the preheat pass reads the standby temperature from the event table
+        previous_temperature: int = events.standby_temperatures[event]
+        events.standby_temperatures[event] = temperature
+        try:
+            lead_s: float
+            if tool_config.heater is not None:
+                lead_s = self._preheat_lead_time(next_event, target)
+            elif temperature == 0 or tool != self._first_tool:
+                lead_s = tool_config.warmup_from_off_time_s
+            else:
+                lead_s = tool_config.warmup_time_s
+        finally:
+            events.standby_temperatures[event] = previous_temperature
+        preheat_at: float = pickup - lead_s
+        if preheat_at < deselected_at:
+            # no preheat while the tool is still in use, it heats up at the pickup
+            preheat_at = pickup
+        idle_s: float = max(preheat_at - deselected_at, 0.0)
+        pickup_temperature: float = heater.temperature_after(
+            heater.temperature_after(self._print_temperature(tool, bool(events.first_layer[event])), temperature, idle_s),
+            target,
+            pickup - preheat_at
+        )
+        return heater.heat_time(pickup_temperature, target), idle_s if temperature > 0 else 0.0
+
+    def _add_preheat_logic(self) -> None:
+        """
+        Add the preheat logic.
+        """
+
+        # determine if only one extruder is used in the print
+        ct_used: int = 0
+        for tool in self._tool_configs:
+            if tool.tool_used:
+                ct_used += 1
+        if ct_used == 1:
+            # if only one extruder is used in the print, then we can skip the preheat logic
+            return
+
+        sections: list[GcodeSection] | dict[int, GcodeSection] = self._indexed_sections
+        events: ToolchangeEvents = self._toolchange_events
+        # now for each tool used in the print, excluding the first tool, mark the sections it is selected in as heat from off
+        first_tool: int = self._first_tool
+        for event in range(len(events)):
+            incoming_tool: int = events.incoming_tools[event]
+            if incoming_tool != first_tool and self._tool_configs[incoming_tool].tool_used:
+                sections[events.positions[event]].heat_from_off = True
+        # now go through each toolchange section and add the preheat logic
+        for event in range(len(events)):
+            index: int = events.positions[event]
+            toolchange_section: GcodeSection = sections[index]
+            last_selected_index: int = events.previous_use[event]
+            current_tool: int = events.incoming_tools[event]
+            # first determine the temperature to set
+            temp_to_set: int
+            if events.first_layer[event]:
+                temp_to_set = self._tool_configs[current_tool].first_layer_temperature
+            else:
+                temp_to_set = self._tool_configs[current_tool].temperature
+            # next, determine the preheat time needed
+            preheat_time_s: float
+            if self._tool_configs[current_tool].heater is not None:
+                # from how far the tool has cooled down by then
+                preheat_time_s = self._preheat_lead_time(event, temp_to_set)
+            elif toolchange_section.heat_from_off:
+                preheat_time_s = self._tool_configs[current_tool].warmup_from_off_time_s
+            else:
+                preheat_time_s = self._tool_configs[current_tool].warmup_time_s
+            # find the section, walking backwards from the toolchange, at which the preheat time is reached
+            preheat_index: int
+            if preheat_time_s <= 0:
+                # reached at the section right before the toolchange, preheat sections are only
+                # ever planned before earlier sections so that is the indexed one
+                if index == 1:
+                    preheat_index = 0
+                elif last_selected_index == index - 1:
+                    # the tool is selected in that section or is selected by it
+                    continue
+                else:
+                    # the preheat goes before that section
+                    self._planned_preheats.setdefault(index - 1, []).append((current_tool, temp_to_set))
+                    continue
+            else:
+                preheat_index = self._find_index_before(index, preheat_time_s)
+            if 0 < preheat_index <= last_selected_index:
+                # no point in preheating a tool that is actively being selected or is printing
+                continue
+            if preheat_index > 0:
+                # the preheat goes before the section at which the preheat time is reached
+                self._planned_preheats.setdefault(preheat_index, []).append((current_tool, temp_to_set))
+                continue
+            if last_selected_index > 0:
+                # no point in preheating a tool that is actively being selected or is printing
+                continue
+            # we have reached the start of the print
+            # if this tool is the first tool, then we can skip the preheat logic
+            if current_tool == first_tool:
+                continue
+            # the preheat logic goes right after the start_print section, ahead of the ones planned there
+            self._planned_preheats.setdefault(self._start_gcode_index + 1, []).insert(0, (current_tool, temp_to_set))
+        # streaming mode adds the planned preheats as it writes the output
+        if not self._stream:
+            self._insert_planned_preheat_sections()
+
+    def _insert_planned_preheat_sections(self) -> None:
+        """
+        Insert the planned preheat sections into the section list, before the indexed
+        sections they are planned before.
+        """
+        for index, preheats in self._planned_preheats.items():
+            current_section: GcodeSection = self._indexed_sections[index].prev_section
+            for tool, temperature in preheats:
+                current_section = self._insert_preheat_section(current_section, tool, temperature)
+
+    def _idle_temperature_at(self, event: int, time: float) -> float:
+        """
+        Simulated temperature of the incoming tool of a toolchange at a point in time before
+        the toolchange, while the tool sits at the setpoint the deselect pass left it at.
+
+        :param event: the toolchange event
+        :param time: the point in time, as a cumulative score
+        :return: the temperature
+        """
+        events: ToolchangeEvents = self._toolchange_events
+        tool: int = events.incoming_tools[event]
+        heater: HeaterModel = self._tool_configs[tool].heater or HeaterModel()
+        deselection: int = events.previous_deselection[event]
+        if deselection == -1:
+            # not used yet, the heater has been off since the start
+            return heater.ambient_temperature
+        # the tool was at its print temperature when it was deselected
+        if events.first_layer[deselection]:
+            print_temperature: float = self._tool_configs[tool].first_layer_temperature
+        else:
+            print_temperature = self._tool_configs[tool].temperature
+        setpoint: int = events.standby_temperatures[deselection]
+        if setpoint == -1:
+            # left alone by the deselect pass, so it stays at its print temperature
+            return print_temperature
+        deselected_at: float = self._cumulative_scores[events.positions[deselection] + 1]
+        return heater.temperature_after(print_temperature, setpoint, max(time - deselected_at, 0.0))
+
+    def _preheat_lead_time(self, event: int, temperature: int) -> float:
+        """
+        Time ahead of a toolchange at which the incoming tool has to start heating to reach
+        its temperature right at the toolchange. The later heating starts the further the
+        tool has cooled down, so the latest start that is still on time is found by bisection.
+
+        :param event: the toolchange event
+        :param temperature: the temperature the tool is needed at
+        :return: the lead time, as a score
+        """
+        events: ToolchangeEvents = self._toolchange_events
+        heater: HeaterModel = self._tool_configs[events.incoming_tools[event]].heater or HeaterModel()
+        pickup: float = self._cumulative_scores[events.positions[event]]
+        deselection: int = events.previous_deselection[event]
+        earliest: float = 0.0
+        if deselection != -1:
+            earliest = self._cumulative_scores[events.positions[deselection] + 1]
+
+        def slack(start: float) -> float:
+            return pickup - start - heater.heat_time(self._idle_temperature_at(event, start), temperature)
+
+        if slack(pickup) >= 0:
+            # still hot enough at the toolchange
+            return 0.0
+        if slack(earliest) < 0:
+            # not even heating right away makes it in time
+            return pickup - earliest
+        low: float = earliest
+        high: float = pickup
+        for _ in range(PREHEAT_SEARCH_STEPS):
+            middle: float = (low + high) / 2
+            if slack(middle) >= 0:
+                low = middle
+            else:
+                high = middle
+        return pickup - low
+
+    def _print_temperature(self, tool: int, first_layer: bool) -> int:
+        """
+        :param tool: the tool
+        :param first_layer: whether first layer temperatures are in use
+        :return: the temperature the tool prints at
+        """
+        if first_layer:
+            return self._tool_configs[tool].first_layer_temperature
+        return self._tool_configs[tool].temperature
+
+    def _predict_timeline(self) -> dict[str, Any]:
+        """
+        Replay the processed sections with the scores as the timeline and a heater model for
+        every tool, once following the temperature commands this script wrote and once following
+        the plan SuperSlicer wrote, which drops every deselected tool to its standby temperature
+        and waits with M109 for every selected one.
+
+        :return: one row per toolchange and the totals
+        """
+        heaters: list[HeaterModel] = [tool.heater or HeaterModel() for tool in self._tool_configs]
+        planned: ThermalReplay = ThermalReplay(heaters)
+        original: ThermalReplay = ThermalReplay(heaters)
+        events: ToolchangeEvents = self._toolchange_events
+        rows: list[dict[str, Any]] = []
+        # when each tool was last told to heat up to the temperature it is picked up at
+        heating_since: list[float] = [0.0] * len(heaters)
+        start_wait_s: float = 0.0
+        original_start_wait_s: float = 0.0
+        # SuperSlicer starts with every tool at standby and waits for the first one
+        first_tool: int = self._first_tool
+        for tool in range(len(heaters)):
+            original.set_temperature(tool, self._print_temperature(tool, True) - self._standby_temp_delta)
+        original.set_temperature(first_tool, self._print_temperature(first_tool, True))
+        original_start_wait_s += original.wait_for(first_tool)
+        second_layer_found: bool = False
+        current_section: GcodeSection = self._first_section
+        while current_section is not None:
+            is_toolchange: bool = current_section.toolchange_gcode and not current_section.initial_toolchange
+            row: dict[str, Any] | None = None
+            # the plan of this script, from the temperature commands and tool selections it wrote
+            if current_section.buffer_span() is None:
+                for line in current_section.resolve_lines():
+                    temperature_match = TEMPERATURE_LINE_PATTERN.match(line)
+                    if temperature_match is not None:
+                        tool: int = int(temperature_match.group(3))
+                        setpoint: int = int(temperature_match.group(2))
+                        if setpoint > planned.setpoint(tool):
+                            heating_since[tool] = planned.time
+                        planned.set_temperature(tool, setpoint)
+                        if row is not None and tool == row['outgoing_tool']:
+                            row['outgoing_action'] = 'off' if setpoint == 0 else 'idle'
+                            row['outgoing_temperature'] = setpoint
+                        if temperature_match.group(1) == 'M109':
+                            start_wait_s += planned.wait_for(tool)
+                        continue
+                    select_match = TOOL_SELECT_LINE_PATTERN.match(line)
+                    if select_match is None:
+                        continue
+                    tool = int(select_match.group(1))
+                    pickup_temperature: float = planned.temperature(tool)
+                    wait_s: float = planned.wait_for(tool)
+                    if not is_toolchange:
+                        start_wait_s += wait_s
+                        continue
+                    event: int = len(rows)
+                    row = {
+                        'event': event,
+                        'time_s': planned.time - wait_s,
+                        'layer': events.layers[event] if event < len(events) else -1,
+                        'outgoing_tool': current_section.outgoing_tool,
+                        'incoming_tool': tool,
+                        'target_temperature': planned.setpoint(tool),
+                        'preheat_lead_s': max(planned.time - wait_s - heating_since[tool], 0.0),
+                        'pickup_temperature': pickup_temperature,
+                        'wait_s': wait_s,
+                        'outgoing_action': 'unchanged',
+                        'outgoing_temperature': -1,
+                    }
+            # the plan of SuperSlicer
+            if current_section.second_layer_temperature_block and not second_layer_found:
+                second_layer_found = True
+                for tool in range(len(heaters)):
+                    original.set_temperature(tool, self._print_temperature(tool, False))
+            if is_toolchange:
+                first_layer: bool = current_section.first_layer_temps_used
+                outgoing_tool: int = current_section.outgoing_tool
+                incoming_tool: int = current_section.incoming_tool
+                original.set_temperature(outgoing_tool, self._print_temperature(outgoing_tool, first_layer) - self._standby_temp_delta)
+                original.set_temperature(incoming_tool, self._print_temperature(incoming_tool, first_layer))
+                original_pickup_temperature: float = original.temperature(incoming_tool)
+                original_wait_s: float = original.wait_for(incoming_tool)
+                if row is not None:
+                    row['original_pickup_temperature'] = original_pickup_temperature
+                    row['original_wait_s'] = original_wait_s
+                    rows.append(row)
+            planned.time += current_section.score
+            original.time += current_section.score
+            current_section = current_section.next_section
+        predicted_wait_s: float = sum(row['wait_s'] for row in rows)
+        original_wait_s = sum(row['original_wait_s'] for row in rows)
+        return {
+            'input_file_path': self._input_file_path,
+            'time_model': self._time_model.value,
+            'toolchanges': rows,
+            'totals': {
+                'toolchanges': len(rows),
+                'predicted_wait_s': predicted_wait_s,
+                'original_wait_s': original_wait_s,
+                'saved_wait_s': original_wait_s - predicted_wait_s,
+                'start_wait_s': start_wait_s,
+                'original_start_wait_s': original_start_wait_s,
+                'predicted_print_time_s': planned.time,
+                'original_print_time_s': original.time,
+            },
+        }
+
+    def _write_timeline_report(self, report_file_path: str) -> str:
+        """
+        Predict the timeline and write it as a report.
+
+        :param report_file_path: path to write the report to, JSON or CSV by extension
+        :return: a summary of the report
+        """
+        timeline: dict[str, Any] = self._predict_timeline()
+        write_timeline_report(report_file_path, timeline)
+        totals: dict[str, float] = timeline['totals']
+        return (f"Predicted wait {totals['predicted_wait_s']:.0f}s over {totals['toolchanges']} toolchanges, "
+                f"{totals['original_wait_s']:.0f}s with the original plan, report written to {report_file_path}")
+
+    def _insert_preheat_section(self, section: GcodeSection, tool: int, temperature: int) -> GcodeSection:
+        """
+        Insert a section that preheats a tool after a given section.
+
+        :param section: the section to insert the preheat section after
+        :param tool: the tool to preheat
+        :param temperature: the temperature to preheat the tool to
+        :return: the preheat section
+        """
+        preheat_section = self._insert_section_after_section(section, '\n')
+        self._add_preheat_lines(preheat_section, tool, temperature)
+        return preheat_section
+
+    def _add_preheat_lines(self, preheat_section: GcodeSection, tool: int, temperature: int) -> None:
+        """
+        Add the lines of a preheat section after its first blank line.
+
+        :param preheat_section: the new section
+        :param tool: the tool to preheat
+        :param temperature: the temperature to preheat the tool to
+        """
+        preheat_section.add_line(f'; custom gcode: preheat_section T{tool}\n')
+        preheat_section.add_line(f'M104 S{temperature} T{tool} ; set tool temperature to preheat\n')
+        preheat_section.add_line(f'; custom gcode end: preheat_section T{tool}\n')
+        preheat_section.add_line('\n')
+
+    def _output_pieces(self) -> Iterator[bytes | tuple[int, int]]:
+        """
+        Describes the output as an edit list against the input: new or modified data as bytes,
+        and the spans of the input that are passed through unchanged as (start, end) tuples.
+        Adjacent spans are merged so that the unchanged stretches between edits come out as
+        single ranges. New and rewritten gcode is written with the line terminator of the input.
+        In streaming mode the sections of the body come from its second pass.
+        """
+        line_ending: str = self._line_ending
+        separator: bytes = line_ending.encode(GCODE_ENCODING)
+        yield from self._output_spans
+        yield separator
+        span_start: int = -1
+        span_end: int = -1
+        sections: Iterator[GcodeSection] = self._stream_output_sections() if self._stream else self._walk_sections()
+        for current_section in sections:
+            span: tuple[int, int] | None = current_section.buffer_span()
+            if span is not None and span[0] == span_end:
+                span_end = span[1]
+            else:
+                if span_start != span_end:
+                    yield span_start, span_end
+                if span is not None:
+                    span_start, span_end = span
+                else:
+                    span_start = span_end = -1
+                    yield encode_output_text(''.join(current_section.resolve_lines()), line_ending)
+        if span_start != span_end:
+            yield span_start, span_end
+        yield separator
+        yield from self._end_print_spans
+        yield separator
+        yield from self._print_stats_spans
+        yield separator
+        yield from self._ss_configs_spans
+
+    def _reconstruct_for_output(self) -> Iterator[bytes]:
+        """
+        Reconstructs the gcode for output. Pieces are yielded one at a time, unmodified
+        spans as raw bytes straight from the buffer, rather than concatenated into one big list.
+        """
+        for piece in self._output_pieces():
+            if isinstance(piece, tuple):
+                # a span can run across most of the body, so it is copied a chunk at a time
+                for start in range(piece[0], piece[1], FILE_CHUNK_SIZE):
+                    end: int = min(start + FILE_CHUNK_SIZE, piece[1])
+                    yield self._buffer[start:end]
+                    self._release_pages(start, end)
+            else:
+                yield piece
+
+    def _write_output_file(self) -> None:
+        """
+        Write the output gcode file. The input file is still mapped while the output is
+        written, so the output goes to a temporary file that then replaces the target, the
+        mapping is released just before that. The unchanged spans of the input are copied
+        in the kernel unless splicing is turned off.
+        """
+        if self._splice_output and isinstance(self._buffer, mmap):
+            write_spliced_file(self._output_file_path, self._input_file_path, self._buffer, self._output_pieces(),
+                               before_replace=self._release_input)
+        else:
+            write_file_atomically(self._output_file_path, self._reconstruct_for_output(),
+                                  before_replace=self._release_input)
+
+    def _copy_input_to_output(self) -> None:
+        """
+        Copy the input unchanged to the output file when the output goes somewhere else, for
+        gcode that is left alone. Gcode handed over in memory is written out as is.
+        """
+        if not self._input_from_file:
+            write_file_atomically(self._output_file_path, (self._buffer,))
+        elif os.path.abspath(self._output_file_path) != os.path.abspath(self._input_file_path):
+            self._release_input()
+            copy_file_atomically(self._input_file_path, self._output_file_path)
+
+    def _release_input(self) -> None:
         """
-        Add the preheat logic.
+        Unmap the input file, the buffer cannot be used after this.
         """
+        if isinstance(self._buffer, mmap):
+            self._buffer.close()
 
-        # determine if only one extruder is used in the print
-        ct_used: int = 0
-        for tool in self._tool_configs:
-            if tool.tool_used:
-                ct_used += 1
-        if ct_used == 1:
-            # if only one extruder is used in the print, then we can skip the preheat logic
-            return
+    def _profile_counts(self) -> dict[str, int]:
+        """
+        Counts describing what processing did, for the stage profile report.
 
-        current_section: GcodeSection
-        toolchange_sections: list[GcodeSection] = []
-        # go through all sections and find the toolchange sections
-        current_section = self._first_section
+        :return: the counts by name
+        """
+        sections: int = 0
+        rewritten_sections: int = 0
+        rewritten_lines: int = 0
+        preheat_blocks: int = 0
+        current_section: GcodeSection = self._first_section
         while current_section is not None:
-            if current_section.toolchange_gcode and not current_section.initial_toolchange:
-                toolchange_sections.append(current_section)
+            sections += 1
+            if current_section.buffer_span() is None:
+                rewritten_sections += 1
+                lines: list[str] = current_section.resolve_lines()
+                rewritten_lines += len(lines)
+                preheat_blocks += sum(1 for line in lines if line.startswith('; custom gcode: preheat_section'))
             current_section = current_section.next_section
-        # now for each tool used in the print, excluding the first tool, find the first section it is selected in and mark as heat from off
-        first_tool: int = self._first_section.tool
-        for tool in self._tool_configs:
-            if tool.tool_number == first_tool:
-                continue
-            if not tool.tool_used:
-                continue
-            # find the first section it is selected in
-            for toolchange_section in toolchange_sections:
-                if toolchange_section.incoming_tool == tool.tool_number:
-                    # mark the section as heat from off
-                    toolchange_section.heat_from_off = True
-        # now go through each toolchange section and add the preheat logic
-        for toolchange_section in toolchange_sections:
-            current_tool: int = toolchange_section.incoming_tool
-            # first determine the temperature to set
-            temp_to_set: int
-            if toolchange_section.first_layer_temps_used:
-                temp_to_set = self._tool_configs[current_tool].first_layer_temperature
+        copied_bytes: int = 0
+        new_bytes: int = 0
+        for piece in self._output_pieces():
+            if isinstance(piece, tuple):
+                copied_bytes += piece[1] - piece[0]
             else:
-                temp_to_set = self._tool_configs[current_tool].temperature
-            # next, determine the preheat time needed 
-            preheat_time_s: int
-            if toolchange_section.heat_from_off:
-                preheat_time_s = self._tool_configs[current_tool].warmup_from_off_time_s
-            else:
-                preheat_time_s = self._tool_configs[current_tool].warmup_time_s
-            # now we traverse the sections backwards
-            current_section = toolchange_section
-            score_tracker: float = 0.0
-            while True:
-                # check if there is a previous section
-                if current_section.prev_section == self._first_section:
-                    # we have reached the start of the print
-                    # first find the start_print section
-                    search_section: GcodeSection = self._first_section
-                    while not search_section.start_gcode:
-                        search_section = search_section.next_section
-                    # if this tool is the first tool, then we can skip the preheat logic
-                    if current_tool == first_tool:
-                        break
-                    # the preheat logic goes at the start of the start_print section
-                    preheat_section = self._insert_section_after_section(search_section, '\n')
-                    # add the preheat command
-                    preheat_section.add_line(f'; custom gcode: preheat_section T{current_tool}\n')
-                    preheat_section.add_line(f'M104 S{temp_to_set} T{current_tool} ; set tool temperature to preheat\n')
-                    preheat_section.add_line(f'; custom gcode end: preheat_section T{current_tool}\n')
-                    preheat_section.add_line('\n')
-                    break
-                # check if the previous section has this tool selected or is a toolchange section selecting this tool
-                if current_section.prev_section.tool == current_tool or (current_section.prev_section.toolchange_gcode and current_section.prev_section.incoming_tool == current_tool):
-                    # no point in preheating a tool that is actively being selected or is printing
-                    break
-                # add the score of the previous section to the tracker
-                score_tracker += current_section.prev_section.score
-                # check if the score has been reached
-                if score_tracker >= preheat_time_s:
-                    # insert the preheat section before the previous section
-                    preheat_section = self._insert_section_after_section(current_section.prev_section.prev_section, '\n')
-                    preheat_section.add_line(f'; custom gcode: preheat_section T{current_tool}\n')
-                    preheat_section.add_line(f'M104 S{temp_to_set} T{current_tool} ; set tool temperature to preheat\n')
-                    preheat_section.add_line(f'; custom gcode end: preheat_section T{current_tool}\n')
-                    preheat_section.add_line('\n')
-                    break
-                # move to the previous section
-                current_section = current_section.prev_section
-
-    def _reduce_linked_list_to_middle_section(self) -> None:
-        """
-        Reduce the linked list to the middle section.
+                new_bytes += len(piece)
+        return {
+            'sections': sections,
+            'indexed_sections': len(self._indexed_sections),
+            'rewritten_sections': rewritten_sections,
+            'lines_rewritten': rewritten_lines,
+            'toolchanges': len(self._toolchange_events),
+            'preheat_blocks_inserted': preheat_blocks,
+            'output_bytes_copied': copied_bytes,
+            'output_bytes_new': new_bytes,
+        }
+
+    # section insertion functions
+
+    def _walk_sections(self) -> Iterator[GcodeSection]:
+        """
+        Walk the linked list of sections from the start.
         """
         current_section: GcodeSection = self._first_section
-        self._middle_section = current_section.resolve_lines()
-        while current_section.next_section is not None:
+        while current_section is not None:
+            yield current_section
             current_section = current_section.next_section
-            self._middle_section = self._middle_section + current_section.resolve_lines()
 
-    def _reconstruct_for_output(self) -> None:
-        """
-        Reconstructs the output lines list for output.
-        """
-        self._output_lines = self._output_lines + ['\n']
-        self._output_lines = self._output_lines + self._middle_section
-        self._output_lines = self._output_lines + ['\n']
-        self._output_lines = self._output_lines + self._end_print_section
-        self._output_lines = self._output_lines + ['\n']
-        self._output_lines = self._output_lines + self._print_stats_section
-        self._output_lines = self._output_lines + ['\n']
-        self._output_lines = self._output_lines + self._ss_configs_section
-    
-    def _write_output_file(self) -> None:
+    def _detach_sections(self) -> list[GcodeSection]:
         """
-        Write the output gcode file.
-        """
-        with open(self._input_file_path, "w") as writefile:
-            for line in self._output_lines:
-                writefile.write(line)
+        Take all sections out of the linked list, unlinked from each other, leaving the list
+        empty for the next window of the body.
 
-    # section insertion functions
+        :return: the sections in order
+        """
+        sections: list[GcodeSection] = list(self._walk_sections())
+        for current_section in sections:
+            current_section.prev_section = None
+            current_section.next_section = None
+        self._first_section = None  # type: ignore
+        self._last_section = None  # type: ignore
+        return sections
 
-    def _insert_new_section_at_end(self, line: str) -> GcodeSection:
+    def _insert_new_section_at_end(self, line: str | None) -> GcodeSection:
         """
         Insert a new section at the end of the sections linked list.
         """
-        # check if the list has been initialized
-        if self._first_section is None:
-            self._first_section = GcodeSection(
-                first_line=line,
-                tool=self._track_current_tool
-            )
-            return self._first_section
-        # first find the last section
-        current_section: GcodeSection = self._first_section
-        while current_section.next_section is not None:
-            current_section = current_section.next_section
         # create the new section
         new_section = GcodeSection(
             first_line=line,
             tool=self._track_current_tool
         )
-        current_section.next_section = new_section
-        new_section.prev_section = current_section
+        # check if the list has been initialized
+        if self._first_section is None:
+            self._first_section = new_section
+            self._last_section = new_section
+            return new_section
+        # link it after the current last section
+        self._last_section.next_section = new_section
+        new_section.prev_section = self._last_section
+        self._last_section = new_section
         return new_section
 
     def _insert_new_section_at_start(self, line: str) -> GcodeSection:
@@ -1184,7 +3730,10 @@ class ToolchangerPostprocessor:
             tool=section.tool
         )
         new_section.next_section = section.next_section
-        section.next_section.prev_section = new_section
+        if section.next_section is not None:
+            section.next_section.prev_section = new_section
+        else:
+            self._last_section = new_section
         section.next_section = new_section
         new_section.prev_section = section
         return new_section
@@ -1194,8 +3743,885 @@ class ToolchangerPostprocessor:
         Delete a section from the linked list.
         """
         section.prev_section.next_section = section.next_section
-        section.next_section.prev_section = section.prev_section
+        if section.next_section is not None:
+            section.next_section.prev_section = section.prev_section
+        else:
+            self._last_section = section.prev_section
+
+
+
+def write_timeline_report(file_path: str, timeline: dict[str, Any]) -> None:
+    """
+    Write a predicted timeline report, as CSV with one row per toolchange if the path ends
+    in .csv and as JSON with the totals otherwise.
+
+    :param file_path: path of the report
+    :param timeline: the timeline, as predicted by the processor
+    """
+    if file_path.lower().endswith('.csv'):
+        output: StringIO = StringIO()
+        fields: list[str] = list(timeline['toolchanges'][0]) if timeline['toolchanges'] else ['event']
+        writer = csv.DictWriter(output, fieldnames=fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(timeline['toolchanges'])
+        data: str = output.getvalue()
+    else:
+        data = json.dumps(timeline, indent=2)
+    write_file_atomically(file_path, [data.encode(GCODE_ENCODING)])
+
+
+class StageProfiler:
+    """
+    Records the wall time, cpu time and memory of each stage of a ToolchangerPostprocessor.
+    The stage methods are only wrapped on the instance being profiled, so processing that
+    is not profiled runs exactly as before.
+    """
+
+    # the stage methods of the post processor in the order process_gcode runs them, a stage
+    # that is added to process_gcode or _process_sections has to be added here as well, the
+    # streaming mode of process_gcode is not profiled
+    STAGES: tuple[str, ...] = (
+        '_skip_reason',
+        '_copy_input_to_output',
+        '_index_raw_lines',
+        '_eliminate_blank_lines',
+        '_process_comments_and_images_at_start_of_file',
+        '_process_block_before_print_start',
+        '_extract_slicer_configs_section',
+        '_parse_slicer_configs',
+        '_extract_print_stats_section',
+        '_parse_print_stats',
+        '_extract_end_gcode_section',
+        '_find_tools_used_in_print',
+        '_eliminate_ss_pre_toolchange_tool_temp_drop',
+        '_eliminate_ss_post_start_filament_tool_temp_set',
+        '_process_start_filament_gcode_blocks_for_tool_parameters',
+        '_extract_basic_start_info',
+        '_parse_raw_lines_into_sections',
+        '_process_start_section',
+        '_process_second_layer_changes',
+        '_process_toolchange_sections',
+        '_score_gcode_blocks',
+        '_build_score_index',
+        '_build_toolchange_events',
+        '_add_turn_off_tool_logic',
+        '_add_deselect_temperature_logic',
+        '_add_preheat_logic',
+        '_write_timeline_report',
+        '_write_output_file',
+    )
+
+    trace_memory: bool
+    # measurements of each stage, in the order the stages ran
+    stages: dict[str, dict[str, float | int]]
+    # size of the input, taken before processing as the input may be replaced by the output
+    _input_bytes: int
+
+    def __init__(self, trace_memory: bool = False) -> None:
+        """
+        Initialize the StageProfiler class.
+
+        :param trace_memory: also trace the python allocations of each stage, which is accurate but slows them down
+        """
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._input_bytes = 0
+
+    def instrument(self, processor: ToolchangerPostprocessor) -> None:
+        """
+        Route the stage methods of a processor through the profiler.
+
+        :param processor: the processor to profile
+        :raises AttributeError: if one of the stages is not a method of the processor
+        """
+        self._input_bytes = len(processor._buffer)
+        for name in self.STAGES:
+            method = getattr(processor, name)
+            setattr(processor, name, lambda *args, method=method, name=name: self._measure(name, method, *args))
+
+    def _measure(self, name: str, method: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run a stage and record its measurements.
+
+        :param name: name of the stage
+        :param method: the bound stage method
+        :param args: the arguments of the stage
+        :return: the result of the stage
+        """
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            start_size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        start_max_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        wall_start: float = time.perf_counter()
+        cpu_start: float = time.process_time()
+        result = method(*args)
+        stage: dict[str, float | int] = {
+            'wall_s': time.perf_counter() - wall_start,
+            'cpu_s': time.process_time() - cpu_start,
+            # how far the stage raised the peak resident size of the process, kilobytes except on macos
+            'peak_rss_delta_bytes': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_max_rss) *
+                                    (1 if sys.platform == 'darwin' else 1024),
+        }
+        if self.trace_memory:
+            end_size, peak_size = tracemalloc.get_traced_memory()
+            stage['traced_peak_bytes'] = peak_size - start_size
+            stage['traced_retained_bytes'] = end_size - start_size
+        self.stages[name] = stage
+        return result
+
+    def report(self, processor: ToolchangerPostprocessor) -> dict[str, Any]:
+        """
+        Put the measurements together with the counts of the processed gcode. Memory tracing
+        stops here.
+
+        :param processor: the profiled processor, after processing
+        :return: the report
+        """
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {
+            'input_file_path': processor._input_file_path,
+            'input_bytes': self._input_bytes,
+            'time_model': processor._time_model.value,
+            'total_wall_s': sum(stage['wall_s'] for stage in self.stages.values()),
+            'total_cpu_s': sum(stage['cpu_s'] for stage in self.stages.values()),
+            'stages': self.stages,
+            'counts': processor._profile_counts(),
+        }
+
+    def write_report(self, file_path: str, processor: ToolchangerPostprocessor) -> None:
+        """
+        Write the report as JSON.
+
+        :param file_path: path of the report
+        :param processor: the profiled processor, after processing
+        """
+        write_file_atomically(file_path, [json.dumps(self.report(processor), indent=2).encode(GCODE_ENCODING)])
+
+
+class JobStatus(Enum):
+    """
+    Outcome of post processing a single gcode file.
+    """
+    PROCESSED = 'processed'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+
+class JobResult:
+    """
+    Result of post processing a single gcode file, as reported by batch mode.
+    """
+
+    input_file_path: str
+    status: JobStatus
+    message: str
+
+    def __init__(self, input_file_path: str, status: JobStatus, message: str = '') -> None:
+        self.input_file_path = input_file_path
+        self.status = status
+        self.message = message
+
+    def __str__(self) -> str:
+        if self.message:
+            return f'{self.status.value}: {self.input_file_path} ({self.message})'
+        return f'{self.status.value}: {self.input_file_path}'
+
+
+class ResultCache:
+    """
+    On disk cache of processed gcode, keyed by a hash of the input file together with
+    everything else the output depends on: the time model and the source of this script.
+    Entries are evicted least recently used first once the cache grows past its size limit.
+    """
+
+    cache_dir: str
+    max_size_bytes: int
+
+    # digest of this script, so that entries written by another version are never used
+    _code_digest: str
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = 1024 ** 3) -> None:
+        """
+        Initialize the ResultCache class.
+
+        :param cache_dir: directory the entries are stored in
+        :param max_size_bytes: total size of the entries above which the oldest are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        with open(__file__, 'rb') as readfile:
+            self._code_digest = hashlib.sha256(readfile.read()).hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_file_path: str, time_model: TimeModel) -> str:
+        """
+        Compute the cache key of a gcode file.
+
+        :param input_file_path: path to the gcode file
+        :param time_model: how the durations of the gcode blocks are estimated
+        :return: hex digest identifying the output
+        """
+        digest = hashlib.sha256(f'{self._code_digest}\n{time_model.value}\n'.encode(GCODE_ENCODING))
+        with open(input_file_path, 'rb') as readfile:
+            while chunk := readfile.read(FILE_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def fetch(self, key: str, output_file_path: str) -> bool:
+        """
+        Copy a cached output over the given file.
+
+        :param key: the cache key
+        :param output_file_path: path the output is written to
+        :return: whether the cache had an entry for the key
+        """
+        entry_path: str = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            return False
+        try:
+            copy_file_atomically(entry_path, output_file_path)
+        except FileNotFoundError:
+            # evicted in the meantime
+            return False
+        # the modification time of an entry is its last use
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key: str, output_file_path: str) -> None:
+        """
+        Add a processed file to the cache and evict the least recently used entries if the
+        cache has grown too large.
+
+        :param key: the cache key
+        :param output_file_path: path to the processed file
+        """
+        # write under a unique name first so that concurrent writers never see a partial entry
+        temp_fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(temp_fd)
+        try:
+            shutil.copyfile(output_file_path, temp_path)
+            os.replace(temp_path, self._entry_path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        self._evict()
+
+    def _entry_path(self, key: str) -> str:
+        """
+        :param key: the cache key
+        :return: path of the entry for the key
+        """
+        return os.path.join(self.cache_dir, key + '.gcode')
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used entries until the cache fits its size limit.
+        """
+        entries: list[tuple[int, int, str]] = []
+        total_size: int = 0
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.gcode'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # evicted by another worker
+                pass
+            total_size -= size
+
+
+def process_file(input_file_path: str, time_model: TimeModel = TimeModel.LINE_COUNT,
+                 cache: ResultCache | None = None, output_file_path: str | None = None,
+                 profile: bool = False) -> JobResult:
+    """
+    Post process a single gcode file and report the outcome, errors are reported as a
+    failed result rather than raised.
+
+    :param input_file_path: path to the gcode file
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param cache: cache to take the output from, or to add it to once processed
+    :param output_file_path: path to write the output to, defaults to replacing the input file
+    :param profile: write a stage profile report next to the output
+    :return: the result for the file
+    """
+    output_file_path = output_file_path or input_file_path
+    try:
+        cache_key: str = ''
+        if cache is not None:
+            cache_key = cache.key(input_file_path, time_model)
+            if cache.fetch(cache_key, output_file_path):
+                return JobResult(input_file_path, JobStatus.PROCESSED, 'from cache')
+        processor = ToolchangerPostprocessor(input_file_path, time_model=time_model,
+                                             output_file_path=output_file_path)
+        profiler: StageProfiler | None = StageProfiler() if profile else None
+        if profiler is not None:
+            profiler.instrument(processor)
+        result: JobResult = processor.process_gcode()
+        if result.status is not JobStatus.PROCESSED:
+            return result
+        if profiler is not None:
+            profiler.write_report(output_file_path + PROFILE_SUFFIX, processor)
+        if cache is not None:
+            cache.store(cache_key, output_file_path)
+    except Exception as exc:
+        return JobResult(input_file_path, JobStatus.FAILED, f'{type(exc).__name__}: {exc}')
+    return JobResult(input_file_path, JobStatus.PROCESSED)
+
+
+def read_gcode_source(source: bytes | bytearray | memoryview | BinaryIO | TextIO | Iterable[bytes | str]) -> bytes:
+    """
+    Collect gcode handed over in memory into a single buffer. The planner needs the whole
+    print before it can write the first line, so a stream is read to its end up front and
+    the whole gcode is held in memory. Text, from a stream opened in text mode or str lines,
+    is encoded as UTF-8.
+
+    :param source: the gcode as bytes, a binary or text stream, or an iterable of lines or chunks
+    :return: contents of the gcode file
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, 'read'):
+        data: bytes | str = source.read()
+        return data.encode(GCODE_ENCODING) if isinstance(data, str) else bytes(data)
+    return b''.join(chunk.encode(GCODE_ENCODING) if isinstance(chunk, str) else chunk for chunk in source)
+
+
+def postprocess_gcode(source: bytes | bytearray | memoryview | BinaryIO | TextIO | Iterable[bytes | str],
+                      time_model: TimeModel = TimeModel.LINE_COUNT,
+                      name: str = '<gcode>') -> tuple[JobResult, Iterator[bytes]]:
+    """
+    Post process gcode in process, without any files and without exiting. Gcode that is left
+    alone is reported as skipped and comes out unchanged, errors are raised to the caller.
+
+    :param source: the gcode as bytes, a binary or text stream, or an iterable of lines or chunks
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param name: name of the gcode used in the result
+    :return: the result and an iterator over the chunks of the output
+    """
+    processor = ToolchangerPostprocessor(name, time_model=time_model, data=read_gcode_source(source))
+    return processor.process_to_chunks()
+
+
+def postprocess_gcode_to_stream(source: bytes | bytearray | memoryview | BinaryIO | TextIO | Iterable[bytes | str],
+                                target: BinaryIO, time_model: TimeModel = TimeModel.LINE_COUNT,
+                                name: str = '<gcode>') -> JobResult:
+    """
+    Post process gcode in process and write the output to a binary stream.
+
+    :param source: the gcode as bytes, a binary or text stream, or an iterable of lines or chunks
+    :param target: stream the output is written to
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param name: name of the gcode used in the result
+    :return: the result
+    """
+    result, chunks = postprocess_gcode(source, time_model=time_model, name=name)
+    for chunk in chunks:
+        target.write(chunk)
+    return result
+
+
+def expand_input_paths(patterns: list[str]) -> list[str]:
+    """
+    Expand the paths given on the command line into a list of gcode files. Directories
+    expand to the gcode files directly inside them and anything that is not an existing
+    file is treated as a glob pattern.
+
+    :param patterns: files, directories or glob patterns
+    :return: the matching files in the given order, without duplicates
+    """
+    paths: list[str] = []
+    for pattern in patterns:
+        if os.path.isfile(pattern):
+            paths.append(pattern)
+        elif os.path.isdir(pattern):
+            paths.extend(sorted(glob.glob(os.path.join(glob.escape(pattern), '*.gcode'))))
+        else:
+            paths.extend(path for path in sorted(glob.glob(pattern, recursive=True)) if os.path.isfile(path))
+    return list(dict.fromkeys(paths))
+
+
+def process_files(input_file_paths: list[str], time_model: TimeModel = TimeModel.LINE_COUNT,
+                  jobs: int | None = None, cache: ResultCache | None = None, profile: bool = False) -> list[JobResult]:
+    """
+    Post process many gcode files in place across a pool of worker processes. A failure
+    in one file does not stop the others. A crashed worker breaks the whole pool, so the
+    files that had not finished are given one more try on a fresh pool.
+
+    :param input_file_paths: paths to the gcode files
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param jobs: number of worker processes, defaults to the number of cpus
+    :param cache: cache of processed outputs
+    :param profile: write a stage profile report next to each processed file
+    :return: one result per file, in the order of the input paths
+    """
+    if not input_file_paths:
+        return []
+    jobs = min(jobs or os.cpu_count() or 1, len(input_file_paths))
+    results: list[JobResult | None] = [None] * len(input_file_paths)
+    pending: list[int] = list(range(len(input_file_paths)))
+    for retry in (False, True):
+        broken: list[int] = []
+        with ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as executor:
+            futures: list[tuple[int, Future | None]] = []
+            for index in pending:
+                try:
+                    futures.append((index, executor.submit(process_file, input_file_paths[index], time_model, cache,
+                                                           None, profile)))
+                except BrokenProcessPool:
+                    # the pool broke while the files were being handed out
+                    futures.append((index, None))
+            for index, future in futures:
+                path: str = input_file_paths[index]
+                try:
+                    if future is None:
+                        raise BrokenProcessPool('the pool broke before the file was submitted')
+                    result: JobResult = future.result()
+                except BrokenProcessPool as exc:
+                    if not retry:
+                        # a worker died and took every unfinished file down with it, try them again
+                        broken.append(index)
+                        continue
+                    result = JobResult(path, JobStatus.FAILED, f'{type(exc).__name__}: {exc}')
+                except Exception as exc:
+                    result = JobResult(path, JobStatus.FAILED, f'{type(exc).__name__}: {exc}')
+                print(result, flush=True)
+                results[index] = result
+        if not broken:
+            break
+        print(f'A worker process crashed, retrying {len(broken)} files', flush=True)
+        pending = broken
+    return [result for result in results if result is not None]
+
+
+class FolderWatcher:
+    """
+    Long running mode that watches a directory for exported gcode files, post processes
+    each one once its size has stopped changing and moves it to an output directory. The
+    worker processes stay alive between files, so each export only pays for the
+    processing itself.
+    """
+
+    watch_dir: str
+    output_dir: str
+    time_model: TimeModel
+    jobs: int
+    settle_time_s: float
+    poll_interval_s: float
+    max_queued: int
+    cache: ResultCache | None
+
+    # path -> (size, mtime, time the size was first seen), for files still being written
+    _candidates: dict[str, tuple[int, int, float]]
+    # files that are fully written and waiting for a free worker
+    _queue: deque[str]
+    _in_flight: dict[Future, str]
+    # path -> (size, mtime) of files that failed, they are retried only once they change
+    _failed: dict[str, tuple[int, int]]
+    # files that were in progress when a worker crashed, they are retried only once
+    _crashed: set[str]
+    _executor: ProcessPoolExecutor | None
+    _stopping: bool
+
+    def __init__(self, watch_dir: str, output_dir: str, time_model: TimeModel = TimeModel.LINE_COUNT,
+                 jobs: int | None = None, settle_time_s: float = 2.0, poll_interval_s: float = 0.5,
+                 max_queued: int = 100, cache: ResultCache | None = None) -> None:
+        """
+        Initialize the FolderWatcher class.
+
+        :param watch_dir: directory the gcode files are exported to
+        :param output_dir: directory the processed files are moved to
+        :param time_model: how the durations of the gcode blocks are estimated
+        :param jobs: number of worker processes, defaults to the number of cpus
+        :param settle_time_s: how long the size of a file has to stay the same before it is processed
+        :param poll_interval_s: time between scans of the watched directory
+        :param max_queued: maximum number of files waiting for a worker, the rest are picked up later
+        :param cache: cache of processed outputs
+        """
+        self.watch_dir = watch_dir
+        self.output_dir = output_dir
+        self.time_model = time_model
+        self.jobs = jobs or os.cpu_count() or 1
+        self.settle_time_s = settle_time_s
+        self.poll_interval_s = poll_interval_s
+        self.max_queued = max_queued
+        self.cache = cache
+        self._candidates = {}
+        self._queue = deque()
+        self._in_flight = {}
+        self._failed = {}
+        self._crashed = set()
+        self._executor = None
+        self._stopping = False
+
+    def run(self) -> None:
+        """
+        Watch the directory until interrupted or terminated. The files that are already
+        being processed are finished before returning.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        print(f'Watching {self.watch_dir}, processed files are moved to {self.output_dir}', flush=True)
+        signal.signal(signal.SIGTERM, self._stop)
+        self._start_executor()
+        try:
+            try:
+                while not self._stopping:
+                    self.poll()
+                    time.sleep(self.poll_interval_s)
+            except KeyboardInterrupt:
+                pass
+            print('Stopping, waiting for the files in progress', flush=True)
+            self._stopping = True
+            self._queue.clear()
+            while self._in_flight:
+                self._collect_results(block=True)
+        finally:
+            self._executor.shutdown()
+
+    def _start_executor(self) -> None:
+        """
+        Start a fresh worker pool, replacing the current one. A worker that dies breaks the
+        whole pool, so this is also how the watcher recovers from a crash.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        # the workers keep the default handler so that they can still be terminated
+        self._executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=signal.signal,
+                                             initargs=(signal.SIGTERM, signal.SIG_DFL))
+
+    def _stop(self, signum: int, frame: Any) -> None:
+        """
+        Signal handler that ends the watch loop.
+        """
+        self._stopping = True
+
+    def poll(self) -> None:
+        """
+        Run one round of the watch loop: pick up finished files, scan for new ones and
+        hand queued files to free workers.
+        """
+        self._collect_results()
+        self._scan()
+        while self._queue and len(self._in_flight) < self.jobs:
+            path: str = self._queue.popleft()
+            try:
+                future: Future = self._executor.submit(process_file, path, self.time_model, self.cache)
+            except BrokenProcessPool:
+                # a worker died since the last round, put the file back and start over with fresh workers
+                self._queue.appendleft(path)
+                self._start_executor()
+                break
+            self._in_flight[future] = path
+
+    def _scan(self) -> None:
+        """
+        Scan the watched directory and queue the files whose size and modification time
+        have not changed for the settle time.
+        """
+        now: float = time.monotonic()
+        busy: set[str] = set(self._queue) | set(self._in_flight.values())
+        seen: set[str] = set()
+        with os.scandir(self.watch_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.gcode') or entry.path in busy or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # removed while scanning
+                    continue
+                seen.add(entry.path)
+                if self._failed.get(entry.path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                candidate = self._candidates.get(entry.path)
+                if candidate is None or candidate[:2] != (stat.st_size, stat.st_mtime_ns):
+                    # new file, or still being written
+                    self._candidates[entry.path] = (stat.st_size, stat.st_mtime_ns, now)
+                elif now - candidate[2] >= self.settle_time_s and len(self._queue) < self.max_queued:
+                    del self._candidates[entry.path]
+                    self._queue.append(entry.path)
+        # forget files that have disappeared
+        for path in [path for path in self._candidates if path not in seen]:
+            del self._candidates[path]
+        for path in [path for path in self._failed if path not in seen]:
+            del self._failed[path]
+
+    def _collect_results(self, block: bool = False) -> None:
+        """
+        Report the finished files and move the ones that were processed or skipped to the
+        output directory.
 
+        :param block: wait until at least one file is finished
+        """
+        if block:
+            done: set[Future] = wait(self._in_flight, return_when=FIRST_COMPLETED).done
+        else:
+            done = {future for future in self._in_flight if future.done()}
+        for future in done:
+            path: str = self._in_flight.pop(future)
+            try:
+                result: JobResult = future.result()
+            except BrokenProcessPool as exc:
+                if path not in self._crashed and not self._stopping:
+                    # a worker died and took every file in progress down with it, try them again
+                    self._crashed.add(path)
+                    self._queue.appendleft(path)
+                    print(f'requeued: {path} (a worker process crashed)', flush=True)
+                    continue
+                result = JobResult(path, JobStatus.FAILED, f'{type(exc).__name__}: {exc}')
+            except Exception as exc:
+                result = JobResult(path, JobStatus.FAILED, f'{type(exc).__name__}: {exc}')
+            self._crashed.discard(path)
+            if result.status != JobStatus.FAILED:
+                try:
+                    shutil.move(path, os.path.join(self.output_dir, os.path.basename(path)))
+                except OSError as exc:
+                    result = JobResult(path, JobStatus.FAILED, f'could not move to output directory: {exc}')
+            if result.status == JobStatus.FAILED:
+                try:
+                    stat = os.stat(path)
+                    self._failed[path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    pass
+            print(result, flush=True)
+
+
+def process_gcode_bytes(data: bytes, time_model: TimeModel = TimeModel.LINE_COUNT,
+                        cache: ResultCache | None = None) -> tuple[JobResult, bytes]:
+    """
+    Post process gcode held in memory. The cache works on files, so with a cache the gcode
+    is run through a temporary file.
+
+    :param data: contents of the gcode file
+    :param time_model: how the durations of the gcode blocks are estimated
+    :param cache: cache of processed outputs
+    :return: the result and the output, which is the unchanged input when the file was skipped
+    """
+    if cache is None:
+        try:
+            result, chunks = postprocess_gcode(data, time_model=time_model, name='<bytes>')
+            return result, b''.join(chunks)
+        except Exception as exc:
+            return JobResult('<bytes>', JobStatus.FAILED, f'{type(exc).__name__}: {exc}'), b''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path: str = os.path.join(temp_dir, 'input.gcode')
+        with open(temp_path, 'wb') as writefile:
+            writefile.write(data)
+        result: JobResult = process_file(temp_path, time_model=time_model, cache=cache)
+        result.input_file_path = '<bytes>'
+        if result.status == JobStatus.FAILED:
+            return result, b''
+        with open(temp_path, 'rb') as readfile:
+            return result, readfile.read()
+
+
+class PostprocessServer:
+    """
+    Local server that keeps the post processor loaded and processes requests sent over a
+    unix domain socket on a pool of worker processes.
+
+    Each request is one json header line, optionally followed by the raw gcode:
+    `{"path": ...}` processes a file in place, or writes the output to `output_path` when
+    that is given, and `{"size": n}` followed by n bytes processes the bytes. Both can
+    carry a `time_model` and a `timeout` in seconds. The response is one json header line
+    with `status`, `message` and `size`, followed by `size` bytes of output for byte
+    requests.
+    """
+
+    socket_path: str
+    time_model: TimeModel
+    jobs: int
+    timeout_s: float
+    cache: ResultCache | None
+
+    _executor: ProcessPoolExecutor | None
+
+    def __init__(self, socket_path: str, time_model: TimeModel = TimeModel.LINE_COUNT, jobs: int | None = None,
+                 timeout_s: float = 60.0, cache: ResultCache | None = None) -> None:
+        """
+        Initialize the PostprocessServer class.
+
+        :param socket_path: path of the unix domain socket to listen on
+        :param time_model: time model used when a request does not name one
+        :param jobs: number of worker processes, defaults to the number of cpus
+        :param timeout_s: time budget of a request when it does not set its own
+        :param cache: cache of processed outputs
+        """
+        self.socket_path = socket_path
+        self.time_model = time_model
+        self.jobs = jobs or os.cpu_count() or 1
+        self.timeout_s = timeout_s
+        self.cache = cache
+        self._executor = None
+
+    def run(self) -> None:
+        """
+        Serve requests until interrupted or terminated.
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self) -> None:
+        """
+        Listen on the socket and serve requests until the task is cancelled or the process
+        receives SIGTERM.
+        """
+        if os.path.exists(self.socket_path):
+            # left behind by a previous run
+            os.unlink(self.socket_path)
+        self._start_executor()
+        try:
+            server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+            print(f'Listening on {self.socket_path}', flush=True)
+            try:
+                async with server:
+                    await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            finally:
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
+        finally:
+            self._executor.shutdown()
+
+    def _start_executor(self) -> None:
+        """
+        Start the worker pool, or replace one that a crashed worker has broken.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        # the workers keep the default handler so that they can still be terminated
+        self._executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=signal.signal,
+                                             initargs=(signal.SIGTERM, signal.SIG_DFL))
+
+    def _run_in_executor(self, func: Callable, *args: Any) -> asyncio.Future:
+        """
+        Hand a job to the worker pool. The request that was running when a worker died fails
+        with it, and the first job after that starts a fresh pool instead of failing too.
+
+        :param func: the function to run in a worker
+        :param args: the arguments of the function
+        :return: future of the result
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return loop.run_in_executor(self._executor, func, *args)
+        except BrokenProcessPool:
+            print('A worker process crashed, starting a fresh pool', flush=True)
+            self._start_executor()
+            return loop.run_in_executor(self._executor, func, *args)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve a single request.
+
+        :param reader: stream of the request
+        :param writer: stream of the response
+        """
+        output: bytes = b''
+        try:
+            request: dict[str, Any] = json.loads(await reader.readline())
+            time_model: TimeModel = TimeModel(request.get('time_model', self.time_model.value))
+            timeout_s: float = float(request.get('timeout', self.timeout_s))
+            if 'path' in request:
+                result = await self._process_path(request['path'], request.get('output_path'), time_model, timeout_s)
+            else:
+                data: bytes = await reader.readexactly(int(request['size']))
+                job = self._run_in_executor(process_gcode_bytes, data, time_model, self.cache)
+                try:
+                    result, output = await asyncio.wait_for(job, timeout_s)
+                except asyncio.TimeoutError:
+                    # a job that has already started cannot be stopped, only its result is dropped
+                    result = JobResult('<bytes>', JobStatus.FAILED, f'timed out after {timeout_s}s')
+        except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError) as exc:
+            result = JobResult('', JobStatus.FAILED, f'bad request: {exc}')
+        except Exception as exc:
+            result = JobResult('', JobStatus.FAILED, f'{type(exc).__name__}: {exc}')
+        print(result, flush=True)
+        response: dict[str, Any] = {'status': result.status.value, 'message': result.message, 'size': len(output)}
+        try:
+            writer.write(json.dumps(response).encode(GCODE_ENCODING) + b'\n')
+            writer.write(output)
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            # the client went away
+            pass
+
+    async def _process_path(self, path: str, output_path: str | None, time_model: TimeModel,
+                            timeout_s: float) -> JobResult:
+        """
+        Process a file on the worker pool. The worker writes to a staging file next to the
+        target that only replaces the target when the result is in within the time budget, so
+        a job that runs over never changes the target after it has been reported as timed out.
+
+        :param path: path to the gcode file
+        :param output_path: path to write the output to, defaults to replacing the input file
+        :param time_model: how the durations of the gcode blocks are estimated
+        :param timeout_s: time budget of the request
+        :return: the result for the file
+        """
+        target_path: str = output_path or path
+        temp_fd, staging_path = _create_temp_file(target_path)
+        os.close(temp_fd)
+        job = self._run_in_executor(process_file, path, time_model, self.cache, staging_path)
+        try:
+            # shielded so that the job is still there to clean up after when the wait times out
+            result: JobResult = await asyncio.wait_for(asyncio.shield(job), timeout_s)
+        except BaseException as exc:
+            # a job that has already started cannot be stopped, its output is dropped once it finishes
+            job.add_done_callback(lambda _: _remove_file(staging_path))
+            if isinstance(exc, asyncio.TimeoutError):
+                return JobResult(path, JobStatus.FAILED, f'timed out after {timeout_s}s, {target_path} was left unchanged')
+            raise
+        # skipped files are only copied when the output goes somewhere else
+        if result.status == JobStatus.PROCESSED or (result.status == JobStatus.SKIPPED and target_path != path):
+            _replace_file(staging_path, target_path)
+        else:
+            _remove_file(staging_path)
+        return result
+
+
+def send_request(socket_path: str, request: dict[str, Any], data: bytes | None = None) -> tuple[dict[str, Any], bytes]:
+    """
+    Send a request to a running PostprocessServer and wait for the response.
+
+    :param socket_path: path of the server's unix domain socket
+    :param request: the request header
+    :param data: gcode to send, the request header gets its size
+    :return: the response header and the output bytes
+    """
+    if data is not None:
+        request = dict(request, size=len(data))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode(GCODE_ENCODING) + b'\n')
+        if data is not None:
+            client.sendall(data)
+        with client.makefile('rb') as responsefile:
+            response: dict[str, Any] = json.loads(responsefile.readline())
+            return response, responsefile.read(response.get('size', 0))
 
 
 def main(args) -> None:
@@ -1204,13 +4630,219 @@ def main(args) -> None:
 
     :param args: command line arguments
     """
-    if len(sys.argv) > 1:
-        print(f"Path to file provided: {sys.argv[1]}")
-    else:
+    parser = argparse.ArgumentParser(description='Toolchanger post processing for SuperSlicer gcode.')
+    parser.add_argument(
+        'input_file_paths',
+        nargs='*',
+        help='path to the gcode file, it is processed in place, several files, directories or glob patterns are '
+             'processed in batch mode'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar='PATH',
+        help='write the output here and keep the input file, instead of replacing the input file'
+    )
+    parser.add_argument(
+        '--no-splice',
+        action='store_true',
+        help='rewrite the whole output instead of copying the unchanged parts of the input in the kernel'
+    )
+    parser.add_argument(
+        '--report',
+        metavar='PATH',
+        help='write the predicted temperature of each tool at its pickup and the time spent waiting for it, compared '
+             'to the plan SuperSlicer wrote, as JSON or as CSV if PATH ends in .csv'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='leave the output alone: with --report or --profile the file is processed for those only, '
+             'on its own only the metadata at the end of the file is read and summarized'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=f'write the time, cpu time and memory of each processing stage, with counts of what was changed, as '
+             f'JSON next to the output (OUTPUT{PROFILE_SUFFIX})'
+    )
+    parser.add_argument(
+        '--profile-memory',
+        action='store_true',
+        help='with --profile, also trace the python allocations of each stage, this slows processing down'
+    )
+    parser.add_argument(
+        '--time-model',
+        choices=[time_model.value for time_model in TimeModel],
+        default=None,
+        help=f'how the durations of the gcode blocks are estimated (default: {TimeModel.LINE_COUNT.value})'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='process the body of the print a few layers at a time in two passes over the file, so that the memory '
+             'used does not grow with the size of the file, for very large files'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of worker processes in batch, watch and server mode (default: number of cpus)'
+    )
+    parser.add_argument('--watch', metavar='DIR', help='watch a directory and process the gcode files exported to it')
+    parser.add_argument('--output-dir', metavar='DIR', help='directory the watched files are moved to once processed')
+    parser.add_argument(
+        '--settle-time',
+        type=float,
+        default=2.0,
+        help='seconds the size of a watched file has to stay the same before it is processed (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=100,
+        help='maximum number of watched files waiting for a worker (default: %(default)s)'
+    )
+    parser.add_argument('--serve', metavar='SOCKET', help='serve processing requests on a unix domain socket')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=None,
+        help='time budget of a request in seconds, in server mode this is the default for requests that do not set '
+             'their own (default: 60)'
+    )
+    parser.add_argument('--connect', metavar='SOCKET', help='send the file to a running server instead of processing it here')
+    parser.add_argument(
+        '--send-bytes',
+        action='store_true',
+        help='with --connect, send the contents of the file and write the result back, for servers that cannot '
+             'access the file'
+    )
+    parser.add_argument('--cache-dir', metavar='DIR', help='keep processed outputs in this directory and reuse them '
+                                                           'when the same file is processed again')
+    parser.add_argument(
+        '--cache-size',
+        type=float,
+        default=1024,
+        help='size of the cache in MB, the least recently used outputs are evicted beyond it (default: %(default)s)'
+    )
+    options = parser.parse_args(args[1:])
+    if options.stream and (options.report is not None or options.profile):
+        parser.error('--stream cannot be combined with --report or --profile, they need the whole print in memory')
+    time_model: TimeModel = TimeModel(options.time_model or TimeModel.LINE_COUNT.value)
+    cache: ResultCache | None = None
+    if options.cache_dir is not None:
+        cache = ResultCache(options.cache_dir, max_size_bytes=int(options.cache_size * 1024 ** 2))
+    if options.serve is not None:
+        PostprocessServer(
+            options.serve,
+            time_model=time_model,
+            jobs=options.jobs,
+            timeout_s=options.timeout if options.timeout is not None else 60.0,
+            cache=cache
+        ).run()
+        return
+    if options.watch is not None:
+        if options.output_dir is None or options.input_file_paths:
+            parser.error('--watch needs --output-dir and no input files')
+        FolderWatcher(
+            options.watch,
+            options.output_dir,
+            time_model=time_model,
+            jobs=options.jobs,
+            settle_time_s=options.settle_time,
+            max_queued=options.queue_size,
+            cache=cache
+        ).run()
+        return
+    if not options.input_file_paths:
         print("No file path provided, exiting now.")
         sys.exit(1)
-    
-    processor: ToolchangerPostprocessor = ToolchangerPostprocessor(sys.argv[1])
-    processor.process_gcode()
 
-main(sys.argv)
\ No newline at end of file
+    if len(options.input_file_paths) > 1 or not os.path.isfile(options.input_file_paths[0]):
+        # batch mode
+        if options.output is not None:
+            parser.error('--output only works with a single input file')
+        if options.stream:
+            parser.error('--stream only works with a single input file')
+        if options.connect is not None or options.send_bytes:
+            parser.error('--connect and --send-bytes only work with a single input file')
+        if options.no_splice:
+            parser.error('--no-splice only works with a single input file')
+        if options.dry_run or options.report is not None:
+            parser.error('--dry-run and --report only work with a single input file')
+        input_file_paths: list[str] = expand_input_paths(options.input_file_paths)
+        if not input_file_paths:
+            print("No gcode files found, exiting now.")
+            sys.exit(1)
+        print(f"Processing {len(input_file_paths)} files")
+        results: list[JobResult] = process_files(input_file_paths, time_model=time_model, jobs=options.jobs, cache=cache,
+                                                 profile=options.profile)
+        counts: dict[JobStatus, int] = {status: 0 for status in JobStatus}
+        for result in results:
+            counts[result.status] += 1
+        print(', '.join(f'{count} {status.value}' for status, count in counts.items()))
+        sys.exit(1 if counts[JobStatus.FAILED] else 0)
+
+    print(f"Path to file provided: {options.input_file_paths[0]}")
+    if options.connect is not None:
+        # thin client, the server does the work
+        request: dict[str, Any] = {}
+        if options.time_model is not None:
+            request['time_model'] = options.time_model
+        if options.timeout is not None:
+            request['timeout'] = options.timeout
+        if options.send_bytes:
+            with open(options.input_file_paths[0], 'rb') as readfile:
+                response, output = send_request(options.connect, request, readfile.read())
+            if response['status'] != JobStatus.FAILED.value and \
+                    (response['status'] == JobStatus.PROCESSED.value or options.output is not None):
+                write_file_atomically(options.output or options.input_file_paths[0], [output])
+        else:
+            request['path'] = os.path.abspath(options.input_file_paths[0])
+            if options.output is not None:
+                request['output_path'] = os.path.abspath(options.output)
+            response, output = send_request(options.connect, request)
+        print(f"{response['status']}: {response['message']}" if response['message'] else response['status'])
+        sys.exit(1 if response['status'] == JobStatus.FAILED.value else 0)
+    output_file_path: str = options.output or options.input_file_paths[0]
+    cache_key: str = ''
+    if cache is not None and not options.profile and options.report is None and not options.dry_run:
+        cache_key = cache.key(options.input_file_paths[0], time_model)
+        if cache.fetch(cache_key, output_file_path):
+            print("Output taken from the cache.")
+            return
+    try:
+        processor: ToolchangerPostprocessor = ToolchangerPostprocessor(
+            options.input_file_paths[0],
+            time_model=time_model,
+            output_file_path=output_file_path,
+            splice_output=not options.no_splice,
+            stream=options.stream
+        )
+    except OSError as exc:
+        print('FileReadError:' + str(exc))
+        sys.exit(1)
+    if options.dry_run and options.report is None and not options.profile:
+        # nothing is written, so only the metadata at the end of the file and the start of the gcode are read
+        print(processor.summary())
+        return
+    profiler: StageProfiler | None = None
+    if options.profile:
+        profiler = StageProfiler(trace_memory=options.profile_memory)
+        profiler.instrument(processor)
+    result: JobResult = processor.process_gcode(write_output=not options.dry_run, report_file_path=options.report)
+    if result.status is JobStatus.SKIPPED:
+        print(f'{result.message}, exiting now.')
+        return
+    if result.message:
+        print(result.message)
+    if profiler is not None:
+        profiler.write_report(output_file_path + PROFILE_SUFFIX, processor)
+        print(f"Profile written to {output_file_path + PROFILE_SUFFIX}")
+    elif cache is not None and not options.dry_run and options.report is None:
+        cache.store(cache_key, output_file_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)